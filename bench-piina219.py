@@ -0,0 +1,687 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks for the PiINA219 read path. Runs on the simulated bus (piina219/simbus.py) so no board is needed.
+Needs pi-ina219 installed (requirements-pi-ina219.txt).
+
+$ python3 bench-piina219.py burst            # getdata legacy (voltage/current/power calls) vs burst read
+$ python3 bench-piina219.py burst --xfer 0.1 # i2c transaction time in ms (0.4 ~100kHz, 0.1 ~400kHz)
+$ python3 bench-piina219.py acquire          # fresh samples/s, duplicates and misses per ADC setting and acquire mode
+$ python3 bench-piina219.py multi            # cycle time vs number of boards, one bus vs several, triggered pipelining
+$ python3 bench-piina219.py gain             # lost samples, i2c cost and gain switches per gainmode on a spiky load profile
+$ python3 bench-piina219.py startup          # time to first sample, full configure vs cached calibration (fast start)
+$ python3 bench-piina219.py analysis -n 2000000   # piina219.analysis on n samples from a capture file (needs numpy)
+$ python3 bench-piina219.py publish          # publish call latency, paho queue and drops per queue policy against a slow local broker
+$ python3 bench-piina219.py backends         # read latency/throughput per driver backend (pi-ina219, smbus, adafruit), fastest pick
+$ python3 bench-piina219.py trigger          # bytes/sec of triggered event captures vs the 1Hz stream vs full rate batches
+$ python3 bench-piina219.py influx           # points/s into a local influx stand-in, one write per point vs gzip batches, outage
+$ python3 bench-piina219.py spool            # broker down/restart: spooled while down, drained after, none lost or sent twice
+$ python3 bench-piina219.py alloc -n 100000  # gc collections and pause time per sample path, new objects per read vs caller buffers
+$ python3 bench-piina219.py suite --json results.json
+    latency  per-sample latency percentiles for each read path
+    rate     samples/sec per device with Sampler threads, boards on one bus vs spread over buses
+    e2e      sample to publish latency (read, dict, json, publish) on a null mqtt client, single and batched
+    --json saves the numbers so a later run can be compared against them (regression check)
+'''
+
+import argparse, logging, json, math, os, tempfile
+from time import perf_counter_ns, sleep
+from ina219 import INA219
+import piina219
+
+def percentile(sorted_ns, pct):
+    return sorted_ns[min(len(sorted_ns) - 1, int(len(sorted_ns) * pct / 100))]
+
+def report(name, deltas, transactions):
+    deltas.sort()
+    n = len(deltas)
+    print("{0:<12} n:{1:<6} mean:{2:7.3f}ms p50:{3:7.3f}ms p99:{4:7.3f}ms max:{5:7.3f}ms i2c/sample:{6:.1f} samples/s:{7:8.0f}".format(
+        name, n, sum(deltas)/n/10**6, percentile(deltas, 50)/10**6, percentile(deltas, 99)/10**6, deltas[-1]/10**6,
+        transactions/n, n/(sum(deltas)/10**9)))
+
+def summary(deltas):
+    ''' Latency percentiles in ms from a list of ns deltas '''
+    deltas.sort()
+    n = len(deltas)
+    return {'n': n, 'mean_ms': sum(deltas)/n/10**6, 'p50_ms': percentile(deltas, 50)/10**6, 'p90_ms': percentile(deltas, 90)/10**6,
+            'p99_ms': percentile(deltas, 99)/10**6, 'max_ms': deltas[-1]/10**6, 'per_s': n/(sum(deltas)/10**9)}
+
+def print_summary(name, stats):
+    print("  {0:<22} n:{1:<6} mean:{2:7.3f}ms p50:{3:7.3f}ms p90:{4:7.3f}ms p99:{5:7.3f}ms max:{6:7.3f}ms {7:8.0f}/s".format(
+        name, stats['n'], stats['mean_ms'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms'], stats['per_s']))
+
+def time_getdata(ina, sim, n):
+    deltas = []
+    t0_transactions = sim.transactions
+    for _ in range(n):
+        t0 = perf_counter_ns()
+        ina.getdata()
+        deltas.append(perf_counter_ns() - t0)
+    return deltas, sim.transactions - t0_transactions
+
+def bench_burst(args):
+    logger = logging.getLogger('bench')
+    for name, burst, shuntkey in (('legacy', False, None), ('burst', True, None), ('burst+shunt', True, 'VshuntmVf')):
+        sim = piina219.SimINA219(volts=5.0, amps=0.120, xfer_s=args.xfer/1000)
+        ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, logger=logger, i2c=sim, burst=burst, shuntkey=shuntkey)
+        deltas, transactions = time_getdata(ina, sim, args.n)
+        report(name, deltas, transactions)
+
+def bench_acquire(args):
+    logger = logging.getLogger('bench')
+    for adc in (INA219.ADC_9BIT, INA219.ADC_12BIT, INA219.ADC_4SAMP, INA219.ADC_32SAMP):
+        for acquire in (None, 'ready', 'triggered'):
+            sim = piina219.SimINA219(volts=5.0, amps=0.120, xfer_s=args.xfer/1000)
+            ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, logger=logger, i2c=sim,
+                                    bus_adc=adc, shunt_adc=adc, acquire=acquire)
+            n = max(20, min(args.n, int(1 / ina.conversion_time())))   # ~1 sec per run
+            t0 = perf_counter_ns()
+            for _ in range(n):
+                ina.read()
+            seconds = (perf_counter_ns() - t0) / 10**9
+            stats = ina.acqstats()
+            fresh = stats['samples'] - stats['duplicates']
+            print("adc:{0:<3} {1:<10} conv:{2:7.3f}ms fresh/s:{3:7.0f} reads/s:{4:7.0f} duplicates:{5:<5} missed:{6:<5} polls:{7:<5} i2c/fresh:{8:.1f}".format(
+                adc, str(acquire), ina.conversion_time()*1000, fresh/seconds, n/seconds, stats['duplicates'], stats['missed'],
+                stats['polls'], sim.transactions/max(fresh, 1)))
+
+def build_set(count, buses, acquire, xfer_s):
+    ''' count boards spread round robin over buses simulated i2c buses '''
+    logger = logging.getLogger('bench')
+    simbuses = [piina219.SimI2CBus(busnum, xfer_s) for busnum in range(1, buses + 1)]
+    ina219Set = {}
+    for i in range(count):
+        sim = simbuses[i % buses].device(0x40 + i // buses, amps=0.1)
+        ina219Set['ina{0}'.format(i)] = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, sim.address, logger=logger,
+                                                          i2c=sim, acquire=acquire)
+    return ina219Set
+
+def bench_multi(args):
+    cycles = max(10, args.n // 20)
+    for count in (1, 2, 4, 8, 16):
+        row = []
+        for name, buses, acquire, multi in (('sequential', 1, None, False), ('multi 1bus', 1, None, True),
+                                            ('multi 4bus', 4, None, True), ('trig seq', 1, 'triggered', False),
+                                            ('trig multi', 1, 'triggered', True)):
+            ina219Set = build_set(count, buses, acquire, args.xfer/1000)
+            reader = piina219.MultiReader(ina219Set, logger=logging.getLogger('bench'))
+            t0 = perf_counter_ns()
+            for _ in range(cycles):
+                if multi:
+                    reader.read()
+                else:                       # demoMQTT style, one board after the other
+                    for ina219 in ina219Set.values():
+                        ina219.read()
+            row.append("{0}:{1:7.2f}ms".format(name, (perf_counter_ns() - t0) / cycles / 10**6))
+            reader.close()
+        print("boards:{0:<3} ".format(count) + "  ".join(row))
+
+class NullClient:
+    ''' Stands in for paho mqtt.Client. Publish returns at once like paho queueing a QoS 0 message '''
+    class Info:
+        rc = 0
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+    def is_connected(self):
+        return True
+    def publish(self, topic, payload, qos=0):
+        self.messages += 1
+        self.bytes += len(payload)
+        return self.Info
+
+def suite_latency(args):
+    print("latency - one read per call, {0}ms per i2c transaction".format(args.xfer))
+    results = {}
+    logger = logging.getLogger('bench')
+    for name, kwargs, call in (('getdata legacy', {'burst': False}, 'getdata'), ('getdata burst', {}, 'getdata'),
+                               ('read burst', {}, 'read'), ('read burst+shunt', {'shuntkey': 'VshuntmVf'}, 'read'),
+                               ('read ready', {'acquire': 'ready'}, 'read'), ('read triggered', {'acquire': 'triggered'}, 'read')):
+        sim = piina219.SimINA219(volts=5.0, amps=0.120, xfer_s=args.xfer/1000)
+        ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, logger=logger, i2c=sim, **kwargs)
+        func = getattr(ina, call)
+        deltas = []
+        for _ in range(args.n if 'acquire' not in kwargs else args.n // 4):
+            t0 = perf_counter_ns()
+            func()
+            deltas.append(perf_counter_ns() - t0)
+        results[name] = summary(deltas)
+        print_summary(name, results[name])
+    return results
+
+def suite_rate(args):
+    print("rate - Sampler threads for 1 sec, samples/sec per device")
+    results = {}
+    for count, buses in ((1, 1), (4, 1), (4, 4), (8, 2)):
+        ina219Set = build_set(count, buses, None, args.xfer/1000)
+        samplers = [piina219.Sampler(ina219, size=5000, logger=logging.getLogger('bench')) for ina219 in ina219Set.values()]
+        for sampler in samplers:
+            sampler.start()
+        sleep(1)
+        for sampler in samplers:
+            sampler.stop()
+        rates = [sampler.ring.count for sampler in samplers]
+        name = "{0} boards {1} bus".format(count, buses)
+        results[name] = {'per_device_min': min(rates), 'per_device_mean': sum(rates)/len(rates), 'total': sum(rates)}
+        print("  {0:<22} per device mean:{1:7.0f}/s min:{2:7.0f}/s total:{3:7.0f}/s".format(
+            name, results[name]['per_device_mean'], results[name]['per_device_min'], results[name]['total']))
+    return results
+
+def suite_e2e(args):
+    print("e2e - sample to publish (read + dict + encode + publish call)")
+    results = {}
+    logger = logging.getLogger('bench')
+    for name, batch in (('json per reading', None), ('batch json 100', 'json'), ('batch struct 100', 'struct')):
+        sim = piina219.SimINA219(volts=5.0, amps=0.120, xfer_s=args.xfer/1000)
+        ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, logger=logger, i2c=sim)
+        client = NullClient()
+        batcher = piina219.BatchPublisher(client, 'pi2nred/ina219A/bench', batch, max_samples=100) if batch else None
+        deltas = []
+        for _ in range(args.n):
+            t0 = perf_counter_ns()
+            data = ina.getdata()
+            if batcher is None:
+                client.publish('pi2nred/ina219A/bench', json.dumps(data))
+            else:
+                batcher.add('ina219A', t0 / 10**9, data)
+            deltas.append(perf_counter_ns() - t0)
+        results[name] = summary(deltas)
+        results[name]['messages'] = client.messages
+        results[name]['bytes_per_sample'] = client.bytes / args.n
+        print_summary(name, results[name])
+        print("  {0:<22} messages:{1} bytes/sample:{2:.1f}".format('', client.messages, client.bytes / args.n))
+    return results
+
+def load_profile():
+    ''' Load per conversion: slow 0-1.2A swell with 2.5A spikes, and quiet 20mA stretches '''
+    count = [0]
+    def profile(t):
+        count[0] += 1
+        i = count[0]
+        if (i // 2000) % 2:
+            return 5.0, 0.02
+        if i % 500 < 5:
+            return 5.0, 2.5
+        return 5.0, 0.6 + 0.6 * math.sin(i / 300)
+    return profile
+
+def ramp_profile(up=4000, hold=1000, down=4000, top=2.5, quiet=0.02):
+    ''' Load per conversion: ramp quiet -> top, hold, ramp back down, then stay quiet '''
+    count = [0]
+    def profile(t):
+        count[0] += 1
+        i = count[0]
+        if i < up:
+            return 5.0, quiet + (top - quiet) * i / up
+        if i < up + hold:
+            return 5.0, top
+        if i < up + hold + down:
+            return 5.0, top - (top - quiet) * (i - up - hold) / down
+        return 5.0, quiet
+    return profile
+
+def check_gain():
+    ''' Hysteretic gain on a ramp: steps up ahead of the load (nothing clips or is lost), only steps down after
+    gain_hold quiet samples, and is back on the 40mV range when the load is quiet again '''
+    sim = piina219.SimINA219(profile=ramp_profile(), xfer_s=0, convert_s=0)
+    ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', 'hysteretic', 0.4, 0x40, logger=logging.getLogger('bench'), i2c=sim)
+    changes = []                          # (read index, new gain)
+    gain = ina.ina219._gain
+    lost = 0
+    for i in range(12000):
+        volts, amps, watts, mVshunt = ina.read()
+        if amps is None:
+            lost += 1
+        if ina.ina219._gain != gain:
+            gain = ina.ina219._gain
+            changes.append((i, gain))
+    stats = ina.acqstats()
+    gains = [gain for i, gain in changes]
+    top = gains.index(max(gains))
+    print("  {0:<11} ramp 0.02-2.5-0.02A: lost:{1} overflows:{2} recoveries:{3} gain changes:{4}".format(
+        'hysteretic', lost, stats['overflows'], stats['gain_recoveries'], changes))
+    assert lost == 0 and stats['overflows'] == 0 and stats['gain_recoveries'] == 0, stats   # Stepped up before it clipped
+    assert max(gains) == 3 and gains[:top + 1] == sorted(gains[:top + 1]), changes        # Only up while the load rises
+    assert gains[top:] == sorted(gains[top:], reverse=True) and gains[-1] == 0, changes   # Back down to 40mV
+    for (i, gain), (j, after) in zip(changes[top:], changes[top + 1:]):
+        assert j - i >= ina.gain_hold, changes   # Each step down waits gain_hold samples below the next range
+
+def bench_gain(args):
+    print("gain - {0} reads of a spiky load per gainmode".format(args.n * 4))
+    for gainmode in ('manual', 'auto', 'hysteretic'):
+        sim = piina219.SimINA219(profile=load_profile(), xfer_s=0, convert_s=0)
+        ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', gainmode, 0.4, 0x40, logger=logging.getLogger('bench'), i2c=sim)
+        lost = 0
+        gains = [0, 0, 0, 0]              # Samples taken at each PGA range. Lower ranges are more accurate on small loads
+        for _ in range(args.n * 4):
+            volts, amps, watts, mVshunt = ina.read()
+            if amps is None:
+                lost += 1
+            gains[ina.ina219._gain] += 1
+        stats = ina.acqstats()
+        print("  {0:<11} lost:{1:<6} i2c/sample:{2:.3f} overflows:{3:<5} ups:{4:<4} downs:{5:<4} recoveries:{6:<4} 40/80/160/320mV:{7}".format(
+            gainmode, lost, sim.transactions / (args.n * 4), stats['overflows'], stats['gain_ups'], stats['gain_downs'],
+            stats['gain_recoveries'], '/'.join(str(n) for n in gains)))
+    check_gain()
+
+def bench_startup(args):
+    print("startup - PiINA219() to first sample, {0}ms per i2c transaction".format(args.xfer))
+    cache = os.path.join(tempfile.mkdtemp(), 'ina219-cache.json')
+    sim = piina219.SimINA219(volts=5.0, amps=0.120, xfer_s=args.xfer/1000)
+    for name, kwargs in (('configure', {}), ('cache, first run', {'cache': cache}), ('cache, restart', {'cache': cache})):
+        sim.transactions = 0
+        t0 = perf_counter_ns()
+        ina = piina219.PiINA219('Vbusf', 'IbusAf', 'PowerWf', "auto", 0.4, 0x40, logger=logging.getLogger('bench'), i2c=sim, **kwargs)
+        ina.read()
+        print("  {0:<18} {1:7.3f}ms i2c transactions:{2}".format(name, (perf_counter_ns() - t0)/10**6, sim.transactions))
+    os.remove(cache)
+
+def bench_analysis(args):
+    from piina219 import analysis
+    print("analysis - {0} samples, spiky load (as gain) at 2000 samples/s with 120Hz ripple".format(args.n))
+    path = os.path.join(tempfile.mkdtemp(), 'bench.cap')
+    cap = piina219.Capture(path, chunk=args.n)
+    profile = load_profile()
+    t0 = perf_counter_ns()
+    for i in range(args.n):
+        volts, amps = profile(i)
+        amps += 0.01 * math.sin(2 * math.pi * 120 * i / 2000)
+        current = int(amps / 0.0001)
+        cap.append(i / 2000, 0x40, int(volts / 0.004) << 3 | 2, current, int(abs(current) * volts / 20), current // 10, 0.0001)
+    cap.close()
+    print("  {0:<14} {1:8.1f}ms (Capture.append, for scale)".format('write', (perf_counter_ns() - t0)/10**6))
+    results = {}
+    data = None
+    for name, func in (('load_capture', lambda: analysis.load_capture(path)),
+                       ('window_stats', lambda: analysis.window_stats(data.t, data.amps, 1.0)),
+                       ('ripple', lambda: analysis.ripple(data.t, data.amps, fmin=100)),
+                       ('events', lambda: analysis.events(data.t, data.amps, 2.0, 1.5)),
+                       ('peaks', lambda: analysis.peaks(data.t, data.amps, 2.0, 0.1)),
+                       ('energy', lambda: analysis.energy(data.t, data.volts, data.amps, data.watts, 60))):
+        t0 = perf_counter_ns()
+        results[name] = func()
+        print("  {0:<14} {1:8.1f}ms".format(name, (perf_counter_ns() - t0)/10**6))
+        data = results['load_capture']
+    print("  ripple {0[0]:.1f}Hz {0[1]:.4f}A, {1} events, {2:.4f}Ah".format(
+        results['ripple'], len(results['events'].start), results['energy']['Ah'].sum()))
+    os.remove(path)
+
+def bench_publish(args):
+    import paho.mqtt.client as mqtt
+    rate, broker_rate = 1000, 300
+    print("publish - {0} msgs at {1}/s into a local broker reading {2}/s, QoS 1 acks after 10ms".format(args.n, rate, broker_rate))
+    for name, policy in (('paho direct', None), ('drop-oldest', 'drop-oldest'), ('coalesce', 'coalesce'), ('block', 'block')):
+        broker = piina219.SimBroker(rate=broker_rate, ack_delay=0.01)
+        client = mqtt.Client('bench')
+        client.connect('127.0.0.1', broker.port)
+        client.loop_start()
+        while not client.is_connected():
+            sleep(0.01)
+        pub = client
+        if policy is not None:
+            pub = piina219.AsyncPublisher(client, maxsize=200, policy=policy, max_inflight=20, qos=1, block_timeout=0.05)
+            client.on_publish = lambda c, userdata, mid: pub.acked(mid)
+        deltas = []
+        paho_max = 0
+        inflight_max = 0
+        for i in range(args.n):
+            t0 = perf_counter_ns()
+            pub.publish('pi2nred/ina219{0}/bench'.format('ABCD'[i % 4]), '{{"IbusAf": {0}}}'.format(i), 1)
+            deltas.append(perf_counter_ns() - t0)
+            paho_max = max(paho_max, len(client._out_messages))
+            if policy is not None:
+                inflight_max = max(inflight_max, pub.stats()['inflight'])
+            sleep(1 / rate)
+        print_summary(name, summary(deltas))
+        if policy is None:
+            print("  {0:<22} paho queue max:{1}".format('', paho_max))
+        else:
+            pub.close(30)                 # Send everything queued so the counts below are final
+            stats = pub.stats()
+            print("  {0:<22} paho queue max:{1} queue max:{2} inflight max:{3} sent:{4} dropped:{5} coalesced:{6} blocked:{7}".format(
+                '', paho_max, stats['queue_max'], inflight_max, stats['sent'], stats['dropped'], stats['coalesced'], stats['blocked']))
+            assert stats['queue_max'] <= 200, stats
+            assert inflight_max <= 20, inflight_max
+            assert paho_max <= 20, paho_max
+            assert stats['queue_depth'] == 0, stats
+            assert stats['sent'] + stats['dropped'] + stats['coalesced'] == args.n, stats   # Every publish() accounted for
+            if policy == 'block':
+                assert stats['queued'] + stats['dropped'] == args.n, stats   # Only timed out waits drop
+            else:
+                assert stats['queued'] + stats['coalesced'] == args.n, stats
+                assert stats['queued'] == stats['sent'] + stats['dropped'], stats
+            t_end = perf_counter_ns()
+            while broker.messages < stats['sent'] and perf_counter_ns() - t_end < 10**10:
+                sleep(0.05)
+            assert broker.messages == stats['sent'], (broker.messages, stats['sent'])
+        client.disconnect()
+        client.loop_stop()
+        broker.close()
+    # block: with the queue full and nothing draining (not connected) publish() waits block_timeout, then drops
+    client = mqtt.Client('bench-block')
+    pub = piina219.AsyncPublisher(client, maxsize=5, policy='block', block_timeout=0.2)
+    for i in range(5):
+        assert pub.publish('pi2nred/ina219A/bench', str(i))
+    t0 = perf_counter_ns()
+    kept = pub.publish('pi2nred/ina219A/bench', '5')
+    waited = (perf_counter_ns() - t0) / 10**9
+    stats = pub.stats()
+    print("  {0:<22} full queue, not connected: waited {1:.3f}s (block_timeout 0.2) kept:{2} dropped:{3} depth:{4}".format(
+        'block', waited, kept, stats['dropped'], stats['queue_depth']))
+    assert not kept and 0.19 <= waited < 0.4 and stats['dropped'] == 1 and stats['queue_depth'] == 5, (waited, stats)
+    pub.close(0.1)
+
+def delivered(received):
+    ''' seqi of every reading a broker received, single JSON or spool batches '''
+    from piina219.batch import decode
+    out = []
+    for topic, payload in received:
+        obj = json.loads(payload)
+        if 't0' in obj:
+            out += [values['seqi'] for device, t, values in decode(payload)]
+        else:
+            out.append(obj['seqi'])
+    return out
+
+def check_delivery(name, received, n):
+    seqs = delivered(received)
+    lost = set(range(n)) - set(seqs)
+    duplicates = len(seqs) - len(set(seqs))
+    print("  {0:<30} sent:{1} delivered:{2} messages:{3} lost:{4} duplicates:{5}".format(
+        name, n, len(set(seqs)), len(received), len(lost), duplicates))
+    assert not lost and not duplicates, (sorted(lost)[:10], duplicates)
+
+def bench_spool(args):
+    import paho.mqtt.client as mqtt
+    n = args.n - args.n % 3
+    print("spool - {0} readings: a third live, a third while the broker is down, a third while draining".format(n))
+    with tempfile.TemporaryDirectory() as directory:
+        broker = piina219.SimBroker(keep=True)
+        port = broker.port
+        client = mqtt.Client('bench-spool')
+        client.reconnect_delay_set(0.05, 0.2)
+        client.connect('127.0.0.1', port)
+        client.loop_start()
+        while not client.is_connected():
+            sleep(0.01)
+        spool = piina219.Spool(os.path.join(directory, 'spool'), segment_bytes=4096)
+        pub = piina219.SpoolPublisher(client, spool, drain_rate=2000)
+        topic = lambda i: 'pi2nred/ina219{0}/bench'.format('AB'[i % 2])
+        for i in range(n // 3):
+            pub.publish(topic(i), '{{"seqi": {0}, "IbusAf": 0.1}}'.format(i))
+        while broker.messages < n // 3:
+            sleep(0.01)
+        received = broker.received
+        broker.close()
+        while client.is_connected():
+            sleep(0.01)
+        for i in range(n // 3, 2 * n // 3):
+            pub.publish(topic(i), '{{"seqi": {0}, "IbusAf": 0.1}}'.format(i))
+        assert pub.spooled == n // 3, pub.spooled
+        spool.close()                     # Restart of this process too: the backlog is read back from disk
+        pub.spool = spool = piina219.Spool(os.path.join(directory, 'spool'), segment_bytes=4096)
+        broker = piina219.SimBroker(port=port, keep=True)
+        while not client.is_connected():
+            sleep(0.01)
+        for i in range(2 * n // 3, n):
+            pub.publish(topic(i), '{{"seqi": {0}, "IbusAf": 0.1}}'.format(i))
+            pub.drain()
+            sleep(0.0005)
+        while spool:
+            pub.drain()
+            sleep(0.01)
+        count = -1
+        while count != broker.messages:   # Let the last drained messages arrive
+            count = broker.messages
+            sleep(0.2)
+        check_delivery('broker killed and restarted', received + broker.received, n)
+        client.disconnect()
+        client.loop_stop()
+        broker.close()
+
+    class FlakyClient:
+        ''' Connected, but publish fails after ok messages (connection lost in the middle of a drain) '''
+        def __init__(self, ok):
+            self.ok = ok
+            self.received = []
+        def is_connected(self):
+            return True
+        def publish(self, topic, payload, qos=0):
+            if self.ok is not None and len(self.received) >= self.ok:
+                return type('Info', (), {'rc': mqtt.MQTT_ERR_NO_CONN})()
+            self.received.append((topic, payload.encode() if isinstance(payload, str) else payload))
+            return type('Info', (), {'rc': 0})()
+    with tempfile.TemporaryDirectory() as directory:
+        spool = piina219.Spool(directory)
+        for i in range(200):              # Runs of 5 on one topic, drained as one batch each
+            spool.put('pi2nred/ina219{0}/bench'.format('AB'[i // 5 % 2]), '{{"seqi": {0}}}'.format(i))
+        flaky = FlakyClient(ok=7)
+        pub = piina219.SpoolPublisher(flaky, spool, drain_rate=10**6)
+        sleep(0.01)
+        sent = pub.drain()
+        assert sent == 35, sent           # 7 batches of 5 went out, the rest stays
+        good = FlakyClient(ok=None)
+        pub.client = good
+        while spool:
+            sleep(0.01)
+            pub.drain()
+        check_delivery('connection lost mid drain', flaky.received + good.received, 200)
+
+def bench_influx(args):
+    from time import time
+    from piina219 import influx
+    from urllib.request import Request, urlopen
+    db = piina219.SimInflux()
+    reading = {'Vbusf': 5.012, 'IbusAf': 0.1234, 'PowerWf': 0.6185}
+    print("influx - {0} points into a local influx stand-in".format(args.n))
+    # Like node-red: one JSON message per reading, parsed, one uncompressed write per point
+    series = influx.series('ina219', {'location': 'pi2nred', 'device': 'ina219A', 'publvl3': 'bench'})
+    t0 = perf_counter_ns()
+    for i in range(args.n):
+        data = json.loads(json.dumps(reading))
+        line = '{0} {1} {2}'.format(series, influx.fields(data), int(time() * 10**6))
+        urlopen(Request(db.url + '/write?db=ina219&precision=u', data=line.encode()), timeout=5).close()
+    elapsed = (perf_counter_ns() - t0) / 10**9
+    print("  {0:<22} {1:9.0f} points/s  requests:{2} bytes:{3}".format('write per point', args.n / elapsed, db.requests, db.bytes))
+    for name, down in (('gzip batches', 0), ('batches, 1s outage', 1.0)):
+        db.close()
+        db = piina219.SimInflux()
+        sink = piina219.InfluxSink(db.url, db='ina219', max_points=5000, max_ms=1000, retry_min=0.2, retry_max=1.0)
+        series = sink.series({'location': 'pi2nred', 'device': 'ina219A', 'publvl3': 'bench'})
+        if down:
+            db.down(down)
+        t0 = perf_counter_ns()
+        for i in range(args.n):
+            sink.add(series, time(), reading)
+        add_ns = (perf_counter_ns() - t0) / args.n
+        sink.close(timeout=10)
+        elapsed = (perf_counter_ns() - t0) / 10**9
+        stats = sink.stats()
+        print("  {0:<22} {1:9.0f} points/s  requests:{2} bytes:{3} ({4:.1f}x gzip) add:{5:.1f}us failures:{6} stored:{7}/{8}".format(
+            name, args.n / elapsed, db.requests, db.bytes, stats['raw_bytes'] / max(stats['bytes'], 1), add_ns / 1000,
+            stats['failures'], db.points, args.n))
+    db.close()
+    check_influx()
+
+def check_influx():
+    ''' Delivery checks against SimInflux: precision, outage buffering and order, spill to the spool, 4xx drop '''
+    from time import time
+    reading = {'Vbusf': 5.012, 'IbusAf': 0.1234}
+    quiet = logging.getLogger('bench.influx')   # The retries and drops below are on purpose
+    quiet.setLevel(logging.CRITICAL)
+    def run(n=1000, down=0.0, close=10, **kwargs):
+        db = piina219.SimInflux()
+        if 'bucket' not in kwargs:
+            kwargs.setdefault('db', 'ina219')
+        sink = piina219.InfluxSink(db.url, max_points=100, max_ms=10**6, retry_min=0.1, retry_max=0.2, logger=quiet, **kwargs)
+        series = sink.series({'device': 'ina219A'})
+        if down:
+            db.down(down)
+        t = time()
+        for i in range(n):
+            sink.add(series, t + i / 1000, reading)
+        sink.close(timeout=close)
+        db.close()
+        return db, sink.stats()
+    for kwargs in ({'db': 'ina219'}, {'bucket': 'ina219', 'org': 'home'}):
+        for precision in ('s', 'ms', 'us', 'ns'):
+            db, stats = run(n=10, precision=precision, **kwargs)
+            assert stats['written'] == db.points == 10 and not stats['rejected'], (kwargs, precision, stats)
+    print("  {0:<22} 1.x and 2.x, s/ms/us/ns: all written".format('precision'))
+    db, stats = run(down=1.0)
+    firsts = [first for points, first in db.writes]
+    assert stats['failures'] and stats['written'] == db.points == 1000 and not stats['dropped'], stats
+    assert firsts == sorted(firsts) and len(firsts) == 10, firsts   # Retried oldest first
+    print("  {0:<22} 1s down: {1} failed tries, {2}/1000 written in {3} batches, oldest first".format(
+        'outage', stats['failures'], db.points, len(firsts)))
+    with tempfile.TemporaryDirectory() as directory:
+        spool = piina219.Spool(directory)
+        db, stats = run(down=1.0, max_batches=2, spool=spool)
+        assert stats['spooled'] == 800 and db.points == 1000 and not stats['dropped'] and not spool, stats
+        print("  {0:<22} max_batches 2: {1} points spooled, {2}/1000 written".format('spill to spool', stats['spooled'], db.points))
+    db, stats = run(down=1.0, max_batches=2)
+    assert stats['dropped'] == 800 and db.points == stats['written'] == 200, stats
+    print("  {0:<22} max_batches 2, no spool: {1} dropped, {2} written".format('spill, no spool', stats['dropped'], db.points))
+    db = piina219.SimInflux()
+    sink = piina219.InfluxSink(db.url, db='ina219', max_points=10, max_ms=10**6, retry_min=0.1, logger=quiet)
+    for i in range(10):
+        sink.add('', time(), reading)     # No measurement, influx answers 400
+    for i in range(10):
+        sink.add(sink.series({'device': 'ina219A'}), time(), reading)
+    sink.close(timeout=5)
+    db.close()
+    stats = sink.stats()
+    assert stats['rejected'] == 10 and db.errors == 1 and stats['written'] == db.points == 10 and not stats['failures'], stats
+    print("  {0:<22} bad batch rejected once ({1} points), not retried; next batch written".format('4xx', stats['rejected']))
+
+def bench_trigger(args):
+    from piina219.batch import encode
+    def profile(t):                   # 5ms 0.35A inrush every 2 sec and a 3ms brown-out to 4.2V
+        phase = t % 2
+        return (4.2 if 1.0 < phase < 1.003 else 5.0), (0.35 if phase < 0.005 else 0.1)
+    seconds = 6
+    sim = piina219.SimINA219(0x40, xfer_s=args.xfer / 1000, profile=profile, noise_amps=0.001)
+    ina = piina219.PiINA219(i2c=sim, bus_adc=0, shunt_adc=0)
+    triggers = [piina219.Trigger('IbusAf', 'rising', level=0.3, hysteresis=0.02, pre=0.002, post=0.01, holdoff=0.5),
+                piina219.Trigger('Vbusf', 'falling', level=4.5, hysteresis=0.1, pre=0.002, post=0.006, holdoff=0.5)]
+    sampler = piina219.Sampler(ina, size=50000, onsample=lambda *sample: [trigger.add(*sample) for trigger in triggers])
+    sampler.start()
+    stream = 0
+    for i in range(seconds):
+        sleep(1)
+        stream += len(json.dumps(sampler.flatstats(seconds=1)))
+    sampler.stop()
+    t, cols = sampler.ring.slice(seconds=seconds)
+    full = len(encode([('ina219A', x, dict(zip(sampler.ring.fields, values))) for x, *values in zip(t, *cols)], 'struct'))
+    events = [payload for trigger in triggers for payload in trigger.poll()]
+    print("trigger - {0}s at {1:.0f} samples/s, an inrush and a brown-out every 2s".format(seconds, len(t) / seconds))
+    print("  {0:<22} {1:8.0f} bytes/s".format('full rate (struct)', full / seconds))
+    print("  {0:<22} {1:8.0f} bytes/s".format('1Hz window stats', stream / seconds))
+    print("  {0:<22} {1:8.0f} bytes/s  events:{2} samples/event:{3:.0f}".format(
+        'trigger events', sum(map(len, events)) / seconds, len(events),
+        sum(json.loads(event)['n'] for event in events) / max(len(events), 1)))
+
+def bench_backends(args):
+    from importlib.util import find_spec
+    from piina219 import backends
+    for xfer in (0.0, args.xfer):
+        print("backends - PiINA219.read() through each backend, {0}ms per i2c transaction".format(xfer))
+        bus = piina219.SimI2CBus(1, xfer_s=xfer / 1000)
+        sim = bus.device(0x40, volts=5.0, amps=0.120, convert_s=0)
+        buses = {'pi-ina219': bus.smbus(), 'smbus': bus.smbus()}
+        if find_spec('adafruit_bus_device'):
+            buses['adafruit'] = bus.busio()
+        records = {}
+        for name in backends.BACKENDS:
+            if name not in buses:
+                print("  {0:<22} not installed".format(name))
+                continue
+            ina = piina219.PiINA219(i2c=backends.open_device(name, 0x40, 1, bus=buses[name]), logger=logging.getLogger('bench'))
+            deltas = []
+            sim.transactions = 0
+            for _ in range(args.n):
+                t0 = perf_counter_ns()
+                records[name] = ina.read()
+                deltas.append(perf_counter_ns() - t0)
+            print_summary(name, summary(deltas))
+            print("  {0:<22} i2c/sample:{1:.1f} record:{2}".format('', sim.transactions / args.n, records[name]))
+        if find_spec('adafruit_ina219'):     # adafruit_ina219's own config model and property reads, for comparison
+            from adafruit_ina219 import INA219 as AdafruitINA219
+            ina = AdafruitINA219(bus.busio(), 0x40)
+            deltas = []
+            sim.transactions = 0
+            for _ in range(args.n):
+                t0 = perf_counter_ns()
+                record = (ina.bus_voltage, ina.current / 1000, ina.power, ina.shunt_voltage * 1000)
+                deltas.append(perf_counter_ns() - t0)
+            print_summary('adafruit_ina219', summary(deltas))
+            print("  {0:<22} i2c/sample:{1:.1f} record:{2}".format('', sim.transactions / args.n, record))
+        else:
+            print("  {0:<22} not installed".format('adafruit_ina219'))
+        name, times = backends.fastest(0x40, 1, buses=buses, n=200)
+        print("  fastest: {0} ({1})".format(name, ', '.join('{0} {1:.1f}us/read'.format(key, us) for key, us in times.items())))
+
+def bench_alloc(args):
+    import gc
+    from array import array
+    from piina219.batch import encode
+    class NullClient:
+        def publish(self, topic, payload, qos=0):
+            pass
+    pauses = []
+    def on_gc(phase, info):
+        if phase == 'start':
+            pauses.append(perf_counter_ns())
+        else:
+            pauses[-1] = perf_counter_ns() - pauses[-1]
+    sim = piina219.SimINA219(0x40, volts=5.0, amps=0.120, noise_amps=0.001, xfer_s=0)
+    ina = piina219.PiINA219(i2c=sim, logger=logging.getLogger('bench'))
+    ring = piina219.RingBuffer(10000)
+    sample = piina219.Sample()
+    data = {}
+    rows = []
+    batcher = piina219.BatchPublisher(NullClient(), 'pi2nred/ina219A/bench', max_samples=1000)   # 1 sec batches at 1k samples/s
+    def rows_batch():                 # How batches were queued before, a tuple and a dict per sample until the flush
+        rows.append(('ina219A', perf_counter_ns() / 10**9, ina.getdata()))
+        if len(rows) >= 1000:
+            encode(rows)
+            rows.clear()
+    paths = [('read() + append', lambda: ring.append(perf_counter_ns() / 10**9, *ina.read()[:3])),
+             ('read_into + append3', lambda: ring.append3(ina.read_into(sample).t, sample.volts, sample.amps, sample.watts)),
+             ('getdata() new dict', lambda: ina.getdata()),
+             ('getdata(out)', lambda: ina.getdata(data)),
+             ('getdata() + row batch', rows_batch),
+             ('getdata(out) + batcher', lambda: batcher.add('ina219A', perf_counter_ns() / 10**9, ina.getdata(data)))]
+    print("alloc - gc collections and pause per read path, {0} samples each".format(args.n))
+    gc.callbacks.append(on_gc)
+    try:
+        for name, step in paths:
+            gc.collect()
+            del pauses[:]
+            before = [stats['collections'] for stats in gc.get_stats()]
+            t0 = perf_counter_ns()
+            for _ in range(args.n):
+                step()
+            elapsed = perf_counter_ns() - t0
+            collections = [stats['collections'] - n for stats, n in zip(gc.get_stats(), before)]
+            print("  {0:<24} {1:6.1f}us/sample  collections gen0/1/2: {2:>5}/{3:>4}/{4:>3}  gc pause total:{5:7.2f}ms max:{6:.3f}ms".format(
+                name, elapsed / args.n / 1000, *collections, sum(pauses) / 10**6, max(pauses, default=0) / 10**6))
+    finally:
+        gc.callbacks.remove(on_gc)
+
+def bench_suite(args):
+    results = {'xfer_ms': args.xfer, 'latency': suite_latency(args), 'rate': suite_rate(args), 'e2e': suite_e2e(args)}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("saved", args.json)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PiINA219 benchmarks on a simulated i2c bus")
+    parser.add_argument('bench', choices=['burst', 'acquire', 'multi', 'gain', 'startup', 'analysis', 'publish', 'backends', 'trigger', 'influx', 'spool', 'alloc', 'suite'])
+    parser.add_argument('-n', type=int, default=2000, help="samples per run")
+    parser.add_argument('--xfer', type=float, default=0.4, help="ms per i2c transaction")
+    parser.add_argument('--json', help="suite: save results to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    {'burst': bench_burst, 'acquire': bench_acquire, 'multi': bench_multi, 'gain': bench_gain, 'startup': bench_startup, 'analysis': bench_analysis, 'publish': bench_publish, 'backends': bench_backends, 'trigger': bench_trigger, 'influx': bench_influx, 'spool': bench_spool, 'alloc': bench_alloc, 'suite': bench_suite}[args.bench](args)
@@ -1,11 +1,11 @@
 import sys, json, logging, re
-from time import sleep, perf_counter
-import paho.mqtt.client as mqtt
+import concurrent.futures
+from time import sleep, perf_counter, time
 from os import path
 from pathlib import Path
 from logging.handlers import RotatingFileHandler
 import piina219
-from mytools import Timer
+from mytools import Timer, Scheduler
 
 class pcolor:
     ''' Add color to print statements '''
@@ -123,17 +123,40 @@ def on_connect(client, userdata, flags, rc):
         main_logger.info("Unsuccessful Connection - Code {0}".format(str(rc)))
 
 def on_message(client, userdata, msg):
-    """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect"""
+    """on message callback will receive messages from the server/broker. Must be subscribed to the topic in on_connect
+    Commands change device settings at runtime (see apply_setting)
+    nred2pi/<lvl2>ZCMD/<setting>  payload is the value, ie nred2pi/ina219AZCMD/msginterval 0.1
+    nred2pi/<lvl2>ZCMD/config     payload is {"setting": value, ..} and optionally "device" when devices share lvl2
+    They are applied on the main loop between reads and confirmed on <pubtopic>/status"""
     mqtt_logger.debug("Received: {0} with payload: {1}".format(msg.topic, str(msg.payload)))
+    lvl2, setting = msg.topic.split('/')[1][:-len('ZCMD')], msg.topic.split('/')[-1]
+    try:
+        value = json.loads(msg.payload)
+    except ValueError:
+        value = msg.payload.decode(errors='replace')
+    if setting == 'config' and isinstance(value, dict):
+        changes = dict(value)
+        only = changes.pop('device', None)
+    else:
+        changes, only = {setting: value}, None
+    devices = [device for device in deviceD if deviceD[device]['lvl2'] == lvl2 and only in (None, device)]
+    if scheduler is None:
+        main_logger.warning(f"{msg.topic} ignored, not running yet")
+        return
+    scheduler.call_soon(apply_commands, devices, changes)   # mqtt thread. Leave the boards to the main loop
 
 def on_publish(client, userdata, mid):
     """on publish will send data to client"""
     mqtt_logger.debug("Publish msg ID: " + str(mid)) 
+    metrics.inc('acked')
+    if pubqueue is not None:
+        pubqueue.acked(mid)       # One less message in flight
     pass 
 
 def on_disconnect(client, userdata,rc=0):
     main_logger.info("DisConnected result code "+str(rc))
-    mqtt_client.loop_stop()
+    if rc == 0:                 # Asked to disconnect. Otherwise keep the loop running so paho reconnects (readings are spooled meanwhile)
+        mqtt_client.loop_stop()
 
 def mqtt_setup(IPaddress):
     global MQTT_SERVER, MQTT_CLIENT_ID, MQTT_USER, MQTT_PASSWORD, MQTT_SUB_TOPIC, MQTT_PUB_LVL1, MQTT_SUB_LVL1, MQTT_REGEX
@@ -150,7 +173,7 @@ def mqtt_setup(IPaddress):
     MQTT_SUB_LVL1 = 'nred2' + MQTT_CLIENT_ID
     MQTT_PUB_LVL1 = 'pi2nred/'
 
-def setup_device(device, lvl2, publvl3, data_keys):
+def setup_device(device, lvl2, publvl3, data_keys, msginterval=1, reduce=None):
     global printcolor, deviceD, MQTT_PUB_LVL1
     if deviceD.get(device) == None:
         deviceD[device] = {}
@@ -168,7 +191,11 @@ def setup_device(device, lvl2, publvl3, data_keys):
                         main_logger.warning(f"**DUPLICATE WARNING {device} and {item} are both publishing {key} on {topic}")
                 deviceD[device]['data'][key] = 0
         deviceD[device]['pubtopic'] = MQTT_PUB_LVL1 + lvl2 + '/' + publvl3
+        deviceD[device]['publvl3'] = publvl3   # Influx tag, like the node-red flow sets location/device from the topic
         deviceD[device]['send'] = False
+        deviceD[device]['msginterval'] = msginterval # Seconds between publishes for this device
+        # Optional edge reduction, ie reduce={'deadband': {'Vbusf': 0.05, 'IbusAf': 0.005}, 'window': 10, 'heartbeat': 60}
+        deviceD[device]['reducer'] = piina219.Reducer(**reduce) if reduce is not None else None
         printcolor = not printcolor # change color of every other print statement
         if printcolor: 
             main_logger.info(f"{pcolor.LBLUE}{device} Subscribing to: {topic}{pcolor.ENDC}")
@@ -182,10 +209,182 @@ def setup_device(device, lvl2, publvl3, data_keys):
         main_logger.error(f"Device {device} already in use. Device name should be unique")
         sys.exit(f"{pcolor.RED}Device {device} already in use. Device name should be unique{pcolor.ENDC}")
 
+# Aggregate timers. Each call is recorded in a histogram (no formatting or logging per call).
+# log_schedule logs count/p50/p95/p99/max each minute and starts a new interval
+getdata_timer = Timer(name='getdata', logger=None, aggregate=True)
+publish_timer = Timer(name='publish', logger=None, aggregate=True)
+# Counters/gauges per device and topic. Published on <pubtopic>/stats and optionally written for prometheus (publish_metrics)
+metrics = piina219.Metrics()
+pubqueue = None   # AsyncPublisher when the publish queue is on
+influx_sink = None  # InfluxSink when readings are written straight to influx
+readings_mqtt = True
+scheduler = None  # Main loop, set once the devices are running. mqtt commands are handed to it
+
+def publish(device):
+    ''' Publish the device data now, or queue it in the topic's batch when batching is on.
+    A device with a reducer only publishes what passes its deadband/window/heartbeat '''
+    with publish_timer:
+        _publish(device)
+
+def _publish(device):
+    data = deviceD[device]['data']
+    t = time()
+    if deviceD[device]['reducer'] is not None:
+        data = deviceD[device]['reducer'].add(t, data)
+        if data is None:
+            return
+    if influx_sink is not None:
+        influx_sink.add(deviceD[device]['series'], t, data)
+        if not readings_mqtt:
+            return
+    batcher = batchSet.get(deviceD[device]['pubtopic'])
+    if batcher is not None:
+        batcher.add(device, t, data)
+        metrics.inc('batched', device=device, topic=batcher.topic)
+    else:
+        payload = json.dumps(data)
+        mqtt_pub.publish(deviceD[device]['pubtopic'], payload)  # publish voltage values
+        metrics.inc('published', device=device, topic=deviceD[device]['pubtopic'])
+        metrics.inc('published_bytes', len(payload), device=device, topic=deviceD[device]['pubtopic'])
+
+def flush_batches():
+    for batcher in batchSet.values():
+        batcher.poll()
+
+def read_publish(device, ina219, sampler=None):
+    ''' Scheduled job - read (or get window stats from the sampler) and publish one device '''
+    if sampler is not None:
+        deviceD[device]['data'] = sampler.flatstats(seconds=deviceD[device]['msginterval'])
+    else:
+        with getdata_timer:
+            ina219.getdata(deviceD[device]['data'])   # Filled in place, no dict per reading
+    if device in integratorSet:
+        deviceD[device]['data'].update(integratorSet[device].totals())   # Running Ah/Wh totals
+    publish(device)
+
+def publish_events():
+    ''' Scheduled job - publish triggered transient captures, one message per event on <pubtopic>/event '''
+    for device, trigger in triggerSet.items():
+        for payload in trigger.poll():
+            mqtt_pub.publish(deviceD[device]['pubtopic'] + '/event', payload)
+            metrics.inc('event_bytes', len(payload), device=device)
+
+def save_energy():
+    for integrator in integratorSet.values():
+        integrator.save()
+
+def read_publish_all(reader):
+    ''' Scheduled job - read every device in one cycle (buses in parallel) and publish each '''
+    snap = reader.read()
+    for device, reading in snap.readings.items():
+        if reading is not None:
+            reader.ina219Set[device].fill(reading.volts, reading.amps, reading.watts, out=deviceD[device]['data'])
+            publish(device)
+
+def replay_publish(replay, devices, scheduler):
+    ''' Scheduled job - publish the captured samples that are due, through the same path as live readings '''
+    for address, t, volts, amps, watts, mVshunt in replay.due():
+        if address in devices:
+            device, ina219 = devices[address]
+            ina219.fill(volts, amps, watts, mVshunt, deviceD[device]['data'])
+            publish(device)
+    if replay.done():
+        main_logger.info(f"Replay finished, {replay.sent} samples")
+        scheduler.stop()
+
+def log_schedule(scheduler):
+    for name, stats in scheduler.stats().items():
+        main_logger.info(f"{name} runs:{stats['runs']} late mean:{stats['late_mean_ms']:.2f}ms max:{stats['late_max_ms']:.2f}ms "
+                         f"overruns:{stats['overruns']} skipped:{stats['skipped']}")
+    for name, stats in Timer.snapshot(reset=True).items():
+        if stats['count']:
+            main_logger.info(f"{name} n:{stats['count']} p50:{stats['p50']:.2f}ms p95:{stats['p95']:.2f}ms "
+                             f"p99:{stats['p99']:.2f}ms max:{stats['max']:.2f}ms")
+        for stat in ('p50', 'p95', 'p99', 'max'):     # Last full minute, for the stats topic/prometheus
+            metrics.set(f"latency_{stat}_ms", stats[stat] if stats['count'] else 0.0, timer=name)
+
+def publish_metrics(promfile=None):
+    ''' Scheduled job - one stats message per device on <pubtopic>/stats, the rest on pi2nred/<client id>/stats '''
+    for group, stats in metrics.grouped().items():
+        topic = deviceD[group]['pubtopic'] + '/stats' if group in deviceD else f"{MQTT_PUB_LVL1}{MQTT_CLIENT_ID}/stats"
+        mqtt_client.publish(topic, json.dumps(stats))   # Not spooled. Stale stats are not worth resending
+    if promfile is not None:
+        metrics.write(promfile)
+
+def apply_commands(devices, changes):
+    ''' Apply command settings on the main loop (between reads) and report what took effect on <pubtopic>/status '''
+    for device in devices:
+        status = {'device': device}
+        for setting, value in changes.items():
+            try:
+                status[setting] = apply_setting(device, setting, value)
+            except (ValueError, TypeError, RuntimeError, TimeoutError, concurrent.futures.TimeoutError, OSError) as e:
+                status.setdefault('errors', {})[setting] = str(e) or type(e).__name__   # OSError = i2c, futures timeout < py3.11
+        status['ok'] = 'errors' not in status
+        main_logger.info(f"{device} command {changes}: {status}")
+        metrics.inc('commands' if status['ok'] else 'command_errors', device=device)
+        mqtt_client.publish(deviceD[device]['pubtopic'] + '/status', json.dumps(status))
+
+def apply_setting(device, setting, value):
+    ''' One setting for one device. Returns the value now in effect. ValueError if it can't be applied
+    msginterval  seconds between reads/publishes (highrate: publish window)
+    bus_adc      INA219.ADC_* code (0-3 9-12bit, 8-15 1-128 sample average). shunt_adc the same
+    batch        samples per batch message (batching on)
+    deadband     {"IbusAf": 0.005, ..} merged into the reducer's deadband, null removes a key. Adds a reducer if none '''
+    if setting == 'msginterval':
+        value = float(value)
+        if not 0.001 <= value <= 3600:
+            raise ValueError('msginterval must be 0.001-3600 sec')
+        deviceD[device]['msginterval'] = value
+        if device in jobSet:
+            scheduler.reschedule(jobSet[device], value)
+        elif 'multiread' in jobSet:       # One cycle for every device, at the fastest interval asked for
+            scheduler.reschedule(jobSet['multiread'], min(deviceD[d]['msginterval'] for d in ina219Set))
+        else:
+            raise ValueError('no read job to change (replay)')
+        return value
+    if setting in ('bus_adc', 'shunt_adc'):
+        code = int(value)
+        board_call(device, 'set_adc', *((code, None) if setting == 'bus_adc' else (None, code)))
+        return code
+    if setting == 'batch':
+        batcher = batchSet.get(deviceD[device]['pubtopic'])
+        if batcher is None:
+            raise ValueError('batching is off')
+        from piina219.batch import MAX_ROWS
+        if not 1 <= int(value) <= MAX_ROWS:
+            raise ValueError(f"batch must be 1 to {MAX_ROWS} samples")
+        batcher.max_samples = int(value)
+        return batcher.max_samples
+    if setting == 'deadband':
+        if not isinstance(value, dict):
+            raise ValueError('deadband must be {key: amount}')
+        if deviceD[device]['reducer'] is None:
+            deviceD[device]['reducer'] = piina219.Reducer()
+        deadband = deviceD[device]['reducer'].deadband
+        for key, amount in value.items():
+            if amount is None:
+                deadband.pop(key, None)
+            else:
+                deadband[key] = float(amount)
+        return deadband
+    raise ValueError(f"unknown setting {setting}")
+
+def board_call(device, method, *args):
+    ''' Call a PiINA219 method between two reads of the board, in whichever thread/process reads it '''
+    if busworkers is not None:
+        busworkers.call(device, method, *args)
+    elif device in samplerSet:
+        samplerSet[device].call(getattr(ina219Set[device], method), *args).result(1)
+    else:
+        getattr(ina219Set[device], method)(*args)
+
 def main():
     global deviceD, printcolor      # Containers setup in 'create' functions and used for Publishing mqtt
     global MQTT_SERVER, MQTT_USER, MQTT_PASSWORD, MQTT_CLIENT_ID, mqtt_client, MQTT_PUB_LVL1
-    global _loggers, main_logger, mqtt_logger
+    global _loggers, main_logger, mqtt_logger, batchSet, mqtt_pub, integratorSet, pubqueue, influx_sink, readings_mqtt
+    global triggerSet
+    global scheduler, jobSet, samplerSet, busworkers, ina219Set
 
     main_logger_level= logging.DEBUG # CRITICAL=logging off. DEBUG=get variables. INFO=status messages.
     main_logger_type = 'custom'       # 'basic' or 'custom' (with option for log files)
@@ -216,6 +415,7 @@ def main():
     #==== HARDWARE/MQTT SETUP ===============#
     # AUTO GAIN, HIGH RESOLUTION - Lower precision above max amps specified
     # MANUAL GAIN, HIGH RESOLUTION - Max amps is 400mA
+    # HYSTERETIC GAIN (gainmode="hysteretic") - PGA stepped up ahead of the load and back down when it stays low, no lost samples
     # Pass gain (auto or manual), max current (400mA for high resolution), and address
     #Board 0: Address = 0x40 Offset = binary 00000 (no jumpers required)
     #Board 1: Address = 0x41 Offset = binary 00001 (bridge A0)
@@ -224,27 +424,147 @@ def main():
     #Returns a dictionary with Vbusf, IbusAi, PowerWf
     #Readings take 4-6ms
 
+    # SIMULATE - no hardware needed. Each board is a register level SimINA219 (piina219/simbus.py) with some noise
+    simulate = False
+    # REPLAY - publish a capture file (see CAPTURE below) instead of reading the boards, at speed x the captured rate.
+    # Boards are simulated. Samples go to the device set up with the same address. ie {'file': 'capture.cap', 'speed': 1}
+    replay = None
+    simulate = simulate or replay is not None
+    # FAST START - calibration/config cached per address and maxA. A restart that finds the board still configured
+    # checks it with one register read and skips configure. None = configure every start
+    cache = None if simulate else path.join(path.dirname(path.abspath(__file__)), 'ina219-cache.json')
+    # BACKEND - how the registers are read: 'pi-ina219' (Adafruit_GPIO like pi-ina219), 'smbus' (smbus2), 'adafruit' (Blinka)
+    # or 'fastest' (each installed one timed on the board at start). Readings are the same either way
+    backend = 'pi-ina219'
     ina219Set = {}
     ina219_logger = setup_logging(path.dirname(path.abspath(__file__)), 'custom', 'ina219lgr', log_level=logging.DEBUG, mode=1)
-    device = "ina219A"  
-    lvl2 = "ina219A"
-    publvl3 = MQTT_CLIENT_ID + "Test1" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
-    data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
-    setup_device(device, lvl2, publvl3, data_keys)
-    ina219Set[device] = piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger)
-
-    device = "ina219B"
-    lvl2 = "ina219B"
-    publvl3 = MQTT_CLIENT_ID + "Test2" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
-    data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
-    setup_device(device, lvl2, publvl3, data_keys)
-    ina219Set[device] = piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x41, logger=ina219_logger)
+    # DISCOVERY - find the INA219s on these buses by their register signature (0x40-0x4F, buses probed in parallel)
+    # and set each one up with the settings below instead of the boards hard coded under else. Named ina219A (0x40),
+    # ina219B (0x41).. with _bus<n> added off bus 1. Every start probes all addresses (new boards are found); the cache
+    # file only records what each bus had, so boards added or gone are logged
+    discover = None   # ie {'buses': [1, 3], 'maxA': 0.4, 'gainmode': 'auto'}
+    if discover is not None:
+        i2c = None
+        if simulate:
+            i2c = {busnum: piina219.SimI2CBus(busnum) for busnum in discover['buses']}
+            for busnum, bus in i2c.items():
+                bus.device(0x40, volts=5.0, amps=0.12, noise_amps=0.002)
+                bus.device(0x41, volts=3.3, amps=0.05, noise_amps=0.001)
+        found = piina219.discover(discover['buses'], i2c=i2c, logger=ina219_logger,
+                                  cache=None if simulate else path.join(path.dirname(path.abspath(__file__)), 'ina219-discover.json'))
+        data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
+        for busnum, address in found:
+            device = piina219.device_name(busnum, address)
+            setup_device(device, device, MQTT_CLIENT_ID + "Test1", data_keys)
+            ina219Set[device] = piina219.PiINA219(*data_keys, gainmode=discover.get('gainmode', 'auto'), maxA=discover.get('maxA', 0.4),
+                                                  address=address, busnum=busnum, logger=ina219_logger, cache=cache, backend=backend,
+                                                  i2c=i2c[busnum].devices[address] if simulate else None)
+    else:
+        device = "ina219A"  
+        lvl2 = "ina219A"
+        publvl3 = MQTT_CLIENT_ID + "Test1" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
+        data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
+        setup_device(device, lvl2, publvl3, data_keys)
+        ina219Set[device] = piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x40, logger=ina219_logger, cache=cache, backend=backend,
+                                              i2c=piina219.SimINA219(0x40, volts=5.0, amps=0.12, noise_amps=0.002) if simulate else None)
+
+        device = "ina219B"
+        lvl2 = "ina219B"
+        publvl3 = MQTT_CLIENT_ID + "Test2" # Will be a tag in influxdb. Optional to modify it and describe experiment being ran
+        data_keys = ['Vbusf', 'IbusAf', 'PowerWf']
+        # Reduction example - read 10x a second, publish 10 sec min/max/mean windows only when the load changes (heartbeat each minute)
+        #setup_device(device, lvl2, publvl3, data_keys, msginterval=0.1, reduce={'deadband': {'Vbusf': 0.05, 'IbusAf': 0.005, 'PowerWf': 0.02}, 'window': 10, 'heartbeat': 60})
+        setup_device(device, lvl2, publvl3, data_keys)
+        ina219Set[device] = piina219.PiINA219(*data_keys, gainmode="auto", maxA=0.4, address=0x41, logger=ina219_logger, cache=cache, backend=backend,
+                                              i2c=piina219.SimINA219(0x41, volts=3.3, amps=0.05, noise_amps=0.001) if simulate else None)
     
+    # HIGH RATE SAMPLING - each board read in its own thread as fast as its ADC allows (12bit = ~1ms).
+    # Publishes window stats (mean/min/max/rms over all samples since the last publish) instead of one snapshot
+    highrate = False
+    # CAPTURE - every read (full rate with highrate) is also recorded as raw registers to a binary file for replay/analysis
+    # Not with workers (below), the worker processes can't share the file
+    capture = None   # ie path.join(path.dirname(path.abspath(__file__)), 'capture.cap')
+    captureSet = {}
+    workers = False   # BUS WORKERS, see below
+    if capture is not None and workers:
+        main_logger.warning("capture is not supported with bus workers, not capturing")
+    elif capture is not None and replay is None:
+        captureSet['capture'] = piina219.Capture(capture, logger=ina219_logger)
+        for ina219 in ina219Set.values():
+            ina219.capture = captureSet['capture']
+    # MULTI READ - read all devices together once per cycle. Boards on different i2c buses (busnum=) are read in parallel
+    multiread = False
+    # BATCHING - pack many samples into one mqtt message (node-red 'parse MQTT JSON str' decodes both encodings)
+    # Set with a short msginterval, ie 0.01 sec = 100 samples per 1 sec message. None = one json message per reading
+    batch = None   # ie {'encoding': 'struct', 'max_samples': 100, 'max_ms': 1000}  encoding 'struct' or 'json'
+    # SPOOL - readings taken while the broker is unreachable are kept on disk (bounded) and resent after reconnect
+    spool = True
+    spooldir = path.join(path.dirname(path.abspath(__file__)), 'spool')
+    # PUBLISH QUEUE - publishes go into a bounded queue and an asyncio sender passes them on with at most max_inflight
+    # waiting on paho (QoS 1/2 acks), so a slow broker can't stall the loop or grow memory. When the queue is full the
+    # policy drops the oldest, coalesces (newest value replaces the one queued for the same topic) or blocks the
+    # publishing job up to block_timeout sec (never the samplers). Depth and drops are on the stats topic as pubq_*
+    publish_queue = None   # ie {'maxsize': 1000, 'policy': 'coalesce', 'max_inflight': 20}
+    # INFLUX - write readings straight to influxdb as line protocol, gzip batches over http (max_points or max_ms),
+    # retried with backoff while influx is down and spooled to disk past max_batches (with spool on).
+    # Tags location/device/publvl3 as the node-red flow sets them. Disconnect node-red's influxdb out when this is on.
+    # readings_mqtt = False stops publishing readings on mqtt (stats/status still go), ie no gauges needed
+    influx = None   # ie {'url': 'http://127.0.0.1:8086', 'db': 'ina219'}  influx 2.x: 'bucket', 'org', 'token'
+    readings_mqtt = True
+    # ENERGY - integrate Ah/Wh at the full sample rate (needs highrate). Totals are added to each publish
+    # and saved in energy-<device>.json so they carry on after a restart
+    energy = False
+    # METRICS - counters/gauges (reads, overflows, publishes, queue depth, loop overruns, latency) every metrics_interval sec
+    # on the mqtt stats topics. promfile also writes them in prometheus format (ie node_exporter textfile collector dir)
+    metrics_interval = 10
+    promfile = None   # ie '/var/lib/node_exporter/textfile_collector/ina219.prom'
+    # ADC TUNING - pick bus_adc/shunt_adc per device for a sample rate and current noise floor (amps RMS), re-tuned
+    # as the load noise changes (needs highrate). ie {'ina219A': {'rate': 100, 'noise': 0.0005}, 'ina219B': {'rate': 2}}
+    tune = {}
+    # TRIGGER - oscilloscope mode (needs highrate). Every sample goes through a trigger on one field; when it trips, pre sec
+    # before and post sec after are published as one message on <pubtopic>/event. Re-arms holdoff sec after the event.
+    # mode rising/falling (edge, re-armed past hysteresis) or above/below (level).
+    # ie {'ina219A': {'field': 'IbusAf', 'mode': 'rising', 'level': 0.3, 'hysteresis': 0.02, 'pre': 0.01, 'post': 0.05, 'holdoff': 1}}
+    trigger = {}
+    # BUS WORKERS - like highrate, but each i2c bus (busnum=) is sampled by its own process into shared memory rings.
+    # Reads are not held up by this process (GIL, logging, mqtt). Workers that die or hang are restarted.
+    # Boards must not be read here once the workers start. energy/tune/capture need highrate instead. Set workers above
+    samplerSet = {}
+    integratorSet = {}
+    tunerSet = {}
+    triggerSet = {}
+    busworkers = None
+    if workers and replay is None:
+        busworkers = piina219.BusWorkers(ina219Set, size=20000, logger=ina219_logger)
+        busworkers.start()
+        samplerSet = busworkers.rings     # Rings have the same flatstats as a Sampler
+    elif highrate and replay is None:
+        for device, ina219 in ina219Set.items():
+            onsample = []
+            if energy:
+                integratorSet[device] = piina219.Integrator(path.join(path.dirname(path.abspath(__file__)), f"energy-{device}.json"),
+                                                            logger=ina219_logger)
+                onsample.append(integratorSet[device].add)
+            if device in tune:
+                tunerSet[device] = piina219.AdcTuner(ina219, logger=ina219_logger, **tune[device])
+                onsample.append(tunerSet[device].add)
+            if device in trigger:
+                triggerSet[device] = piina219.Trigger(fields=(ina219.voltkey, ina219.currentkey, ina219.powerkey),
+                                                      logger=ina219_logger, **trigger[device])
+                onsample.append(triggerSet[device].add)
+            if len(onsample) > 1:
+                onsample = lambda t, volts, amps, watts, calls=tuple(onsample): [call(t, volts, amps, watts) for call in calls]
+            else:
+                onsample = onsample[0] if onsample else None
+            samplerSet[device] = piina219.Sampler(ina219, size=20000, logger=ina219_logger, onsample=onsample)
+            samplerSet[device].start()    # Sampling starts now. The first publish after connecting has the samples taken meanwhile
+
     print("\n")
     for logger in _loggers:
         main_logger.info('{0} is set at level: {1}'.format(logger, logger.getEffectiveLevel()))
 
     #==== START/BIND MQTT FUNCTIONS ====#
+    import paho.mqtt.client as mqtt           # Imported here so the boards are set up (and sampling) before paying for paho
     # Create a couple flags to handle a failed attempt at connecting. If user/password is wrong we want to stop the loop.
     mqtt.Client.connected = False             # Flag for initial connection (different than mqtt.Client.is_connected)
     mqtt.Client.failed_connection = False     # Flag for failed initial connection
@@ -266,22 +586,122 @@ def main():
         mqtt_client.loop_stop()
         sys.exit(f"{pcolor.RED}Connection failed. Use rc code to trouble shoot{pcolor.ENDC}")
     
+    mqtt_pub = mqtt_client    # Everything publishes through mqtt_pub
+    if spool:
+        spooler = mqtt_pub = piina219.SpoolPublisher(mqtt_client, piina219.Spool(spooldir, max_bytes=50*10**6), drain_rate=500, logger=mqtt_logger)
+    if publish_queue is not None:
+        pubqueue = mqtt_pub = piina219.AsyncPublisher(mqtt_pub, logger=mqtt_logger, **publish_queue)
+    if influx is not None:
+        influx_sink = piina219.InfluxSink(spool=piina219.Spool(spooldir + '-influx', max_bytes=50*10**6) if spool else None,
+                                          logger=mqtt_logger, **influx)
+        for device in ina219Set:
+            deviceD[device]['series'] = influx_sink.series({'location': MQTT_PUB_LVL1.strip('/'), 'device': deviceD[device]['lvl2'],
+                                                            'publvl3': deviceD[device]['publvl3']})
+    batchSet = {}   # One batcher per publish topic
+    if batch is not None:
+        for device in ina219Set:
+            topic = deviceD[device]['pubtopic']
+            if topic not in batchSet:
+                batchSet[topic] = piina219.BatchPublisher(mqtt_pub, topic, logger=mqtt_logger, **batch)
+
+    # Metric sources are only read when the stats are published, nothing is added to the read path
+    for device, ina219 in ina219Set.items():
+        if busworkers is not None:
+            metrics.source(lambda d=device: dict(busworkers.acqstats(d), sampler_samples=busworkers.rings[d].count),
+                           counters=True, device=device)
+            continue
+        metrics.source(ina219.acqstats, counters=True, device=device)
+        if device in samplerSet:
+            metrics.source(lambda s=samplerSet[device]: {'sampler_samples': s.ring.count, 'sampler_errors': s.errors,
+                                                         'sampler_onsample_errors': s.onsample_errors}, counters=True, device=device)
+        if device in tunerSet:
+            metrics.source(lambda d=tunerSet[device]: {'adc_retunes': d.retunes, 'bus_adc': d.ina219.bus_adc, 'shunt_adc': d.ina219.shunt_adc,
+                                                       'noise_raw_amps': d.raw_amps}, counters=('adc_retunes',), device=device)
+        if device in triggerSet:
+            metrics.source(triggerSet[device].stats, counters=True, device=device)
+        if deviceD[device]['reducer'] is not None:
+            metrics.source(lambda r=deviceD[device]['reducer']: {'reduce_in': r.samples, 'reduce_out': r.messages}, counters=True, device=device)
+    if busworkers is not None:
+        for busnum in busworkers.buses:
+            metrics.source(lambda b=busnum: busworkers.stats(b), counters=('worker_cycles', 'worker_errors'), bus=busnum)
+        metrics.source(lambda: {'worker_restarts': busworkers.restarts}, counters=True)
+    for topic, batcher in batchSet.items():
+        metrics.source(lambda b=batcher: {'batch_messages': b.messages, 'batch_samples': b.samples, 'batch_bytes': b.bytes,
+                                          'batch_pending': b.pending}, counters=('batch_messages', 'batch_samples', 'batch_bytes'), topic=topic)
+    metrics.source(lambda: {'queue_depth': len(getattr(mqtt_client, '_out_messages', ())), 'connected': int(mqtt_client.is_connected())})
+    if spool:
+        metrics.source(lambda: {'spooled': spooler.spooled, 'drained': spooler.drained, 'spool_dropped': spooler.spool.dropped},
+                       counters=True)
+        metrics.source(lambda: {'spool_bytes': spooler.spool.size()})
+    if influx_sink is not None:
+        metrics.source(lambda: {'influx_' + name: value for name, value in influx_sink.stats().items()},
+                       counters=('influx_points', 'influx_written', 'influx_batches', 'influx_bytes', 'influx_raw_bytes',
+                                 'influx_failures', 'influx_rejected', 'influx_dropped', 'influx_spooled'))
+    if pubqueue is not None:
+        metrics.source(lambda: {'pubq_' + name: value for name, value in pubqueue.stats().items()},
+                       counters=('pubq_queued', 'pubq_sent', 'pubq_dropped', 'pubq_coalesced', 'pubq_blocked', 'pubq_ack_timeouts'))
+
     #==== MAIN LOOP ====================#
-    # MQTT setup is successful. Initialize dictionaries and start the main loop.   
-    t0_sec = perf_counter() # sec Counter for getting stepper data. Future feature - update interval in  node-red dashboard to link to perf_counter
-    msginterval = 1       # Adjust interval to increase/decrease number of mqtt updates.
+    # MQTT setup is successful. Schedule each device on its own interval and start the main loop.
+    # Scheduler sleeps until the next deadline (no busy wait) and deadlines are absolute so the period does not drift.
+    # Adjust msginterval in setup_device to increase/decrease number of mqtt updates per device.
     #t = Timer()
     # can use t.start() and t.stop() for quick timing numbers.  ina219 read is taking >3ms
+    # getdata and publish are timed by getdata_timer/publish_timer (aggregate) and logged every minute
+    jobSet = {}     # Read job per device (or 'multiread'), so msginterval commands can reschedule them
+    scheduler = Scheduler()
+    if replay is not None:
+        replayer = piina219.Replay(replay['file'], speed=replay.get('speed', 1), loop=replay.get('loop', False))
+        main_logger.info(f"Replaying {replay['file']}: {len(replayer.capture)} samples at {replayer.speed}x")
+        devices = {ina219.address: (device, ina219) for device, ina219 in ina219Set.items()}
+        scheduler.every(0.01, replay_publish, replayer, devices, scheduler, name='replay')
+    elif multiread and not highrate:
+        reader = piina219.MultiReader(ina219Set, logger=ina219_logger)
+        jobSet['multiread'] = scheduler.every(min(deviceD[device]['msginterval'] for device in ina219Set), read_publish_all, reader, name='multiread')
+    else:
+        for device, ina219 in ina219Set.items():
+            jobSet[device] = scheduler.every(deviceD[device]['msginterval'], read_publish, device, ina219, samplerSet.get(device), name=device)
+    scheduler.every(60, log_schedule, scheduler, name='log_schedule')  # jitter/overrun stats
+    if batchSet:
+        scheduler.every(0.1, flush_batches, name='flush_batches')      # send batches that reached max_ms
+    if influx_sink is not None:
+        scheduler.every(0.1, influx_sink.poll, name='influx')          # hand influx batches that reached max_ms to the writer
+    if integratorSet:
+        scheduler.every(60, save_energy, name='save_energy')
+    if triggerSet:
+        scheduler.every(0.1, publish_events, name='events')             # triggered captures, one message each
+    if spool:
+        scheduler.every(0.1, spooler.drain, name='drain_spool')        # resend spooled readings at drain_rate after reconnect
+    scheduler.every(metrics_interval, publish_metrics, promfile, name='metrics')
+    if busworkers is not None:
+        scheduler.every(1, busworkers.supervise, name='supervise')       # restart dead/hung bus workers
+    for cap in captureSet.values():
+        scheduler.every(1, cap.flush, name='capture_flush')              # header count + msync, survives power loss
+    for job in scheduler.jobs:                                          # Loop runs/overruns/lateness per job
+        metrics.source(job.stats, counters=('runs', 'overruns', 'skipped'), job=job.name)
     try:
-        while True:
-            if (perf_counter() - t0_sec) > msginterval: # Get data on a time interval
-                for device, ina219 in ina219Set.items():
-                    deviceD[device]['data'] = ina219.getdata()
-                    mqtt_client.publish(deviceD[device]['pubtopic'], json.dumps(deviceD[device]['data']))  # publish voltage values
-                t0_sec = perf_counter()
+        scheduler.run()
     except KeyboardInterrupt:
         main_logger.info("Pressed ctrl-C")
     finally:
+        if busworkers is not None:
+            busworkers.close()
+        else:
+            for sampler in samplerSet.values():
+                sampler.stop()
+        save_energy()
+        for batcher in batchSet.values():
+            batcher.flush()
+        if pubqueue is not None:
+            pubqueue.close()
+        if influx_sink is not None:
+            influx_sink.close()
+            if influx_sink.spool is not None:
+                influx_sink.spool.close()
+        if spool:
+            spooler.spool.close()
+        for cap in captureSet.values():
+            cap.close()
         main_logger.info("Exiting")
 
 if __name__ == "__main__":
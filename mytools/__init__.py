@@ -1 +1,2 @@
-from .timer import *
\ No newline at end of file
+from .timer import *
+from .scheduler import Job, Scheduler
\ No newline at end of file
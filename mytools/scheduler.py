@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+@dataclass
+class Job:
+    """Function called every interval seconds on absolute deadlines"""
+
+    interval: float
+    func: Callable[..., Any]
+    args: Tuple[Any, ...] = ()
+    name: Optional[str] = None
+    deadline: float = 0.0
+    runs: int = 0
+    late_sum: float = 0.0     # Sum of (start - deadline), jitter
+    late_max: float = 0.0
+    runtime_max: float = 0.0
+    overruns: int = 0         # Times the job started a full interval or more late
+    skipped: int = 0          # Deadlines dropped to get back on schedule
+
+    def stats(self) -> Dict[str, Any]:
+        """Jitter/overrun summary in ms"""
+        return {"runs": self.runs, "interval_ms": self.interval * 1000,
+                "late_mean_ms": self.late_sum / self.runs * 1000 if self.runs else 0.0,
+                "late_max_ms": self.late_max * 1000, "runtime_max_ms": self.runtime_max * 1000,
+                "overruns": self.overruns, "skipped": self.skipped}
+
+class Scheduler:
+    """Runs jobs on absolute deadlines from a monotonic clock and sleeps in between (no busy wait).
+    Each deadline is the last deadline + interval so read/publish time does not make the period drift.
+    A job that falls a whole interval behind skips the missed deadlines instead of running back to back"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.jobs: List[Job] = []
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._calls: Deque[Tuple[Callable[..., Any], Tuple[Any, ...]]] = deque()
+
+    def every(self, interval: float, func: Callable[..., Any], *args: Any, name: Optional[str] = None) -> Job:
+        """Add a job. First run is one interval from now"""
+        job = Job(interval, func, args, name or getattr(func, "__name__", None), self.clock() + interval)
+        self.jobs.append(job)
+        return job
+
+    def cancel(self, job: Job) -> None:
+        self.jobs.remove(job)
+
+    def reschedule(self, job: Job, interval: float) -> None:
+        """Change a job's interval. Next deadline counts from now"""
+        job.interval = interval
+        job.deadline = self.clock() + interval
+
+    def call_soon(self, func: Callable[..., Any], *args: Any) -> None:
+        """Run func once on the scheduler's thread, between jobs, as soon as the current job is done.
+        Safe to call from other threads (ie an mqtt callback)"""
+        self._calls.append((func, args))
+        self._wake.set()
+
+    def run_pending(self) -> float:
+        """Run every job that is due. Returns seconds until the next deadline"""
+        for job in sorted(self.jobs, key=lambda j: j.deadline):
+            now = self.clock()
+            if job.deadline > now:
+                break
+            late = now - job.deadline
+            job.func(*job.args)
+            job.runtime_max = max(job.runtime_max, self.clock() - now)
+            job.runs += 1
+            job.late_sum += late
+            job.late_max = max(job.late_max, late)
+            job.deadline += job.interval
+            if late >= job.interval:
+                missed = int(late // job.interval)
+                job.overruns += 1
+                job.skipped += missed
+                job.deadline += missed * job.interval
+        if not self.jobs:
+            return 1.0
+        return max(0.0, min(j.deadline for j in self.jobs) - self.clock())
+
+    def run(self) -> None:
+        """Run jobs until stop() is called (from a job or another thread)"""
+        self._stop_event.clear()
+        while not self._stop_event.is_set():
+            while self._calls:
+                func, args = self._calls.popleft()
+                func(*args)
+            wait = self.run_pending()
+            if wait > 0 and not self._calls:
+                self._wake.wait(wait)
+                self._wake.clear()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {job.name: job.stats() for job in self.jobs}
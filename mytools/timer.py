@@ -1,8 +1,8 @@
 from time import perf_counter_ns
 from contextlib import ContextDecorator
 from dataclasses import dataclass, field
-import time
-from typing import Any, Callable, ClassVar, Dict, Optional
+import time, threading
+from typing import Any, Callable, ClassVar, Dict, List, Optional
 
 def test():
     print("test")
@@ -10,48 +10,148 @@ def test():
 class TimerError(Exception):
     """Exception for Timer Class errors"""
 
+SUB_BITS = 4                # 16 buckets per power of 2, each bucket is within 1/16 (6%) of its value
+SUB = 1 << SUB_BITS
+NBUCKETS = SUB * 38         # Up to 2**38 ns (~4.5 min). Longer times land in the last bucket
+
+@dataclass
+class Histogram:
+    """Fixed memory log bucketed histogram of ns durations. Thread safe"""
+
+    count: int = 0
+    total: int = 0
+    min: Optional[int] = None
+    max: Optional[int] = None
+    buckets: List[int] = field(default_factory=lambda: [0] * NBUCKETS, repr=False)
+    _lock: Any = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @staticmethod
+    def bucket(ns: int) -> int:
+        """Bucket index for ns. Exact below SUB, then SUB buckets per power of 2"""
+        if ns < SUB:
+            return max(ns, 0)
+        shift = ns.bit_length() - SUB_BITS - 1
+        return min((shift + 1) * SUB + ((ns >> shift) & (SUB - 1)), NBUCKETS - 1)
+
+    @staticmethod
+    def bucket_mid(index: int) -> float:
+        """Middle of the ns range covered by a bucket"""
+        if index < SUB:
+            return float(index)
+        shift = index // SUB - 1
+        return ((SUB + index % SUB) << shift) + ((1 << shift) - 1) / 2
+
+    def record(self, ns: int) -> None:
+        """Add one duration. No allocation or formatting, safe to call from any thread"""
+        index = self.bucket(ns)
+        with self._lock:
+            self.count += 1
+            self.total += ns
+            self.buckets[index] += 1
+            if self.min is None or ns < self.min:
+                self.min = ns
+            if self.max is None or ns > self.max:
+                self.max = ns
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Approximate percentile in ns, clamped to the recorded min/max"""
+        with self._lock:
+            count, buckets = self.count, list(self.buckets)
+        if not count:
+            return None
+        rank = pct / 100 * count
+        seen = 0
+        for index, n in enumerate(buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(max(self.bucket_mid(index), self.min), self.max)
+        return float(self.max)
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Optional[float]]:
+        """count, min, max, mean, p50, p95, p99 (ns). reset=True starts a new interval in the same lock"""
+        with self._lock:
+            copy = Histogram(self.count, self.total, self.min, self.max, list(self.buckets))
+            if reset:
+                self.count, self.total, self.min, self.max = 0, 0, None, None
+                self.buckets = [0] * NBUCKETS
+        return {'count': copy.count, 'min': copy.min, 'max': copy.max,
+                'mean': copy.total / copy.count if copy.count else None,
+                'p50': copy.percentile(50), 'p95': copy.percentile(95), 'p99': copy.percentile(99)}
+
+    def reset(self) -> None:
+        self.snapshot(reset=True)
+
 @dataclass
 class Timer(ContextDecorator):
     """Can use as class, decorator, context manager"""
 
     timers: ClassVar[Dict[str, float]] = dict()
+    histograms: ClassVar[Dict[str, Histogram]] = dict()
+    _timers_lock: ClassVar[Any] = threading.Lock()   # Running totals, shared by every thread using a Timer
     name: Optional[str] = None
     text: str = "{} time: {:.3f} {}"
     logger: Optional[Callable[[str], None]] = print
     units: Optional[str] = "ms"
-    _start_time: Optional[float] = field(default=None, init=False, repr=False)
+    aggregate: bool = False     # Record into histograms[name] instead of logging every stop
+    _local: Any = field(default_factory=threading.local, init=False, repr=False)
 
     def __post_init__(self) -> None:
         """Initialization: update timers dict with new timer"""
+        if self.aggregate and not self.name:
+            raise TimerError(f"aggregate needs a timer name")
         if self.name:
             self.timers.setdefault(self.name, 0)
+        if self.aggregate:
+            self._histogram = self.histograms.setdefault(self.name, Histogram())
 
     def start(self) -> None:
-        """Start a new timer"""
-        if self._start_time is not None:
+        """Start a new timer. The start time is per thread so one decorator can time calls from many threads"""
+        if getattr(self._local, 'start', None) is not None:
             raise TimerError(f"Timer is already running. Use .stop() to stop it")
 
-        self._start_time = time.perf_counter_ns()
+        self._local.start = time.perf_counter_ns()
 
     def stop(self) -> float:
         """Stop the timer and report delta time"""
-        if self._start_time is None:
+        start = getattr(self._local, 'start', None)
+        if start is None:
             raise TimerError(f"There is no timer running. Use .start() to start a timer")
 
         # Calculate delta time
-        Delta_time = time.perf_counter_ns() - self._start_time
-        self._start_time = None
+        Delta_time = time.perf_counter_ns() - start
+        self._local.start = None
+
+        if self.name:
+            with self._timers_lock:       # Running total in both modes
+                self.timers[self.name] += Delta_time
+        if self.aggregate:
+            self._histogram.record(Delta_time)
+            return Delta_time
 
         # Report Delta time
         if self.logger and self.units == "ms":
             self.logger(self.text.format(self.name, Delta_time/10**6, self.units))
         if self.logger and self.units == "us":
             self.logger(self.text.format(self.name, Delta_time/10**3, self.units))
-        if self.name:
-            self.timers[self.name] += Delta_time
 
         return Delta_time
 
+    @classmethod
+    def snapshot(cls, reset: bool = False, units: str = "ms") -> Dict[str, Dict[str, Optional[float]]]:
+        """Stats for every aggregate timer in ms or us. Call periodically (ie every minute) with reset=True"""
+        scale = 10**6 if units == "ms" else 10**3
+        out = {}
+        for name, histogram in list(cls.histograms.items()):
+            stats = histogram.snapshot(reset)
+            out[name] = {key: (value if key == 'count' or value is None else value / scale) for key, value in stats.items()}
+        return out
+
+    @classmethod
+    def reset(cls) -> None:
+        """Clear every aggregate timer"""
+        for histogram in list(cls.histograms.values()):
+            histogram.reset()
+
     def __enter__(self) -> "Timer":
         """Start a new timer as a context manager"""
         self.start()
@@ -68,4 +168,12 @@ if __name__ == "__main__":
             x = x + 1.1
     x=1
     n=1000
-    test(x, n)
\ No newline at end of file
+    test(x, n)
+
+    @Timer(name="agg", aggregate=True)
+    def add(x, n):
+        for _ in range(n):
+            x = x + 1.1
+    for _ in range(1000):
+        add(x, n)
+    print(Timer.snapshot(units="us"))
\ No newline at end of file
@@ -47,21 +47,130 @@ ADC*32SAMP: 32 samples at 12 bit, conversion time 17.02ms.
 ADC*64SAMP: 64 samples at 12 bit, conversion time 34.05ms.
 ADC*128SAMP: 128 samples at 12 bit, conversion time 68.10ms.
 
+gainmode="hysteretic" calibrates once for the 320mV range and only moves the PGA, one config write and no
+recalibration. The gain steps up before the shunt voltage reaches the top of the range (gain_up of full scale,
+one sample ahead on the present slope) and steps down after gain_hold samples below gain_down of the next range.
+A reading that clipped anyway jumps straight to 320mV and is read again, so it is late instead of lost.
+gain_ups/gain_downs/gain_recoveries count the switches (acqstats).
+
+Fast start. PiINA219(cache='/home/pi/ina219-cache.json') saves the calibration and config register per bus, address,
+maxA, gain mode and ADC setting. On the next start one config register read checks the device still holds that config
+(power on reset or a reset clears config and calibration together) and the whole configure/calibrate is skipped.
+
+Backends. The registers are read/written through backend='pi-ina219' (default, Adafruit_GPIO like pi-ina219 itself),
+'smbus' (smbus2) or 'adafruit' (Blinka busio). backend='fastest' times the installed ones on the board at start
+and keeps the fastest. Everything else is the same whatever the backend (see backends.py).
+
+Allocation free reads. getdata() returns a new dict (it no longer hands out one dict that the next read overwrites).
+For many channels at high rate pass buffers the caller owns and reuses, so no containers are made per sample
+and the garbage collector has nothing to collect:
+sample = Sample()
+ina.read_into(sample)     # sample.t (perf_counter), .volts, .amps, .watts (None on overflow), .mVshunt
+data = {}
+ina.getdata(data)         # fills data in place and returns it
+
 '''
 
 from ina219 import INA219
 from ina219 import DeviceRangeError
-import time, logging
+import os, json, time, logging
 from time import perf_counter, perf_counter_ns
+from math import trunc
+
+REG_CONFIG = 0x00
+REG_SHUNTVOLTAGE = 0x01
+REG_BUSVOLTAGE = 0x02
+REG_POWER = 0x03
+REG_CURRENT = 0x04
+
+PGA_COUNTS = (4000, 8000, 16000, 32000)   # Shunt register full scale for GAIN_1_40MV .. GAIN_8_320MV (10uV/bit)
+
+# Conversion time (sec) for each bus_adc/shunt_adc setting. Codes 4-7 repeat 9-12bit, 8 is 12bit
+ADC_CONV_S = {0: 84e-6, 1: 148e-6, 2: 276e-6, 3: 532e-6, 4: 84e-6, 5: 148e-6, 6: 276e-6, 7: 532e-6, 8: 532e-6,
+              9: 1.06e-3, 10: 2.13e-3, 11: 4.26e-3, 12: 8.51e-3, 13: 17.02e-3, 14: 34.05e-3, 15: 68.10e-3}
+
+class Sample:
+    ''' One decoded reading. Filled in place by PiINA219.read_into '''
+    __slots__ = ('t', 'volts', 'amps', 'watts', 'mVshunt')
+
+    def __init__(self, t=0.0, volts=0.0, amps=0.0, watts=0.0, mVshunt=0.0):
+        self.t = t
+        self.volts = volts
+        self.amps = amps
+        self.watts = watts
+        self.mVshunt = mVshunt
+
+    def __repr__(self):
+        return 'Sample(t={0}, volts={1}, amps={2}, watts={3}, mVshunt={4})'.format(
+            self.t, self.volts, self.amps, self.watts, self.mVshunt)
+
+class _INA219(INA219):
+    ''' pi-ina219 INA219 bound to an i2c device passed in (ie simbus.SimINA219) instead of opening /dev/i2c-N '''
+
+    def __init__(self, shunt_ohms, max_expected_amps, i2c, log_level=logging.ERROR):
+        self.logger = logging.getLogger('ina219')
+        self.logger.setLevel(log_level)
+        self._i2c = i2c
+        self._shunt_ohms = shunt_ohms
+        self._max_expected_amps = max_expected_amps
+        self._min_device_current_lsb = self._calculate_min_current_lsb()
+        self._gain = None
+        self._auto_gain_enabled = False
+
+def _cache_load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _cache_save(path, key, entry):
+    ''' Add one device to the cache file. Written to .tmp then renamed so a crash never leaves half a file '''
+    cache = _cache_load(path)
+    cache[key] = entry
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(path + '.tmp', path)
 
 class PiINA219:
 
-    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None): 
+    def __init__(self, voltkey='Vbusf', currentkey='IbusAf', powerkey='PowerWf', gainmode="auto", maxA = 0.4, address=0x40, logger=None,
+                 busnum=None, i2c=None, burst=True, shuntkey=None, bus_adc=INA219.ADC_12BIT, shunt_adc=INA219.ADC_12BIT, acquire=None,
+                 gain_up=0.8, gain_down=0.5, gain_hold=50, cache=None, backend='pi-ina219'): 
         self.SHUNT_OHMS = 0.1
         self.voltkey = voltkey
         self.currentkey = currentkey
         self.powerkey = powerkey
+        self.shuntkey = shuntkey      # Optional key for shunt mV. Costs one extra register read per sample
         self.address = address
+        self.busnum = busnum if i2c is None else getattr(i2c, 'busnum', busnum)  # None = default Pi bus (1)
+        self.burst = burst            # True = getdata reads registers directly (3 reads, 4 with shunt) and decodes in one pass
+        self.bus_adc = bus_adc        # ADC resolution/averaging (see ADC table above). Sets the conversion time
+        self.shunt_adc = shunt_adc
+        self.adc_changes = 0          # Bumped by set_adc so a running Sampler picks up the new conversion time
+        self.acquire = acquire        # None = read whatever is in the registers
+                                      # 'ready' = continuous mode, wait for the conversion ready flag (CNVR) before each read
+                                      # 'triggered' = single shot, trigger a conversion and wait for it on each read
+        self.samples = 0              # Burst reads done
+        self.duplicates = 0           # Reads that got the same conversion as the last read (CNVR not set)
+        self.missed = 0               # 'ready' mode: conversions that finished but were never read (estimated from timing)
+        self.polls = 0                # 'ready'/'triggered': extra bus register reads spent waiting on CNVR
+        self.overflows = 0            # Reads with the OVF flag set (auto gain may still recover them)
+        self.gainmode = gainmode
+        self.gain_up = gain_up        # 'hysteretic': step up when the shunt reaches this fraction of full scale
+        self.gain_down = gain_down    # 'hysteretic': step down below this fraction of the next lower range..
+        self.gain_hold = gain_hold    # ..for this many samples in a row
+        self.gain_ups = 0
+        self.gain_downs = 0
+        self.gain_recoveries = 0      # 'hysteretic': reads that clipped and were read again at 320mV
+        self._gain_level = 0          # Last |current register|
+        self._gain_below = 0          # Samples in a row below the step down level
+        self.range_errors = 0         # DeviceRangeError "Current overflow" - amps/watts lost
+        self._t_ready = None          # When the last fresh conversion was seen
+        self._t_trigger = None        # 'triggered': when the pending single shot was started
+        self.cache = cache            # Path of the calibration cache (fast start). None = configure every start
+        self.fast_start = False       # True if the cached setup was still on the device
+        self.capture = None           # capture.Capture. Every read() is also recorded there as raw registers
         if logger is not None:                        # Use logger passed as argument
             self.logger = logger
         elif len(logging.getLogger().handlers) == 0:   # Root logger does not exist and no custom logger passed
@@ -69,25 +178,294 @@ class PiINA219:
             self.logger = logging.getLogger(__name__)    # Create from root logger
         else:                                          # Root logger already exists and no custom logger passed
             self.logger = logging.getLogger(__name__)    # Create from root logger        
-        self.ina219 = INA219(self.SHUNT_OHMS, maxA, address=self.address)  # can pass log_level=log_level
-        self.outgoing = {}
+        self.backend = backend if i2c is None else None   # None = i2c device passed in (ie simulated)
+        if i2c is None and backend != 'pi-ina219':
+            from .backends import open_device, fastest
+            if backend == 'fastest':
+                self.backend, times = fastest(address, busnum, logger=self.logger)
+                self.logger.info('ina219 at {0} backend {1} ({2})'.format(address, self.backend, ', '.join(
+                    '{0}:{1:.0f}us'.format(name, us) for name, us in times.items())))
+            if self.backend != 'pi-ina219':
+                i2c = open_device(self.backend, address, busnum)
+        if i2c is None:
+            self.ina219 = INA219(self.SHUNT_OHMS, maxA, busnum=busnum, address=self.address)  # can pass log_level=log_level
+        else:                                          # Simulated bus or an already open i2c device
+            self.ina219 = _INA219(self.SHUNT_OHMS, maxA, i2c)
+        self.outgoing = {}            # Last reading. Kept so an overflow repeats the last current/power, never handed out
+        self._sample = Sample()       # read() and getdata() decode into this
+        self._busreg = self._currentreg = self._powerreg = self._shuntreg = 0   # Registers of the last burst read
+        key = '{0}:{1}:{2}:{3}:{4}:{5}:{6}'.format(self.busnum, hex(address), maxA, gainmode, bus_adc, shunt_adc, acquire)
+        entry = _cache_load(cache).get(key) if cache is not None else None
+        if entry is not None:
+            self.fast_start = self._restore(entry)
+        if not self.fast_start:
+            self._setup(gainmode, maxA, bus_adc, shunt_adc, acquire)
+            if cache is not None:
+                ina = self.ina219
+                _cache_save(cache, key, {'config': self._config, 'current_lsb': ina._current_lsb, 'power_lsb': ina._power_lsb,
+                                         'auto_gain': ina._auto_gain_enabled})
+        if gainmode == "hysteretic":
+            self.burst = True
+            cal = trunc(0.04096 / (self.ina219._current_lsb * self.SHUNT_OHMS))
+            self._gain_clip = [trunc(counts * cal / 4096) - 1 for counts in PGA_COUNTS]   # |current register| when clipped
+            self._gain_uplevel = [clip * gain_up for clip in self._gain_clip]
+            self._gain_downlevel = [0] + [clip * gain_down for clip in self._gain_clip[:-1]]
+        self.logger.info('ina219 at {0} setup with gain mode:{1} max Amps:{2}{3}'.format(
+            address, gainmode, maxA, ' (cached)' if self.fast_start else ''))
+        if self.logger.isEnabledFor(logging.DEBUG):   # str() reads every register
+            self.logger.debug(self.ina219)
+
+    def _setup(self, gainmode, maxA, bus_adc, shunt_adc, acquire):
+        ''' Full configure and calibrate '''
         if gainmode == "auto":      # AUTO GAIN, HIGH RESOLUTION - Lower precision above max amps specified
-            self.ina219.configure(self.ina219.RANGE_16V)
+            self.ina219.configure(self.ina219.RANGE_16V, bus_adc=bus_adc, shunt_adc=shunt_adc)
         elif gainmode == "manual":  # MANUAL GAIN, HIGH RESOLUTION - Max amps is 400mA
-            self.ina219.configure(self.ina219.RANGE_16V, self.ina219.GAIN_1_40MV)
-        self.logger.info('ina219 at {0} setup with gain mode:{1} max Amps:{2}'.format(address, gainmode, maxA))
-        self.logger.info(self.ina219)
+            self.ina219.configure(self.ina219.RANGE_16V, self.ina219.GAIN_1_40MV, bus_adc, shunt_adc)
+        elif gainmode == "hysteretic":  # One calibration for the whole 320mV range, gain switched ahead of the load
+            self.ina219._voltage_range = self.ina219.RANGE_16V
+            self.ina219._calibrate(16, 0.32)
+            self.ina219._gain = self.ina219._determine_gain(maxA)
+            self.ina219._configure(self.ina219.RANGE_16V, self.ina219._gain, bus_adc, shunt_adc)
+        self._config = self.ina219._read_configuration()
+        if acquire == 'triggered':  # Mode 3 = shunt and bus triggered. Each config write starts one conversion
+            self._config = self._trigger_config = (self._config & 0xFFF8) | 0x03
+            self.ina219._configuration_register(self._trigger_config)
+
+    def _restore(self, entry):
+        ''' Fast start. One config read. If the device still holds the cached config take the cached calibration
+        instead of configuring again. 'hysteretic' moves the PGA at runtime so the gain bits are taken from the device '''
+        config = self.ina219._read_configuration()
+        mask = 0xE7FF if self.gainmode == "hysteretic" else 0xFFFF
+        if config & mask != entry['config'] & mask:
+            return False
+        ina = self.ina219
+        ina._voltage_range = ina.RANGE_16V
+        ina._current_lsb = entry['current_lsb']
+        ina._power_lsb = entry['power_lsb']
+        ina._auto_gain_enabled = entry['auto_gain']
+        ina._gain = (config >> 11) & 0x03
+        self._config = config
+        if self.acquire == 'triggered':
+            self._trigger_config = config
+        return True
 
-    def getdata(self):
+    def getdata(self, out=None):
+        ''' Reading as {voltkey, currentkey, powerkey(, shuntkey)}. out = a dict to fill in place, None = a new dict '''
+        if self.burst:
+            return self.getdata_burst(out)
         self.outgoing[self.voltkey] =  self.ina219.voltage()
         try:
             self.outgoing[self.currentkey] = float("{:.3f}".format(self.ina219.current()/1000))
             self.outgoing[self.powerkey] = float("{:.2f}".format(self.ina219.power()/1000))
             #Vshunt = self.ina219.shunt_voltage()
         except DeviceRangeError as e:
+            self.range_errors += 1
             self.logger.info("Current overflow")
         self.logger.debug('{0}, {1}, {2}'.format(self.address, self.outgoing.keys(), self.outgoing.values()))
-        return self.outgoing
+        return self._copy_out(out)
+
+    def readraw(self):
+        ''' Burst read of the raw registers. Returns (bus, current, power, shunt), shunt is 0 if no shuntkey
+        INA219 does not auto-increment the register pointer so each register is one i2c transaction.
+        The bus register also carries the CNVR and OVF flags so no separate overflow check reads are needed. '''
+        self._readregs()
+        return self._busreg, self._currentreg, self._powerreg, self._shuntreg
+
+    def _readregs(self):
+        ''' readraw() into self._busreg.. instead of a tuple '''
+        i2c = self.ina219._i2c
+        if self.acquire is None:
+            self._busreg = i2c.readU16BE(REG_BUSVOLTAGE)
+        else:
+            self._busreg = self._wait_ready()
+        self._currentreg = i2c.readS16BE(REG_CURRENT)
+        self._powerreg = i2c.readU16BE(REG_POWER)
+        self._shuntreg = i2c.readS16BE(REG_SHUNTVOLTAGE) if self.shuntkey is not None else 0
+
+    def read(self):
+        ''' Burst read decoded to (volts, amps, watts, mVshunt) floats. amps and watts are None if the
+        current overflowed and auto gain could not recover. mVshunt is 0 unless shuntkey is set '''
+        sample = self.read_into(self._sample)
+        return sample.volts, sample.amps, sample.watts, sample.mVshunt
+
+    def read_into(self, sample):
+        ''' read() into a Sample the caller keeps and reuses (no tuple per sample). Sets sample.t to perf_counter() '''
+        self._readregs()
+        busreg = self._busreg
+        currentreg = self._currentreg
+        powerreg = self._powerreg
+        shuntreg = self._shuntreg
+        self.samples += 1
+        if not busreg & 0x02:              # CNVR clear - no conversion since the last power read
+            self.duplicates += 1
+        lost = False                       # Current/power unrecoverable (overflow past the top range)
+        if self.gainmode == "hysteretic":
+            if busreg & 0x01 or abs(currentreg) >= self._gain_clip[self.ina219._gain]:
+                self.overflows += 1
+                self._recover_gain()
+                busreg = self._busreg
+                currentreg = self._currentreg
+                powerreg = self._powerreg
+                shuntreg = self._shuntreg
+                if busreg & 0x01 or abs(currentreg) >= self._gain_clip[3]:   # Past 320mV, nothing left to switch to
+                    self.range_errors += 1
+                    self.logger.info("Current overflow")
+                    lost = True
+            else:
+                self._track_gain(currentreg)
+        elif busreg & 0x01:                  # OVF - current/power registers are invalid
+            self.overflows += 1
+            try:
+                self.ina219._handle_current_overflow()   # Auto gain steps up (recalibrates) or raises DeviceRangeError
+                i2c = self.ina219._i2c
+                currentreg = i2c.readS16BE(REG_CURRENT)
+                powerreg = i2c.readU16BE(REG_POWER)
+            except DeviceRangeError as e:
+                self.range_errors += 1
+                self.logger.info("Current overflow")
+                lost = True
+        if self.capture is not None:       # Raw registers at full rate to the capture file (decoded on replay)
+            self.capture.append(time.time(), self.address, busreg, currentreg, powerreg, shuntreg,
+                                self.ina219._current_lsb, self.ina219._gain or 0, lost)
+        sample.t = perf_counter()
+        sample.volts = (busreg >> 3) * 4 / 1000
+        if lost:
+            sample.amps = sample.watts = None
+        else:
+            sample.amps = currentreg * self.ina219._current_lsb
+            sample.watts = powerreg * self.ina219._power_lsb
+        sample.mVshunt = shuntreg * 0.01
+        return sample
+
+    def _track_gain(self, currentreg):
+        ''' Hysteretic gain. Step up ahead of the load, step down only after gain_hold quiet samples '''
+        level = abs(currentreg)
+        ahead = level + max(level - self._gain_level, 0)   # Next sample if the current keeps rising like this
+        self._gain_level = level
+        gain = self.ina219._gain
+        if gain < 3 and ahead >= self._gain_uplevel[gain]:
+            while gain < 3 and ahead >= self._gain_uplevel[gain]:
+                gain += 1
+            self.gain_ups += 1
+            self._set_gain(gain)
+        elif gain > 0 and level < self._gain_downlevel[gain]:
+            self._gain_below += 1
+            if self._gain_below >= self.gain_hold:
+                self.gain_downs += 1
+                self._set_gain(gain - 1)
+        else:
+            self._gain_below = 0
+
+    def _recover_gain(self):
+        ''' The shunt clipped. Jump to 320mV, wait for a conversion at the new gain and read again '''
+        self.gain_recoveries += 1
+        self._set_gain(3)
+        if self.acquire is None:           # 'ready'/'triggered' wait for the conversion in readraw
+            time.sleep(self.conversion_time())
+        self._readregs()
+
+    def _set_gain(self, gain):
+        ''' PGA bits only. Calibration covers every range so the current/power registers stay valid '''
+        self._config = (self._config & 0xE7FF) | gain << 11
+        if self.acquire == 'triggered':
+            self._trigger_config = self._config
+            self._t_trigger = None
+        self.ina219._configuration_register(self._config)
+        self.ina219._gain = gain
+        self._gain_below = 0
+        self._t_ready = None
+        self.logger.debug('ina219 at %s gain %d', self.address, gain)
+
+    def getdata_burst(self, out=None):
+        ''' Same dict as getdata but decoded straight from one pass over the registers (no string formatting) '''
+        sample = self.read_into(self._sample)
+        return self.fill(sample.volts, sample.amps, sample.watts, sample.mVshunt, out)
+
+    def fill(self, volts, amps, watts, mVshunt=0, out=None):
+        ''' A read() result as the getdata dict (rounded like getdata). out = a dict to fill in place, None = a new dict '''
+        self.outgoing[self.voltkey] = volts
+        if amps is not None:               # On overflow keep the last current/power like getdata always has
+            self.outgoing[self.currentkey] = round(amps, 3)
+            self.outgoing[self.powerkey] = round(watts, 2)
+            if self.shuntkey is not None:
+                self.outgoing[self.shuntkey] = round(mVshunt, 2)
+        if self.logger.isEnabledFor(logging.DEBUG):   # Skips the argument tuple when not debugging
+            self.logger.debug('%s, %s', self.address, self.outgoing)
+        return self._copy_out(out)
+
+    def _copy_out(self, out):
+        if out is None:
+            return dict(self.outgoing)
+        out.update(self.outgoing)
+        return out
+
+    def _wait_ready(self):
+        ''' Block until a new conversion is ready and return the bus register with CNVR set.
+        Sleeps through most of the expected conversion time so waiting costs few i2c polls.
+        Gives up after 2 conversion times + 50ms (ie device asleep) and returns the stale register '''
+        i2c = self.ina219._i2c
+        conv = self.conversion_time()
+        now = perf_counter()
+        if self.acquire == 'triggered':
+            if self._t_trigger is None:
+                self.trigger()
+            t_expect = self._t_trigger + conv
+            self._t_trigger = None
+        elif self._t_ready is None:
+            t_expect = now
+        else:
+            t_expect = self._t_ready + conv
+        if t_expect - now > 0.0002:         # Sleep overshoots ~0.1ms, not worth it for the shortest conversions
+            time.sleep(t_expect - now - 0.0001)
+        t_giveup = t_expect + conv + 0.05
+        busreg = i2c.readU16BE(REG_BUSVOLTAGE)
+        while not busreg & 0x02:
+            now = perf_counter()
+            if now > t_giveup:
+                return busreg
+            time.sleep(min(conv / 8, 0.001))
+            self.polls += 1
+            busreg = i2c.readU16BE(REG_BUSVOLTAGE)
+        now = perf_counter()
+        if self.acquire == 'ready' and self._t_ready is not None:
+            periods = int((now - self._t_ready) / conv + 0.5)
+            if periods > 1:
+                self.missed += periods - 1
+        self._t_ready = now
+        return busreg
+
+    def trigger(self):
+        ''' Start a single shot conversion (acquire='triggered'). The next read() waits on it instead of
+        triggering its own, so conversions on several boards can run while the bus is busy with the others '''
+        self.ina219._i2c.writeList(REG_CONFIG, [self._trigger_config >> 8, self._trigger_config & 0xFF])
+        self._t_trigger = perf_counter()
+
+    def acqstats(self):
+        ''' Counters for checking every conversion is read exactly once '''
+        return {'samples': self.samples, 'duplicates': self.duplicates, 'missed': self.missed, 'polls': self.polls,
+                'overflows': self.overflows, 'range_errors': self.range_errors,
+                'gain_ups': self.gain_ups, 'gain_downs': self.gain_downs, 'gain_recoveries': self.gain_recoveries}
+
+    def set_adc(self, bus_adc=None, shunt_adc=None):
+        ''' Change ADC resolution/averaging at runtime. Range, gain, calibration and mode are kept '''
+        for code in (bus_adc, shunt_adc):
+            if code is not None and code not in ADC_CONV_S:
+                raise ValueError('ADC setting {0} is not one of the INA219.ADC_* codes'.format(code))
+        self.bus_adc = self.bus_adc if bus_adc is None else bus_adc
+        self.shunt_adc = self.shunt_adc if shunt_adc is None else shunt_adc
+        self._config = (self.ina219._read_configuration() & ~0x07F8) | self.bus_adc << 7 | self.shunt_adc << 3
+        if self.acquire == 'triggered':
+            self._trigger_config = self._config
+            self._t_trigger = None
+        self.ina219._configuration_register(self._config)   # Restarts the conversion
+        self._t_ready = None
+        self.adc_changes += 1
+        self.logger.info('ina219 at {0} bus_adc:{1} shunt_adc:{2} conversion {3:.3f}ms'.format(
+            self.address, self.bus_adc, self.shunt_adc, self.conversion_time() * 1000))
+
+    def conversion_time(self):
+        ''' Seconds for one shunt+bus conversion cycle in continuous mode. Fastest useful sample period '''
+        return ADC_CONV_S[self.bus_adc] + ADC_CONV_S[self.shunt_adc]
 
     def sleep(self):
         self.ina219.sleep()
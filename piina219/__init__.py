@@ -1 +1,41 @@
-from .Mpiina219 import PiINA219
\ No newline at end of file
+'''
+Submodules load on first use (PEP 562) so a process that only needs PiINA219 does not pay for
+threads, zlib, concurrent.futures etc. at start. `from piina219 import Sampler` works as before.
+'''
+
+import importlib
+
+_EXPORTS = {
+    'PiINA219': 'Mpiina219', 'Sample': 'Mpiina219',
+    'SimI2CBus': 'simbus', 'SimINA219': 'simbus',
+    'RingBuffer': 'sampler', 'Sampler': 'sampler',
+    'MultiReader': 'multireader', 'Reading': 'multireader', 'Snapshot': 'multireader',
+    'BatchPublisher': 'batch',
+    'Spool': 'spool', 'SpoolPublisher': 'spool',
+    'Reducer': 'reduce',
+    'Integrator': 'energy',
+    'Metrics': 'metrics',
+    'AdcTuner': 'tuner',
+    'Capture': 'capture', 'Replay': 'capture',
+    'BusWorkers': 'workers', 'SharedRing': 'workers',
+    'discover': 'discovery', 'device_name': 'discovery',
+    'AsyncPublisher': 'aiopublish',
+    'SimBroker': 'simbroker',
+    'InfluxSink': 'influx',
+    'SimInflux': 'siminflux',
+    'Trigger': 'trigger',
+    'open_device': 'backends',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+'''
+Publish stage between acquisition and mqtt, with a bounded queue and backpressure.
+
+publish() only appends to the queue and returns, so a slow or unreachable broker can neither stall the caller
+nor grow memory without limit. An asyncio loop in its own thread sends from the queue to the client, keeping
+at most max_inflight messages between client.publish() and the on_publish callback (QoS 1/2: acked by the broker,
+QoS 0: written to the socket), so paho's own queue stays small too. While the client is not connected nothing is sent.
+When the queue is full the policy decides:
+drop-oldest   the oldest queued message goes (dropped)
+coalesce      the newest value replaces the last one queued for the same topic (coalesced), or the oldest goes
+block         the caller waits up to block_timeout for room, then the message is dropped
+
+Wire the client's on_publish to acked() so the in-flight count goes down. Messages never acked (ie QoS 0
+messages paho discards on a disconnect) are let go after ack_timeout seconds (ack_timeouts).
+
+pub = AsyncPublisher(mqtt_client, maxsize=1000, policy='coalesce', max_inflight=20)   # or a SpoolPublisher
+mqtt_client.on_publish = lambda client, userdata, mid: pub.acked(mid)
+pub.publish(topic, payload)           # same call as mqtt_client.publish
+pub.stats()                           # {'queue_depth':.., 'queue_max':.., 'inflight':.., 'sent':.., 'dropped':.., 'coalesced':..}
+pub.close()                           # sends what is left (up to timeout)
+'''
+
+import asyncio, threading, logging
+from collections import deque
+from time import monotonic
+
+POLICIES = ('drop-oldest', 'coalesce', 'block')
+
+class AsyncPublisher:
+
+    def __init__(self, client, maxsize=1000, policy='drop-oldest', max_inflight=20, qos=0, block_timeout=1.0,
+                 ack_timeout=30.0, logger=None):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of {0}'.format(POLICIES))
+        self.client = client
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.qos = qos
+        self.block_timeout = block_timeout
+        self.ack_timeout = ack_timeout
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0                  # publish() calls that had to wait for room
+        self.ack_timeouts = 0
+        self.queue_max = 0                # Deepest the queue has been since the last stats(reset=True)
+        self._queue = deque()             # [topic, payload, qos] lists, oldest first
+        self._last = {}                   # topic -> its newest queued item (coalesce)
+        self._inflight = {}               # mid -> monotonic time sent
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._closing = False
+        self._loop = asyncio.new_event_loop()
+        self._wake = None                 # asyncio.Event, made on the loop's thread
+        self._sleeping = False            # Sender is waiting for a wake up (queue empty or nothing it can send)
+        self._thread = threading.Thread(target=self._run, name='aiopublish', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._sender())
+
+    def _connected(self):
+        is_connected = getattr(self.client, 'is_connected', None)
+        return is_connected is None or is_connected()    # A SpoolPublisher takes messages either way
+
+    def publish(self, topic, payload, qos=None):
+        ''' Queue one message. Returns False if it (or an older one, drop-oldest/coalesce) was dropped '''
+        item = [topic, payload, self.qos if qos is None else qos]
+        kept = True
+        with self._lock:
+            if self._closing:
+                return False
+            if len(self._queue) >= self.maxsize:
+                if self.policy == 'block':
+                    self.blocked += 1
+                    if not self._room.wait_for(lambda: len(self._queue) < self.maxsize or self._closing, self.block_timeout) \
+                            or self._closing:
+                        self.dropped += 1
+                        return False
+                elif self.policy == 'coalesce' and topic in self._last:
+                    self._last[topic][1] = payload
+                    self.coalesced += 1
+                    return True
+                else:
+                    old = self._queue.popleft()
+                    if self._last.get(old[0]) is old:
+                        del self._last[old[0]]
+                    self.dropped += 1
+                    kept = False
+            self._queue.append(item)
+            self._last[topic] = item
+            self.queued += 1
+            self.queue_max = max(self.queue_max, len(self._queue))
+            wake = self._sleeping
+            self._sleeping = False
+        if wake:
+            self._loop.call_soon_threadsafe(self._wake.set)   # Only when the sender sleeps, a wake up costs a pipe write
+        return kept
+
+    def acked(self, mid):
+        ''' Call from the client's on_publish '''
+        self._loop.call_soon_threadsafe(self._acked, mid)
+
+    def _acked(self, mid):
+        if self._inflight.pop(mid, None) is not None:
+            self._wake.set()
+
+    def _expire(self):
+        now = monotonic()
+        for mid in [mid for mid, t in self._inflight.items() if now - t > self.ack_timeout]:
+            del self._inflight[mid]
+            self.ack_timeouts += 1
+
+    async def _sender(self):
+        self._wake = asyncio.Event()
+        sent = 0
+        while True:
+            item = None
+            with self._lock:
+                if self._queue and len(self._inflight) < self.max_inflight and self._connected():
+                    item = self._queue.popleft()
+                    if self._last.get(item[0]) is item:
+                        del self._last[item[0]]
+                    self._room.notify()
+                elif self._closing and not self._queue:
+                    return
+                else:
+                    self._sleeping = True
+                    self._wake.clear()
+            if item is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), 0.1)   # Also polls the connection and ack timeouts
+                except asyncio.TimeoutError:
+                    pass
+                self._expire()
+                continue
+            try:
+                info = self.client.publish(*item)
+            except Exception as e:          # Never let one bad message end the sender
+                self.logger.warning('publish to {0} failed: {1}'.format(item[0], e))
+                continue
+            self.sent += 1
+            if info is not None and info.rc == 0:
+                self._inflight[info.mid] = monotonic()
+            sent += 1
+            if sent % 32 == 0:
+                await asyncio.sleep(0)    # Let acks in
+
+    def stats(self, reset=False):
+        ''' Queue and delivery numbers for the metrics. reset starts a new queue_max interval '''
+        with self._lock:
+            out = {'queue_depth': len(self._queue), 'queue_max': self.queue_max, 'inflight': len(self._inflight),
+                   'queued': self.queued, 'sent': self.sent, 'dropped': self.dropped, 'coalesced': self.coalesced,
+                   'blocked': self.blocked, 'ack_timeouts': self.ack_timeouts}
+            if reset:
+                self.queue_max = len(self._queue)
+        return out
+
+    def close(self, timeout=2.0):
+        ''' Stop taking messages and send what is queued, for up to timeout seconds '''
+        with self._lock:
+            self._closing = True
+            self._room.notify_all()
+        self._loop.call_soon_threadsafe(lambda: self._wake.set())
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            with self._lock:
+                left = len(self._queue)
+                self.dropped += left
+                self._queue.clear()
+            self.logger.warning('publisher closed with {0} messages unsent'.format(left))
+            self._loop.call_soon_threadsafe(lambda: self._wake.set())
+            self._thread.join(1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+'''
+Vectorized analysis of captured or buffered samples with NumPy (pip3 install numpy, only this module needs it).
+
+Works on whole arrays instead of per sample dicts, so millions of samples take a fraction of a second
+and the heavy lifting doesn't have to go through influx/flux.
+
+data = load_capture('/home/pi/load.cap', address=0x40)     # or from_ring(sampler.ring)
+data.t, data.volts, data.amps, data.watts                   # float64 arrays, lost amps/watts are nan
+
+window_stats(data.t, data.amps, 1.0)      # {'t':.., 'n':.., 'mean':.., 'min':.., 'max':.., 'rms':.., 'std':..} per 1 sec window
+freqs, amplitude = spectrum(data.t, data.amps)              # current ripple, amps peak per frequency
+ripple(data.t, data.amps)                 # (frequency, amps peak) of the strongest ripple component
+events(data.t, data.amps, 0.5)            # runs above 0.5A: start, end, duration, peak, t_peak, Ah
+peaks(data.t, data.amps, 0.5)             # local maxima above 0.5A at least distance sec apart
+energy(data.t, data.volts, data.amps, data.watts, 60)       # Ah/Wh per minute, in and out
+'''
+
+from collections import namedtuple
+import numpy as np
+from .capture import Capture, RECORD, HEADER_SIZE, LOST
+
+Samples = namedtuple('Samples', 't volts amps watts address')
+
+# Capture record as a numpy structured type (same layout as capture.RECORD)
+RECORD_DTYPE = np.dtype([('marker', 'u1'), ('address', 'u1'), ('gain', 'u1'), ('flags', 'u1'), ('seq', '<u4'),
+                         ('t', '<f8'), ('bus', '<u2'), ('current', '<i2'), ('power', '<u2'), ('shunt', '<i2'),
+                         ('lsb', '<f4'), ('crc', '<u4')])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+def load_capture(path, address=None):
+    ''' Decode a capture file in one pass. address picks one board, None keeps all (see Samples.address) '''
+    cap = Capture(path, mode='r')      # Header check and count of good records (torn tail dropped)
+    count = len(cap)
+    cap.close()
+    records = np.fromfile(path, RECORD_DTYPE, count=count, offset=HEADER_SIZE)
+    if address is not None:
+        records = records[records['address'] == address]
+    lsb = records['lsb'].astype(np.float64)
+    lost = (records['flags'] & LOST) != 0
+    amps = records['current'] * lsb
+    watts = records['power'] * lsb * 20
+    amps[lost] = np.nan
+    watts[lost] = np.nan
+    return Samples(records['t'], (records['bus'] >> 3) * 0.004, amps, watts, records['address'])
+
+def from_ring(ring, seconds=None, n=None):
+    ''' Newest samples of a sampler RingBuffer (perf_counter times). Columns in the default Vbus/IbusA/PowerW order '''
+    t, cols = ring.slice(seconds, n)
+    arrays = [np.frombuffer(col, np.float64) for col in cols]
+    return Samples(np.frombuffer(t, np.float64), arrays[0], arrays[1], arrays[2], None)
+
+def _bounds(t, seconds, start=None):
+    ''' Window edges and the first sample index of each window. t must be sorted '''
+    start = t[0] if start is None else start
+    edges = start + seconds * np.arange(int(np.floor((t[-1] - start) / seconds)) + 2)
+    return edges, np.searchsorted(t, edges)
+
+def window_stats(t, x, seconds, start=None):
+    ''' n/mean/min/max/rms/std of x over fixed windows of seconds. nan samples are skipped, empty windows are nan '''
+    if len(t) == 0:
+        return {key: np.empty(0) for key in ('t', 'n', 'mean', 'min', 'max', 'rms', 'std')}
+    edges, idx = _bounds(t, seconds, start)
+    valid = ~np.isnan(x)
+    filled = np.where(valid, x, 0.0)
+    csum = np.concatenate(([0.0], np.cumsum(filled)))
+    csq = np.concatenate(([0.0], np.cumsum(filled * filled)))
+    cnt = np.concatenate(([0], np.cumsum(valid)))
+    lo, hi = idx[:-1], idx[1:]
+    n = cnt[hi] - cnt[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (csum[hi] - csum[lo]) / n
+        meansq = (csq[hi] - csq[lo]) / n
+        std = np.sqrt(np.maximum(meansq - mean * mean, 0))
+    nonempty = hi > lo
+    low = np.full(len(lo), np.nan)
+    high = np.full(len(lo), np.nan)
+    if nonempty.any():
+        starts = lo[nonempty]
+        low[nonempty] = np.fmin.reduceat(np.where(valid, x, np.inf), starts)
+        high[nonempty] = np.fmax.reduceat(np.where(valid, x, -np.inf), starts)
+        low[np.isinf(low)] = np.nan
+        high[np.isinf(high)] = np.nan
+    return {'t': edges[:-1], 'n': n, 'mean': mean, 'min': low, 'max': high, 'rms': np.sqrt(meansq), 'std': std}
+
+def resample(t, x, rate=None):
+    ''' x on an even time grid (linear interpolation over gaps and nan). rate None = median sample rate '''
+    valid = ~np.isnan(x)
+    t, x = t[valid], x[valid]
+    if rate is None:
+        rate = 1 / np.median(np.diff(t))
+    grid = np.arange(t[0], t[-1], 1 / rate)
+    return grid, np.interp(grid, t, x), rate
+
+def spectrum(t, x, rate=None, window=True):
+    ''' One sided amplitude spectrum of x (peak amplitude per frequency bin) after removing the mean.
+    Samples are resampled to an even grid first. window=True applies a Hann window (amplitude corrected) '''
+    grid, even, rate = resample(t, x, rate)
+    even = even - even.mean()
+    if window:
+        taper = np.hanning(len(even))
+        even = even * taper
+        scale = 2 / taper.sum()
+    else:
+        scale = 2 / len(even)
+    amplitude = np.abs(np.fft.rfft(even)) * scale
+    amplitude[0] /= 2
+    return np.fft.rfftfreq(len(even), 1 / rate), amplitude
+
+def ripple(t, x, fmin=0.0, rate=None):
+    ''' (frequency, peak amplitude) of the strongest component above fmin '''
+    freqs, amplitude = spectrum(t, x, rate)
+    band = freqs > fmin
+    i = np.argmax(np.where(band, amplitude, -1))
+    return freqs[i], amplitude[i]
+
+Events = namedtuple('Events', 'start end duration peak t_peak Ah')
+
+def events(t, x, threshold, release=None, min_duration=0.0):
+    ''' Runs where x goes above threshold and stays above release (hysteresis, release <= threshold, default threshold).
+    nan samples end a run. Returns Events of arrays: start/end time, duration, peak value and its time, Ah (x taken as amps) '''
+    release = threshold if release is None else min(release, threshold)
+    hold = np.nan_to_num(x, nan=-np.inf) > release
+    # Runs above release, kept if some sample in them reaches threshold
+    rises = np.flatnonzero(hold & ~np.concatenate(([False], hold[:-1])))
+    falls = np.flatnonzero(hold & ~np.concatenate((hold[1:], [False])))     # Last sample of each run
+    held = np.where(hold, x, -np.inf)                 # Gaps between runs never win the max
+    if len(rises):
+        peak = np.maximum.reduceat(held, rises)
+        keep = (peak > threshold) & (t[falls] - t[rises] >= min_duration)
+        rises, falls, peak = rises[keep], falls[keep], peak[keep]
+    if not len(rises):
+        empty = np.empty(0)
+        return Events(empty, empty, empty, empty, empty, empty)
+    # Peak time: first sample of each run equal to its peak
+    edge = np.zeros(len(x) + 1, int)
+    edge[rises] += 1
+    edge[falls + 1] -= 1
+    inrun = np.cumsum(edge[:-1]) > 0
+    run = np.cumsum(edge[:-1] > 0) - 1               # Run number (rises only add 1)
+    at_peak = np.flatnonzero(inrun & (held == peak[np.clip(run, 0, None)]))
+    first = at_peak[np.concatenate(([True], np.diff(run[at_peak]) != 0))]
+    filled = np.nan_to_num(x)
+    charge = np.concatenate(([0.0], np.cumsum((filled[1:] + filled[:-1]) * np.diff(t)))) / 7200
+    return Events(t[rises], t[falls], t[falls] - t[rises], peak, t[first], charge[falls] - charge[rises])
+
+def peaks(t, x, height, distance=0.0):
+    ''' Local maxima above height. Of peaks closer than distance sec only the highest is kept. Returns (t, x) arrays '''
+    x = np.nan_to_num(x, nan=-np.inf)
+    mid = (x[1:-1] > x[:-2]) & (x[1:-1] >= x[2:]) & (x[1:-1] > height)
+    idx = np.flatnonzero(mid) + 1
+    if distance > 0 and len(idx) > 1:
+        tp = t[idx]
+        alive = np.ones(len(idx), bool)
+        for i in np.argsort(-x[idx], kind='stable'):  # Highest first, it knocks out the lower ones within distance
+            if alive[i]:
+                lo, hi = np.searchsorted(tp, (tp[i] - distance, tp[i] + distance), side='right')
+                alive[max(lo - 1, 0):hi] &= np.abs(tp[max(lo - 1, 0):hi] - tp[i]) >= distance
+                alive[i] = True
+        idx = idx[alive]
+    return t[idx], x[idx]
+
+def energy(t, volts, amps, watts, seconds, maxgap=1.0, start=None):
+    ''' Ah and Wh per interval of seconds (trapezoid rule, like energy.Integrator). Charge in (positive current)
+    and out are kept apart, power takes the sign of the current, gaps longer than maxgap and nan samples are skipped '''
+    dt = np.diff(t)
+    watts = np.where(amps < 0, -np.abs(watts), np.abs(watts))
+    steps = (dt <= maxgap) & (dt > 0) & ~np.isnan(amps[1:]) & ~np.isnan(amps[:-1])
+    ah = np.where(steps, (amps[1:] + amps[:-1]) * dt / 7200, 0.0)
+    wh = np.where(steps, np.nan_to_num(watts[1:] + watts[:-1]) * dt / 7200, 0.0)
+    edges, idx = _bounds(t, seconds, start)
+    idx = np.minimum(idx, len(dt))    # Step i (sample i to i+1) counts in the window holding sample i
+    def per_window(values):
+        cum = np.concatenate(([0.0], np.cumsum(values)))
+        return cum[idx[1:]] - cum[idx[:-1]]
+    return {'t': edges[:-1], 'Ah': per_window(ah), 'AhIn': per_window(np.maximum(ah, 0)), 'AhOut': per_window(np.maximum(-ah, 0)),
+            'Wh': per_window(wh), 'WhIn': per_window(np.maximum(wh, 0)), 'WhOut': per_window(np.maximum(-wh, 0))}
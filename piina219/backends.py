@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+'''
+Driver backends under PiINA219. PiINA219 keeps the configure/calibrate (pi-ina219's math), gain and acquire modes
+and the decoding, and does its register reads and writes through a backend with the three Adafruit_GPIO.I2C.Device
+calls pi-ina219 makes (readU16BE, readS16BE, writeList). Whichever backend, read() and getdata() return the same
+(volts, amps, watts, mVshunt) record and dict.
+
+pi-ina219  Adafruit_GPIO.I2C.Device on Adafruit_PureIO smbus, what pi-ina219 opens by itself (default)
+smbus      smbus2 (or python3-smbus) word reads straight from here, no logging or byte swap layers in between
+adafruit   adafruit_bus_device I2CDevice on Blinka busio, the i2c layer adafruit_ina219 is built on.
+           Bus 1 is board.I2C(), other buses need adafruit-extended-bus
+
+ina = PiINA219(address=0x40, busnum=1, backend='smbus')
+ina = PiINA219(address=0x40, busnum=1, backend='fastest')   # times each installed backend on the board at start
+available()                  # ['pi-ina219', 'smbus']  installed ones
+fastest(0x40, busnum=1)      # ('smbus', {'pi-ina219': 61.2, 'smbus': 48.5})  us per register read
+device = open_device('smbus', 0x40, 1, bus=SimI2CBus(1).smbus())   # bus = an open/simulated bus object
+
+`python3 bench-piina219.py backends` compares them on the simulated bus.
+'''
+
+import logging
+from importlib.util import find_spec
+from time import perf_counter
+
+BACKENDS = ('pi-ina219', 'smbus', 'adafruit')
+_REQUIRES = {'pi-ina219': ('Adafruit_GPIO',), 'smbus': ('smbus2', 'smbus'), 'adafruit': ('adafruit_bus_device',)}
+REG_BUSVOLTAGE = 0x02
+
+class SMBusDevice:
+    ''' Register access over smbus2 (python3-smbus if smbus2 is not installed) '''
+
+    def __init__(self, address, busnum=1, bus=None):
+        if bus is None:
+            try:
+                from smbus2 import SMBus
+            except ImportError:
+                from smbus import SMBus
+            bus = SMBus(busnum)
+        self.address = address
+        self.busnum = busnum
+        self._bus = bus
+
+    def readU16BE(self, register):
+        word = self._bus.read_word_data(self.address, register)   # SMBus words are little endian, the INA219 sends MSB first
+        return ((word & 0xFF) << 8) | (word >> 8)
+
+    def readS16BE(self, register):
+        value = self.readU16BE(register)
+        return value - 0x10000 if value > 0x7FFF else value
+
+    def writeList(self, register, data):
+        self._bus.write_i2c_block_data(self.address, register, list(data))
+
+class BlinkaDevice:
+    ''' Register access through adafruit_bus_device on a Blinka busio.I2C (adafruit_ina219's own i2c layer) '''
+
+    def __init__(self, address, busnum=1, i2c=None):
+        from adafruit_bus_device.i2c_device import I2CDevice
+        if i2c is None:
+            if busnum == 1:
+                import board
+                i2c = board.I2C()
+            else:
+                from adafruit_extended_bus import ExtendedI2C
+                i2c = ExtendedI2C(busnum)
+        self.address = address
+        self.busnum = busnum
+        self._device = I2CDevice(i2c, address)
+        self._register = bytearray(1)
+        self._buf = bytearray(2)
+
+    def readU16BE(self, register):
+        self._register[0] = register
+        with self._device as device:
+            device.write_then_readinto(self._register, self._buf)
+        return (self._buf[0] << 8) | self._buf[1]
+
+    def readS16BE(self, register):
+        value = self.readU16BE(register)
+        return value - 0x10000 if value > 0x7FFF else value
+
+    def writeList(self, register, data):
+        with self._device as device:
+            device.write(bytes([register, *data]))
+
+def available(backends=BACKENDS):
+    ''' Backends whose packages are installed '''
+    return [name for name in backends if any(find_spec(module) for module in _REQUIRES[name])]
+
+def open_device(backend, address, busnum=None, bus=None):
+    ''' Register access for one board through backend. bus is an already open bus object of the backend's
+    kind (smbus.SMBus for pi-ina219/smbus, busio.I2C for adafruit), ie SimI2CBus.smbus(). None opens busnum '''
+    if backend == 'pi-ina219':
+        import Adafruit_GPIO.I2C as I2C
+        return I2C.get_i2c_device(address, busnum=busnum, i2c_interface=None if bus is None else lambda busnum: bus)
+    if backend == 'smbus':
+        return SMBusDevice(address, 1 if busnum is None else busnum, bus)
+    if backend == 'adafruit':
+        return BlinkaDevice(address, 1 if busnum is None else busnum, bus)
+    raise ValueError('backend must be one of {0}'.format(BACKENDS))
+
+def fastest(address, busnum=None, backends=BACKENDS, n=50, buses=None, logger=None):
+    ''' Time n bus voltage register reads (read only, the board is not touched) through each installed backend.
+    Returns (fastest name, {name: us per read}). buses = {name: bus object} for open_device, ie simulated '''
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    buses = buses or {}
+    times = {}
+    for name in [name for name in backends if name in buses or name in available((name,))]:
+        try:
+            device = open_device(name, address, busnum, buses.get(name))
+            device.readU16BE(REG_BUSVOLTAGE)            # First read can pay for opening the bus
+            t0 = perf_counter()
+            for _ in range(n):
+                device.readU16BE(REG_BUSVOLTAGE)
+            times[name] = (perf_counter() - t0) / n * 10**6
+        except (OSError, ImportError, RuntimeError, ValueError) as e:
+            logger.warning('backend {0} can not read ina219 at {1}: {2}'.format(name, hex(address), e))
+    if not times:
+        raise OSError('no backend could read ina219 at {0} on bus {1}'.format(hex(address), busnum))
+    return min(times, key=times.get), times
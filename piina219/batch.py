@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+'''
+Pack many samples from one or many devices into one MQTT message.
+
+Two encodings, both decoded by the "parse MQTT JSON str" function in node-red-flow:
+'json'   columnar JSON {"t0": epoch sec, "dev": [names], "d": [device index per row], "dt": [us from t0],
+         "Vbusf": [..], "IbusAf": [..], "PowerWf": [..]}   missing values are null
+'struct' packed little endian binary
+         header  '<2sBBdHBB'  magic b'IN', version 1, flags 0, t0 epoch sec (float64), rows, nfields, ndevices
+                 then nfields field names and ndevices device names, each a u8 length + ascii
+         rows    '<BI' + 'f' * nfields   device index, us from t0, one float32 per field (nan if missing)
+         ~ 5 + 4*nfields bytes per sample vs ~60 bytes of JSON
+
+batcher = BatchPublisher(mqtt_client, 'pi2nred/ina219A/piTest1', encoding='struct', max_samples=100, max_ms=1000)
+batcher.add('ina219A', time.time(), {'Vbusf': 5.0, 'IbusAf': 0.12, 'PowerWf': 0.6})   # publishes when full
+batcher.poll()                        # call periodically, publishes when max_ms has passed since the first sample
+
+BatchPublisher keeps queued samples in preallocated array('d') columns (one per field) rather than a tuple and a
+dict per sample, so a batch being filled holds no Python containers for the garbage collector to walk, and
+encoding packs whole columns at once instead of row by row.
+'''
+
+import json, struct, logging, sys
+from array import array
+from math import nan
+from time import time
+
+MAGIC = b'IN'
+VERSION = 1
+HEADER = struct.Struct('<2sBBdHBB')
+ROWHEAD = struct.Struct('<BI')
+MAX_ROWS = 0xFFFF                     # rows is a u16 in the struct header
+MAX_DT = 0xFFFFFFFF                   # dt is a u32 of us, a batch spans at most ~4295 sec
+
+def _names(names):
+    out = bytearray()
+    for name in names:
+        raw = name.encode('ascii')
+        out.append(len(raw))
+        out += raw
+    return bytes(out)
+
+def _lanes(buf, offset, stride, raw, width):
+    ''' Scatter raw (width bytes per row) into every stride bytes of buf from offset, one byte lane at a time '''
+    for b in range(width):
+        buf[offset + b::stride] = raw[b::width]
+
+def _le(col):
+    ''' Little endian bytes of an array '''
+    if sys.byteorder == 'big':
+        col = array(col.typecode, col)
+        col.byteswap()
+    return col.tobytes()
+
+def encode(rows, encoding='struct'):
+    ''' rows = [(device, t epoch sec, {key: value}), ..] oldest first. Returns bytes (struct) or str (json) '''
+    devices, fields = [], []
+    for device, t, values in rows:
+        if device not in devices:
+            devices.append(device)
+        for key in values:
+            if key not in fields:
+                fields.append(key)
+    index = {device: i for i, device in enumerate(devices)}
+    tcol = array('d', [t for device, t, values in rows])
+    dev = bytearray([index[device] for device, t, values in rows])
+    cols = [array('d', [nan if values.get(key) is None else values[key] for device, t, values in rows]) for key in fields]
+    return encode_columns(tcol, dev, devices, fields, cols, len(rows), encoding)
+
+def encode_columns(t, dev, devices, fields, cols, n, encoding='struct'):
+    ''' encode() from columns: first n of t (epoch sec), dev (device index per row) and cols (one array('d') per
+    field, nan = missing). Whole columns are converted at once, nothing is built per row for struct '''
+    t0 = t[0]
+    dt = array('I', [min(max(int(round((t[i] - t0) * 10**6)), 0), MAX_DT) for i in range(n)])   # Clock stepped back = 0
+    if encoding == 'json':
+        out = {'t0': t0, 'dev': list(devices), 'd': list(dev[:n]), 'dt': dt.tolist()}
+        for key, col in zip(fields, cols):
+            if key.endswith('i'):         # Integer fields stay integers in the JSON
+                out[key] = [int(x) if x == x else None for x in col[:n]]
+            else:
+                out[key] = [x if x == x else None for x in col[:n]]
+        return json.dumps(out, separators=(',', ':'))
+    stride = ROWHEAD.size + 4 * len(fields)
+    buf = bytearray(n * stride)
+    buf[0::stride] = dev[:n]
+    _lanes(buf, 1, stride, _le(dt), 4)
+    for j, col in enumerate(cols):
+        _lanes(buf, ROWHEAD.size + 4 * j, stride, _le(array('f', col[:n])), 4)
+    return HEADER.pack(MAGIC, VERSION, 0, t0, n, len(fields), len(devices)) + _names(fields) + _names(devices) + bytes(buf)
+
+def decode(payload):
+    ''' Inverse of encode. Returns [(device, t epoch sec, {key: value}), ..] '''
+    if isinstance(payload, (bytes, bytearray)) and payload[:2] == MAGIC:
+        magic, version, flags, t0, count, nfields, ndevices = HEADER.unpack_from(payload, 0)
+        offset = HEADER.size
+        names = []
+        for _ in range(nfields + ndevices):
+            length = payload[offset]
+            names.append(payload[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+        fields, devices = names[:nfields], names[nfields:]
+        row = struct.Struct('<BI' + 'f' * nfields)
+        rows = []
+        for device, dt, *values in row.iter_unpack(payload[offset:offset + count * row.size]):
+            rows.append((devices[device], t0 + dt / 10**6, {key: value for key, value in zip(fields, values) if value == value}))
+        return rows
+    obj = json.loads(payload)
+    fields = [key for key in obj if key not in ('t0', 'dev', 'd', 'dt')]
+    return [(obj['dev'][d], obj['t0'] + dt / 10**6, {key: obj[key][i] for key in fields if obj[key][i] is not None})
+            for i, (d, dt) in enumerate(zip(obj['d'], obj['dt']))]
+
+class BatchPublisher:
+    ''' Collects samples for one topic and publishes them as one message every max_samples or max_ms '''
+
+    def __init__(self, client, topic, encoding='struct', max_samples=100, max_ms=1000, qos=0, logger=None):
+        if not 1 <= max_samples <= MAX_ROWS:
+            raise ValueError('max_samples must be 1 to {0}'.format(MAX_ROWS))
+        self.client = client
+        self.topic = topic
+        self.encoding = encoding
+        self.max_samples = max_samples
+        self.max_ms = max_ms
+        self.qos = qos
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.pending = 0                  # Samples queued
+        self.messages = 0
+        self.samples = 0
+        self.bytes = 0
+        self._size = 0                    # Rows the columns hold. Grows if max_samples is raised at runtime
+        self._t = array('d')
+        self._dev = bytearray()
+        self._devices = []                # Devices in this batch, in order of first sample
+        self._devindex = {}
+        self._fields = []                 # Fields in this batch, in order of first sample
+        self._active = {}                 # field: column, for this batch
+        self._cols = {}                   # field: column, every field seen (reused by later batches)
+        self._grow(max_samples)
+
+    def _grow(self, size):
+        extra = size - self._size
+        self._t.extend(array('d', bytes(8 * extra)))
+        self._dev.extend(bytes(extra))
+        for col in self._cols.values():
+            col.extend(array('d', [nan]) * extra)
+        self._size = size
+
+    def add(self, device, t, values):
+        ''' Queue one sample. values is copied into the columns so the caller can keep reusing its dict '''
+        if self.pending and not 0 <= (t - self._t[0]) * 10**6 <= MAX_DT:
+            self.flush()                  # Wall clock stepped back (ie NTP) or the batch would span too long, start a new one
+        i = self.pending
+        if i >= self._size:
+            self._grow(max(self.max_samples, i + 1))
+        d = self._devindex.get(device)
+        if d is None:
+            d = self._devindex[device] = len(self._devices)
+            self._devices.append(device)
+        self._dev[i] = d
+        self._t[i] = t
+        active = self._active
+        for key in values:
+            col = active.get(key)
+            if col is None:
+                col = self._cols.get(key)
+                if col is None:
+                    col = self._cols[key] = array('d', [nan]) * self._size
+                active[key] = col
+                self._fields.append(key)
+            value = values[key]
+            col[i] = nan if value is None else value
+        self.pending = i + 1
+        if self.pending >= self.max_samples:
+            self.flush()
+
+    def poll(self):
+        ''' Publish if the oldest queued sample is older than max_ms '''
+        if self.pending and (time() - self._t[0]) * 1000 >= self.max_ms:
+            self.flush()
+
+    def flush(self):
+        n = self.pending
+        if not n:
+            return
+        try:
+            payload = encode_columns(self._t, self._dev, self._devices, self._fields, [self._active[key] for key in self._fields],
+                                     n, self.encoding)
+            self.client.publish(self.topic, payload, self.qos)
+            self.messages += 1
+            self.samples += n
+            self.bytes += len(payload)
+            self.logger.debug('%s batch of %d samples, %d bytes', self.topic, n, len(payload))
+        finally:                          # A batch that failed is dropped, not retried by every later add()
+            blank = array('d', [nan]) * n
+            for col in self._active.values():   # Back to all nan (missing) for the next batch
+                col[:n] = blank
+            self._active.clear()
+            self._fields.clear()
+            self._devices.clear()
+            self._devindex.clear()
+            self.pending = 0
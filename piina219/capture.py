@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+Full rate capture of raw INA219 registers to a memory mapped binary file, and replay.
+
+Catches load transients that mqtt can't carry live. Each read() of a PiINA219 with .capture set is one record.
+
+file    64 byte header  '<8sHHdI' magic b'INA219CP', version 1, record size 32, created epoch sec, records committed
+        then records, preallocated in chunks of zeros and truncated to size on close
+record  32 bytes '<BBBBIdHhHhfI'
+        marker 0xA5, address, gain, flags (bit0 = current/power lost to overflow), sequence no,
+        t epoch sec, bus, current, power, shunt registers, current lsb (A/bit, power lsb is 20x), crc32 of the first 28 bytes
+        32 bytes divides the 512 byte sector, so a record never straddles two sectors
+Crash safe: the header count is updated on flush(). Opening again scans on from there while the marker and crc are good,
+so records written after the last flush are kept and a torn record ends the capture.
+
+cap = Capture('/home/pi/load.cap')    # new file or append to an existing one
+ina219A.capture = cap                 # every read is recorded (Sampler for full rate)
+cap.flush()                           # every second or so (msync + header count)
+cap.close()
+
+for address, t, volts, amps, watts, mVshunt in Capture('/home/pi/load.cap', mode='r').samples():
+    ...
+replay = Replay('/home/pi/load.cap', speed=10)     # 10x faster than captured
+replay.due()                          # [(address, t, volts, amps, watts, mVshunt), ..] whose time has come
+
+$ python3 -m piina219.capture load.cap       # summary per address
+'''
+
+import os, mmap, struct, threading, logging
+from zlib import crc32
+from time import monotonic
+
+MAGIC = b'INA219CP'
+VERSION = 1
+HEADER = struct.Struct('<8sHHdI')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<BBBBIdHhHhfI')
+MARKER = 0xA5
+LOST = 0x01
+
+def decode(record):
+    ''' Raw record tuple to (address, t, volts, amps, watts, mVshunt). amps/watts None if lost to overflow '''
+    marker, address, gain, flags, seq, t, bus, current, power, shunt, lsb, crc = record
+    volts = (bus >> 3) * 4 / 1000
+    if flags & LOST:
+        return address, t, volts, None, None, shunt * 0.01
+    return address, t, volts, current * lsb, power * lsb * 20, shunt * 0.01
+
+class Capture:
+
+    def __init__(self, path, mode='a', chunk=65536, logger=None):
+        self.path = path
+        self.mode = mode                  # 'a' append (creates the file), 'r' read only
+        self.chunk = chunk                # Records added to the file each time it fills up
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.lock = threading.Lock()      # Samplers on several boards can share one capture
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+        if mode == 'r':
+            self._file = open(path, 'rb')
+        else:
+            self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            if mode == 'r':
+                raise ValueError('{0} is not a capture'.format(path))
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, 0.0, 0).ljust(HEADER_SIZE, b'\0'))
+            self._file.truncate(HEADER_SIZE + chunk * RECORD.size)
+        self._map()
+        magic, version, size, self.created, committed = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or size != RECORD.size:
+            raise ValueError('{0} is not a version {1} capture'.format(path, VERSION))
+        self.count = self._scan(committed)
+        if committed != self.count:
+            self.logger.info('capture {0}: {1} records after the last flush recovered'.format(path, self.count - committed))
+
+    def _map(self):
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ if self.mode == 'r' else mmap.ACCESS_WRITE)
+        self.capacity = (len(self._mm) - HEADER_SIZE) // RECORD.size
+
+    def _valid(self, index):
+        offset = HEADER_SIZE + index * RECORD.size
+        return self._mm[offset] == MARKER and \
+            crc32(self._mm[offset:offset + RECORD.size - 4]) == struct.unpack_from('<I', self._mm, offset + RECORD.size - 4)[0]
+
+    def _scan(self, committed):
+        ''' Number of good records: the committed ones plus any written after the last flush '''
+        count = min(committed, self.capacity)
+        while count < self.capacity and self._valid(count):
+            count += 1
+        return count
+
+    def append(self, t, address, busreg, currentreg, powerreg, shuntreg, current_lsb, gain=0, lost=False):
+        ''' One raw sample. Signature follows PiINA219.read() '''
+        with self.lock:
+            if self.count >= self.capacity:
+                self._grow()
+            offset = HEADER_SIZE + self.count * RECORD.size
+            RECORD.pack_into(self._mm, offset, MARKER, address, gain, LOST if lost else 0, self.count & 0xFFFFFFFF,
+                             t, busreg, currentreg, powerreg, shuntreg, current_lsb, 0)
+            struct.pack_into('<I', self._mm, offset + RECORD.size - 4, crc32(self._mm[offset:offset + RECORD.size - 4]))
+            if self.count == 0:
+                struct.pack_into('<d', self._mm, 12, t)    # created = first sample
+            self.count += 1
+
+    def _grow(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.truncate(HEADER_SIZE + (self.capacity + self.chunk) * RECORD.size)
+        self._map()
+
+    def flush(self):
+        ''' Write the record count to the header and msync. Records up to here survive a power loss '''
+        if self.mode == 'r':
+            return
+        with self.lock:
+            struct.pack_into('<I', self._mm, 20, self.count)
+            self._mm.flush()
+
+    def __len__(self):
+        return self.count
+
+    def records(self, start=0):
+        ''' Raw record tuples (see RECORD) from index start '''
+        for index in range(start, self.count):
+            yield RECORD.unpack_from(self._mm, HEADER_SIZE + index * RECORD.size)
+
+    def samples(self, start=0):
+        ''' Decoded (address, t, volts, amps, watts, mVshunt) '''
+        for record in self.records(start):
+            yield decode(record)
+
+    def close(self):
+        if self._mm is None:
+            return
+        self.flush()
+        self._mm.close()
+        self._mm = None
+        if self.mode != 'r':                  # Drop the unused preallocated tail
+            self._file.truncate(HEADER_SIZE + self.count * RECORD.size)
+        self._file.close()
+
+class Replay:
+    ''' Plays a capture back against the clock, speed times faster than it was recorded '''
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.capture = Capture(path, mode='r')
+        self.speed = speed
+        self.loop = loop                  # Start over at the end
+        self.sent = 0
+        self._start()
+
+    def _start(self):
+        self._samples = self.capture.samples()
+        self._next = next(self._samples, None)
+        self._t0 = self._next[1] if self._next is not None else 0.0
+        self._clock0 = monotonic()
+
+    def done(self):
+        return self._next is None
+
+    def due(self, now=None):
+        ''' Samples whose (scaled) capture time has passed since the replay started '''
+        now = monotonic() if now is None else now
+        until = self._t0 + (now - self._clock0) * self.speed
+        out = []
+        while self._next is not None and self._next[1] <= until:
+            out.append(self._next)
+            self._next = next(self._samples, None)
+            if self._next is None and self.loop:
+                self._start()
+                break
+        self.sent += len(out)
+        return out
+
+    def close(self):
+        self.capture.close()
+
+if __name__ == "__main__":
+    import sys
+    cap = Capture(sys.argv[1], mode='r')
+    devices = {}
+    for address, t, volts, amps, watts, mVshunt in cap.samples():
+        stats = devices.setdefault(address, {'n': 0, 'first': t, 'last': t, 'lost': 0, 'maxA': 0.0})
+        stats['n'] += 1
+        stats['last'] = t
+        if amps is None:
+            stats['lost'] += 1
+        else:
+            stats['maxA'] = max(stats['maxA'], abs(amps))
+    print('{0}: {1} records'.format(sys.argv[1], len(cap)))
+    for address, stats in sorted(devices.items()):
+        seconds = stats['last'] - stats['first']
+        print('  {0}: {1} samples over {2:.3f}s ({3:.0f}/s) max {4:.3f}A lost {5}'.format(
+            hex(address), stats['n'], seconds, stats['n'] / seconds if seconds else 0, stats['maxA'], stats['lost']))
+    cap.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+'''
+Find the INA219s on one or more i2c buses instead of hard coding addresses (or running i2cdetect).
+
+Every address in 0x40-0x4F is probed with reads only, nothing is written, so other parts at those addresses
+(INA226/INA260, PCA9685 etc) are left alone. An INA219 is recognised by register bits that always read the same:
+config        bit 15 (reset, self clearing) and bit 14 (unused) read 0
+shunt         the top 1-4 bits are sign extension for the PGA gain in config (4 at /1 .. 1 at /8)
+bus voltage   bit 2 (unused) reads 0
+calibration   bit 0 (unused) reads 0
+0xFE          not the TI manufacturer id 0x5449 that the INA226/INA230/INA260 answer with
+An empty address fails on the first read, so a full bus costs about 16 NACKs plus 5 reads per board.
+Buses are probed in parallel, one thread each.
+
+The result can be cached. Every address is still probed each time (an empty one is a single NACK), so a board
+added to the bus is found without deleting the cache. The cache records what each bus had: a change (board added
+or gone) is logged and written back, an unchanged bus leaves the file alone. rescan=True or a cache older than
+maxage seconds ignores it.
+
+found = discover([1, 3], cache='/home/pi/ina219-discover.json')   # [(busnum, address), ..]
+device_name(1, 0x41)               # 'ina219B' (bus 1), 'ina219B_bus3' on bus 3
+discover([1], i2c={1: SimI2CBus(1)})                                # simulated bus (see simbus.py)
+
+$ python3 -m piina219.discovery 1 3       # list the INA219s on buses 1 and 3
+'''
+
+import json, os, logging
+from time import time, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+ADDRESSES = range(0x40, 0x50)
+TI_MANUFACTURER_ID = 0x5449
+
+def probe(device):
+    ''' True if the i2c device (readU16BE) looks like an INA219. OSError = nothing at that address '''
+    config = device.readU16BE(0x00)
+    if config & 0xC000:
+        return False
+    signbits = 4 - ((config >> 11) & 0x03)
+    shunt = device.readU16BE(0x01) >> (16 - signbits)
+    if shunt not in (0, (1 << signbits) - 1):
+        return False
+    if device.readU16BE(0x02) & 0x0004 or device.readU16BE(0x05) & 0x0001:
+        return False
+    try:
+        return device.readU16BE(0xFE) != TI_MANUFACTURER_ID
+    except OSError:                       # No such register is fine, the INA219 has none past 0x05
+        return True
+
+def device_name(busnum, address, prefix='ina219'):
+    ''' ina219A for 0x40 .. ina219P for 0x4F. Buses other than the default (1) add _bus<n> '''
+    name = prefix + chr(ord('A') + address - ADDRESSES[0])
+    return name if busnum in (None, 1) else '{0}_bus{1}'.format(name, busnum)
+
+def _scan(i2c, busnum, addresses, logger):
+    found = []
+    for address in addresses:
+        try:
+            if probe(i2c.get_i2c_device(address, busnum=busnum)):
+                found.append(address)
+            else:
+                logger.info('bus {0} {1}: answers but is not an INA219'.format(busnum, hex(address)))
+        except OSError:
+            pass
+    return found
+
+def discover(buses=(1,), i2c=None, cache=None, rescan=False, maxage=None, logger=None):
+    ''' [(busnum, address), ..] of the INA219s on the buses, sorted. i2c is Adafruit_GPIO.I2C by default,
+    or {busnum: object with get_i2c_device(address, busnum)} ie a SimI2CBus '''
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    if i2c is None:
+        import Adafruit_GPIO.I2C as adafruit_i2c
+        i2c = {busnum: adafruit_i2c for busnum in buses}
+    cached = {}
+    if cache is not None and not rescan and os.path.exists(cache):
+        try:
+            with open(cache) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        for busnum in buses:
+            entry = entries.get(str(busnum))
+            if entry is not None and (maxage is None or time() - entry['time'] < maxage):
+                cached[busnum] = entry['addresses']
+    t0 = perf_counter()
+
+    def run(busnum):
+        found = _scan(i2c[busnum], busnum, ADDRESSES, logger)
+        if busnum in cached:
+            if found == cached[busnum]:
+                return busnum, found, 'cached'
+            logger.info('bus {0}: boards changed since the cache, added {1} gone {2}'.format(busnum,
+                        [hex(a) for a in found if a not in cached[busnum]], [hex(a) for a in cached[busnum] if a not in found]))
+        return busnum, found, 'scanned'
+
+    with ThreadPoolExecutor(max_workers=len(buses), thread_name_prefix='discover') as pool:
+        results = list(pool.map(run, buses))
+    for busnum, found, how in results:
+        logger.info('bus {0}: INA219 at {1} ({2})'.format(busnum, [hex(address) for address in found] or 'none', how))
+    logger.info('discovery took {0:.1f}ms'.format((perf_counter() - t0) * 1000))
+    if cache is not None and any(how == 'scanned' for busnum, found, how in results):
+        try:
+            with open(cache) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        for busnum, found, how in results:
+            if how == 'scanned':
+                entries[str(busnum)] = {'addresses': found, 'time': time()}
+        with open(cache + '.tmp', 'w') as f:      # .tmp then rename so a crash never leaves half a file
+            json.dump(entries, f, indent=1)
+        os.replace(cache + '.tmp', cache)
+    return sorted((busnum, address) for busnum, found, how in results for address in found)
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    for busnum, address in discover([int(arg) for arg in sys.argv[1:]] or [1]):
+        print('bus {0} {1} {2}'.format(busnum, hex(address), device_name(busnum, address)))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+'''
+Coulomb counter. Integrates current and power into amp-hours and watt-hours at the full sample rate,
+so only the running totals need to go over mqtt.
+
+Trapezoid rule on monotonic (perf_counter) timestamps. Charge in (positive current) and out (negative current)
+are kept apart for batteries. The INA219 power register has no sign so power takes the sign of the current.
+Gaps longer than maxgap (missed samples, paused sampler) and samples lost to a current overflow
+(amps None/nan) are not integrated. Their time is counted in gap_s/overflow_s so a total known to be
+short can be spotted.
+Totals are saved to a JSON file (write to .tmp then rename, so a crash never leaves half a file) and
+loaded again on start.
+
+meter = Integrator('/home/pi/energy-ina219A.json')
+sampler = Sampler(ina219A, onsample=meter.add)   # every sample is integrated
+meter.totals()      # {'AhNetf':.., 'AhInf':.., 'AhOutf':.., 'WhNetf':.., 'WhInf':.., 'WhOutf':.., 'gapsecf':..}
+meter.save()        # call every minute or so and on exit
+'''
+
+import os, json, threading, logging
+from time import time
+
+class Integrator:
+
+    FIELDS = ('Ah_in', 'Ah_out', 'Wh_in', 'Wh_out', 'seconds', 'gap_s', 'overflow_s')
+
+    def __init__(self, statefile=None, maxgap=1.0, logger=None):
+        self.statefile = statefile
+        self.maxgap = maxgap              # Longer intervals between samples are not integrated
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.state = dict.fromkeys(self.FIELDS, 0.0)
+        self.state['since'] = time()      # Wall time the totals started from
+        self._last = None                 # (t, amps, watts) of the previous good sample
+        if statefile is not None and os.path.exists(statefile):
+            with open(statefile) as f:
+                self.state.update(json.load(f))
+            self.logger.info('energy totals loaded from {0}: {1:.4f}Ah {2:.4f}Wh'.format(
+                statefile, self.state['Ah_in'] - self.state['Ah_out'], self.state['Wh_in'] - self.state['Wh_out']))
+
+    def add(self, t, volts, amps, watts):
+        ''' One sample at perf_counter time t. Signature matches Sampler onsample '''
+        if amps is None or amps != amps:           # Overflow. Current unknown until the next good sample
+            if self._last is not None:
+                with self.lock:
+                    self.state['overflow_s'] += t - self._last[0]
+            self._last = None if self._last is None else (t, None, None)
+            return
+        if watts is None or watts != watts:
+            watts = 0.0
+        watts = -watts if amps < 0 else watts
+        last = self._last
+        self._last = (t, amps, watts)
+        if last is None:
+            return
+        dt = t - last[0]
+        with self.lock:
+            if last[1] is None:                    # First good sample after an overflow
+                self.state['overflow_s'] += dt
+                return
+            if dt > self.maxgap or dt <= 0:
+                self.state['gap_s'] += max(dt, 0)
+                return
+            ah = (last[1] + amps) * dt / 7200      # mean amps * hours
+            wh = (last[2] + watts) * dt / 7200
+            self.state['seconds'] += dt
+            if ah >= 0:
+                self.state['Ah_in'] += ah
+            else:
+                self.state['Ah_out'] -= ah
+            if wh >= 0:
+                self.state['Wh_in'] += wh
+            else:
+                self.state['Wh_out'] -= wh
+
+    def mark_gap(self):
+        ''' Next sample starts fresh (ie after sleep/wake) instead of integrating across the pause '''
+        self._last = None
+
+    def totals(self, digits=6):
+        with self.lock:
+            s = dict(self.state)
+        return {'AhNetf': round(s['Ah_in'] - s['Ah_out'], digits), 'AhInf': round(s['Ah_in'], digits),
+                'AhOutf': round(s['Ah_out'], digits), 'WhNetf': round(s['Wh_in'] - s['Wh_out'], digits),
+                'WhInf': round(s['Wh_in'], digits), 'WhOutf': round(s['Wh_out'], digits),
+                'gapsecf': round(s['gap_s'] + s['overflow_s'], 3)}
+
+    def reset(self):
+        with self.lock:
+            self.state = dict.fromkeys(self.FIELDS, 0.0)
+            self.state['since'] = time()
+        self.save()
+
+    def save(self):
+        if self.statefile is None:
+            return
+        with self.lock:
+            s = dict(self.state)
+        with open(self.statefile + '.tmp', 'w') as f:
+            json.dump(s, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.statefile + '.tmp', self.statefile)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+'''
+Direct InfluxDB sink. Readings are encoded to line protocol here and written over HTTP in gzip batches, so
+historical storage no longer goes through mqtt and a JSON parse plus one write per message in node-red.
+
+Points are stored like the node-red flow stores them: measurement ina219, keys ending in f as float fields,
+keys ending in i as integer fields (anything else and nan/None are left out), integer timestamps in precision
+units. Tags are set per series, ie {'location': 'pi2nred', 'device': lvl2, 'publvl3': publvl3}.
+
+add() only appends a line. poll() hands the batch to a writer thread once it holds max_points or is max_ms old.
+The writer gzips and POSTs it (1.x /write?db= or 2.x /api/v2/write?org=&bucket=). While influx can't be reached
+(connection errors, 5xx, 429) batches are kept in memory, up to max_batches, and retried oldest first with
+backoff (retry_min doubling up to retry_max sec). Past max_batches the oldest go to a Spool on disk when one is
+given (sent after the memory backlog) or are dropped. A batch influx rejects (other 4xx, ie bad line protocol)
+is logged and dropped, retrying would not help. A batch sent twice after a partial failure does no harm,
+influx keeps one point per series and timestamp.
+
+sink = InfluxSink('http://127.0.0.1:8086', db='ina219')      # 2.x: bucket='ina219', org='home', token='..'
+series = sink.series({'location': 'pi2nred', 'device': 'ina219A', 'publvl3': 'pi2Test1'})
+sink.add(series, time(), {'Vbusf': 5.01, 'IbusAf': 0.12})
+sink.poll()               # scheduler job, every 0.1s or so
+sink.stats()              # {'points':.., 'written':.., 'batches':.., 'bytes':.., 'failures':.., 'backlog':.., 'dropped':..}
+sink.close()              # writes what is left (up to timeout)
+'''
+
+import gzip, logging, threading, queue
+from math import isnan
+from time import monotonic
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+
+PRECISION = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}
+V1_PRECISION = {'s': 's', 'ms': 'ms', 'us': 'u', 'ns': 'ns'}   # 1.x /write spells microseconds u (400 on 'us')
+
+_MEASUREMENT_ESCAPE = str.maketrans({',': r'\,', ' ': r'\ '})
+_TAG_ESCAPE = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ '})
+
+def series(measurement, tags=None):
+    ''' Escaped 'measurement,tag=value,..' start of a line. Tags sorted by key, as influx prefers '''
+    head = measurement.translate(_MEASUREMENT_ESCAPE)
+    for key, value in sorted((tags or {}).items()):
+        if value is not None and value != '':
+            head += ',{0}={1}'.format(str(key).translate(_TAG_ESCAPE), str(value).translate(_TAG_ESCAPE))
+    return head
+
+def fields(data):
+    ''' Line protocol field set of a reading. f keys are floats, i keys integers, nan/None skipped. '' if none left '''
+    out = []
+    for key, value in data.items():
+        if value is None:
+            continue
+        if key.endswith('f'):
+            value = float(value)
+            if isnan(value):
+                continue
+            out.append('{0}={1!r}'.format(key.translate(_TAG_ESCAPE), value))
+        elif key.endswith('i'):
+            out.append('{0}={1}i'.format(key.translate(_TAG_ESCAPE), int(value)))
+    return ','.join(out)
+
+_STOP = object()
+
+class InfluxSink:
+
+    def __init__(self, url, db=None, bucket=None, org=None, token=None, username=None, password=None,
+                 measurement='ina219', precision='us', max_points=5000, max_ms=5000, max_batches=100, spool=None,
+                 retry_min=1.0, retry_max=60.0, timeout=10.0, compresslevel=6, logger=None):
+        if precision not in PRECISION:
+            raise ValueError('precision must be one of {0}'.format(tuple(PRECISION)))
+        if (db is None) == (bucket is None):
+            raise ValueError('give db (influx 1.x) or bucket (2.x)')
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.measurement = measurement
+        self.precision = precision
+        self.max_points = max_points
+        self.max_ms = max_ms
+        self.max_batches = max_batches    # Batches held in memory while influx is down. Older ones spill to the spool
+        self.spool = spool                # Spool (piina219/spool.py) for batches past max_batches, None = drop them
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.timeout = timeout
+        self.compresslevel = compresslevel
+        if bucket is not None:
+            params = {'org': org or '', 'bucket': bucket, 'precision': precision}
+            self.write_url = url.rstrip('/') + '/api/v2/write?' + urlencode(params)
+        else:
+            params = {'db': db, 'precision': V1_PRECISION[precision]}
+            if username is not None:
+                params.update(u=username, p=password or '')
+            self.write_url = url.rstrip('/') + '/write?' + urlencode(params)
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8', 'Content-Encoding': 'gzip'}
+        if token is not None:
+            self.headers['Authorization'] = 'Token ' + token
+        self._scale = PRECISION[precision]
+        self.points = 0                   # Lines added
+        self.written = 0                  # Points influx took
+        self.batches = 0
+        self.bytes = 0                    # gzip bytes sent
+        self.raw_bytes = 0                # Line protocol bytes before gzip
+        self.failures = 0                 # Failed write attempts (retried)
+        self.rejected = 0                 # Points in batches influx refused (4xx), not retried
+        self.dropped = 0                  # Points lost to max_batches with no spool
+        self.spooled = 0                  # Points moved to the spool
+        self._lines = []
+        self._t_first = 0.0
+        self._backlog = []                # [(points, gzip body)] oldest first, writer thread only
+        self._backlog_points = 0
+        self._queue = queue.Queue()
+        self._close_timeout = 5.0
+        self._thread = threading.Thread(target=self._run, name='influx', daemon=True)
+        self._thread.start()
+
+    def series(self, tags=None):
+        ''' Line start for one set of tags, made once per device and passed to add() '''
+        return series(self.measurement, tags)
+
+    def add(self, series, t, data):
+        ''' One point at epoch time t (sec). Returns False if data has no f/i fields to write '''
+        fieldset = fields(data)
+        if not fieldset:
+            return False
+        if not self._lines:
+            self._t_first = monotonic()
+        self._lines.append('{0} {1} {2}'.format(series, fieldset, int(t * self._scale)))
+        self.points += 1
+        if len(self._lines) >= self.max_points:
+            self.flush()
+        return True
+
+    def poll(self):
+        ''' Hand the batch to the writer if it is max_ms old. Call every 0.1s or so '''
+        if self._lines and (monotonic() - self._t_first) * 1000 >= self.max_ms:
+            self.flush()
+
+    def flush(self):
+        ''' Hand what is collected to the writer now '''
+        if self._lines:
+            lines, self._lines = self._lines, []
+            self._queue.put(lines)
+
+    def _run(self):
+        ''' Writer thread: gzip batches, POST them oldest first, back off while influx is down '''
+        backoff = 0.0
+        retry_at = 0.0
+        deadline = None                   # Set once close() was called
+        while True:
+            if deadline is not None:
+                wait = min(max(retry_at - monotonic(), 0.0), max(deadline - monotonic(), 0.0))
+            elif self._backlog or (self.spool is not None and self.spool):
+                wait = max(retry_at - monotonic(), 0.0)
+            else:
+                wait = None
+            items = []
+            try:
+                items.append(self._queue.get(timeout=wait))
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            for item in items:
+                if item is _STOP:
+                    deadline = monotonic() + self._close_timeout
+                else:
+                    try:
+                        self._hold(item)
+                    except Exception:     # Never let one batch end the writer (flush() would queue with nobody reading)
+                        self.logger.exception('influx batch of {0} points could not be held, dropped'.format(len(item)))
+                        self.dropped += len(item)
+            if monotonic() >= retry_at:
+                try:
+                    sent = self._send_backlog()
+                except Exception:
+                    self.logger.exception('influx writer error, retrying')
+                    self.failures += 1
+                    sent = False
+                if sent:
+                    backoff = 0.0
+                else:
+                    backoff = min(max(backoff * 2, self.retry_min), self.retry_max)
+                    retry_at = monotonic() + backoff
+            if deadline is not None and (not self._backlog or monotonic() >= deadline):
+                try:
+                    self._spill(len(self._backlog))
+                except Exception:
+                    self.logger.exception('influx backlog could not be spooled on close')
+                return
+
+    def _hold(self, lines):
+        body = '\n'.join(lines).encode()
+        self.raw_bytes += len(body)
+        self._backlog.append((len(lines), gzip.compress(body, self.compresslevel)))
+        self._backlog_points += len(lines)
+        self._spill(len(self._backlog) - self.max_batches)
+
+    def _spill(self, count):
+        ''' Move the oldest count batches out of memory, to the spool if there is one '''
+        for points, body in self._backlog[:max(count, 0)]:
+            if self.spool is not None:
+                self.spool.put('influx/{0}'.format(points), body)
+                self.spooled += points
+            else:
+                self.dropped += points
+            self._backlog_points -= points
+        if count > 0:
+            self.logger.warning('influx backlog full, {0} batches {1}'.format(count, 'spooled' if self.spool is not None else 'dropped'))
+            del self._backlog[:count]
+
+    def _send_backlog(self):
+        ''' Send memory backlog then spooled batches. False on the first failure (the rest wait for the retry) '''
+        while self._backlog:
+            points, body = self._backlog[0]
+            if not self._post(points, body):
+                return False
+            self._backlog.pop(0)
+            self._backlog_points -= points
+        if self.spool is not None:
+            while self.spool:
+                for t, topic, body in self.spool.get(10):
+                    try:
+                        points = int(topic.split('/')[1])
+                    except (ValueError, IndexError):   # Not written by _spill. Sent anyway, points unknown
+                        self.logger.warning('influx spool record with topic {0!r}'.format(topic))
+                        points = 0
+                    if not self._post(points, body):
+                        return False
+                self.spool.commit()
+        return True
+
+    def _post(self, points, body):
+        ''' One write. True if it is done with (written or rejected), False to retry later '''
+        try:
+            with urlopen(Request(self.write_url, data=body, headers=self.headers), timeout=self.timeout):
+                pass
+        except HTTPError as e:
+            if e.code < 500 and e.code != 429:
+                self.rejected += points
+                self.logger.error('influx rejected {0} points: {1} {2}'.format(points, e.code, e.read()[:200]))
+                return True
+            self.failures += 1
+            self.logger.warning('influx write failed: {0}, retrying'.format(e.code))
+            return False
+        except (URLError, OSError, HTTPException) as e:   # HTTPException ie RemoteDisconnected, BadStatusLine
+            self.failures += 1
+            self.logger.warning('influx write failed: {0}, retrying'.format(getattr(e, 'reason', e)))
+            return False
+        self.written += points
+        self.batches += 1
+        self.bytes += len(body)
+        return True
+
+    def stats(self):
+        ''' Counters for the metrics. backlog is points waiting in memory (spooled ones are not counted) '''
+        return {'points': self.points, 'written': self.written, 'batches': self.batches, 'bytes': self.bytes,
+                'raw_bytes': self.raw_bytes, 'failures': self.failures, 'rejected': self.rejected, 'dropped': self.dropped,
+                'spooled': self.spooled, 'pending': len(self._lines), 'backlog': self._backlog_points}
+
+    def close(self, timeout=5.0):
+        ''' Write what is collected and stop the writer. Batches still unsent after timeout go to the spool or are dropped '''
+        self.flush()
+        self._close_timeout = timeout
+        self._queue.put(_STOP)
+        self._thread.join(timeout + self.timeout + 1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+Counters and gauges for the acquisition and publish pipeline, with labels (device=, topic=, job=).
+
+Most numbers already exist as plain attributes (PiINA219.acqstats(), BatchPublisher.messages, Job.stats()).
+Those are registered as sources and only read when the metrics are collected, so the sampling loop pays nothing.
+inc()/set() are for events with no counter of their own and cost one dict update under a lock.
+
+Two outputs
+grouped()     {device: {'samplesi': 1200, 'range_errorsi': 0, 'p99_msf': 1.7, ..}, None: {..no device label..}}
+              flat dicts with the node-red f/i key suffix, one mqtt stats message per device
+prometheus()  text exposition format. write(path) replaces the file atomically for the node_exporter textfile collector
+
+metrics = Metrics()
+metrics.source(ina219A.acqstats, counters=True, device='ina219A')     # pulled on collect
+metrics.inc('published', device='ina219A', topic='pi2nred/ina219A/piTest1')
+metrics.set('queue_depth', 3)
+metrics.write('/var/lib/node_exporter/textfile_collector/ina219.prom')
+'''
+
+import os, re, threading, logging
+from math import isnan, isinf
+
+class Metrics:
+
+    def __init__(self, prefix='ina219', logger=None):
+        self.prefix = prefix              # Prometheus name prefix (ina219_samples_total)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.values = {}                  # (name, labels) -> value  set by inc()/set()
+        self.kinds = {}                   # name -> 'counter' or 'gauge'
+        self.sources = []                 # (func, counters, labels) read on collect
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, n=1, **labels):
+        ''' Add n to a counter '''
+        key = (name, self._labels(labels))
+        with self.lock:                   # values and kinds together, collect() may run on another thread
+            self.values[key] = self.values.get(key, 0) + n
+            self.kinds.setdefault(name, 'counter')
+
+    def set(self, name, value, **labels):
+        ''' Set a gauge '''
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.values[key] = value
+            self.kinds.setdefault(name, 'gauge')
+
+    def source(self, func, counters=(), **labels):
+        ''' func() returns {name: number}. counters=True if every name is a counter, or the names that are.
+        The rest are gauges. None values are skipped '''
+        self.sources.append((func, counters, self._labels(labels)))
+
+    def collect(self):
+        ''' [(name, kind, labels tuple, value), ..] '''
+        with self.lock:
+            out = [(name, self.kinds[name], labels, value) for (name, labels), value in self.values.items()]
+        for func, counters, labels in self.sources:
+            try:
+                values = func()
+            except Exception as e:        # A source must never take the stats job down
+                self.logger.warning('metrics source {0} failed: {1}'.format(getattr(func, '__qualname__', func), e))
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    out.append((name, 'counter' if counters is True or name in counters else 'gauge', labels, value))
+        return out
+
+    def grouped(self, by='device'):
+        ''' {label value: {key: value}} for mqtt. Keys get the other label values and an f/i suffix,
+        ie job=flush_batches overruns -> overruns_flush_batchesi. Metrics without the label go under None.
+        The topic label is dropped for metrics that have a device '''
+        out = {}
+        for name, kind, labels, value in self.collect():
+            group = dict(labels).get(by)
+            key = name
+            for label, labelvalue in labels:
+                if label != by and (group is None or label != 'topic'):   # The topic is implied by the device
+                    key += '_' + re.sub(r'\W', '_', str(labelvalue))
+            out.setdefault(group, {})[key + ('i' if isinstance(value, int) else 'f')] = \
+                value if isinstance(value, int) else round(value, 4)
+        return out
+
+    @staticmethod
+    def _number(value):
+        ''' Sample value as prometheus spells it, NaN/+Inf/-Inf for the non-finite floats '''
+        if not isinstance(value, float):
+            return value
+        if isnan(value):
+            return 'NaN'
+        if isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+
+    def prometheus(self):
+        ''' Text exposition format '''
+        series = {}
+        for name, kind, labels, value in self.collect():
+            metric = re.sub(r'\W', '_', '{0}_{1}'.format(self.prefix, name)) + ('_total' if kind == 'counter' else '')
+            series.setdefault((metric, kind), []).append((labels, value))
+        lines = []
+        for (metric, kind), samples in sorted(series.items()):
+            lines.append('# TYPE {0} {1}'.format(metric, kind))
+            for labels, value in samples:
+                text = ','.join('{0}="{1}"'.format(label, str(labelvalue).replace('\\', '\\\\').replace('"', '\\"'))
+                                for label, labelvalue in labels)
+                lines.append('{0}{1} {2}'.format(metric, '{' + text + '}' if text else '', self._number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        ''' Write prometheus() to path via a .tmp file and rename so a scrape never sees half a file '''
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+'''
+Read a whole set of PiINA219 boards once per cycle into one timestamped snapshot.
+
+Boards are grouped by i2c bus (PiINA219.busnum). Each bus is read in its own thread so separate
+/dev/i2c-N buses overlap. Within one bus transactions can't overlap, but conversions can. Boards set up
+with acquire='triggered' are all triggered first, then read in turn, so they convert while the
+bus is busy reading the others instead of each board waiting out its own conversion.
+
+reader = MultiReader(ina219Set)       # {'ina219A': PiINA219(...), 'ina219B': PiINA219(...)}
+snap = reader.read()
+snap.t, snap.duration                 # cycle start (perf_counter) and how long the cycle took
+snap.readings['ina219A']              # Reading(t, volts, amps, watts) or None if the read failed
+reader.close()
+'''
+
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+Reading = namedtuple('Reading', 't volts amps watts')
+Snapshot = namedtuple('Snapshot', 't duration readings')
+
+class MultiReader:
+
+    def __init__(self, ina219Set, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.ina219Set = ina219Set
+        self.buses = {}                   # busnum -> [(device, PiINA219), ..]
+        for device, ina219 in ina219Set.items():
+            self.buses.setdefault(ina219.busnum, []).append((device, ina219))
+        self.errors = 0
+        self.cycles = 0
+        # One worker per bus. A single bus is read inline, no thread hop
+        self._pool = ThreadPoolExecutor(max_workers=len(self.buses), thread_name_prefix='i2cbus') if len(self.buses) > 1 else None
+        for busnum, devices in self.buses.items():
+            self.logger.info('bus {0}: {1}'.format(busnum, [device for device, ina219 in devices]))
+
+    def _read_bus(self, devices):
+        readings = {}
+        for device, ina219 in devices:    # Start every single shot conversion on this bus first
+            if ina219.acquire == 'triggered':
+                ina219.trigger()
+        for device, ina219 in devices:
+            try:
+                volts, amps, watts, mVshunt = ina219.read()
+                readings[device] = Reading(perf_counter(), volts, amps, watts)
+            except OSError as e:
+                self.errors += 1
+                self.logger.warning('{0} read failed: {1}'.format(device, e))
+                readings[device] = None
+        return readings
+
+    def read(self):
+        ''' One cycle over every board. Returns a Snapshot once all buses are done '''
+        t0 = perf_counter()
+        readings = {}
+        if self._pool is None:
+            for devices in self.buses.values():
+                readings.update(self._read_bus(devices))
+        else:
+            for future in [self._pool.submit(self._read_bus, devices) for devices in self.buses.values()]:
+                readings.update(future.result())
+        self.cycles += 1
+        return Snapshot(t0, perf_counter() - t0, readings)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
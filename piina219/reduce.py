@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+Edge reduction between getdata and publish. Decides per device which readings are worth a message.
+
+deadband   {'Vbusf': 0.05, 'IbusAf': 0.005, 'PowerWf': 0.02}  Report by exception. A reading is only published
+           when some key moved more than its deadband from the last published value. Keys not listed publish on any change
+window     seconds. Readings are aggregated over fixed windows and one message per window carries
+           min/max/mean and the last value (IbusAminf, IbusAmaxf, IbusAmeanf, IbusAf). With a deadband as well the
+           window is only published if the min, max, mean or last moved past the deadband (spikes show in min/max)
+heartbeat  seconds. Publish anyway if nothing was sent for this long, so node-red knows the device is alive
+
+reducer = Reducer(deadband={'IbusAf': 0.005}, window=1, heartbeat=60)
+out = reducer.add(time(), ina219.getdata())   # dict to publish or None
+'''
+
+from .sampler import statkey
+
+AGGREGATES = ('min', 'max', 'mean')
+
+class Reducer:
+
+    def __init__(self, deadband=None, window=None, heartbeat=60):
+        self.deadband = deadband or {}
+        self.window = window
+        self.heartbeat = heartbeat
+        self.samples = 0                  # Readings in
+        self.messages = 0                 # Messages out
+        self._last_sent = {}              # Last published value per key
+        self._t_sent = None
+        self._t_window = None             # Start of the current window
+        self._agg = {}                    # key -> [min, max, sum, count, last]
+        self._base = {}                   # Window output key -> reading key (IbusAmaxf -> IbusAf)
+
+    def add(self, t, data):
+        ''' Feed one reading taken at t (sec). Returns the dict to publish or None '''
+        self.samples += 1
+        if self.window is None:
+            return self._gate(t, data)
+        if self._t_window is None:
+            self._t_window = t
+        out = None
+        if t - self._t_window >= self.window:       # This reading starts the next window
+            out = self._close_window(t)
+            self._t_window += self.window * int((t - self._t_window) / self.window)
+        for key, value in data.items():
+            agg = self._agg.get(key)
+            if agg is None:
+                self._agg[key] = [value, value, value, 1, value]
+            else:
+                if value < agg[0]:
+                    agg[0] = value
+                if value > agg[1]:
+                    agg[1] = value
+                agg[2] += value
+                agg[3] += 1
+                agg[4] = value
+        return out
+
+    def flush(self, t):
+        ''' Close the current window early (ie on shutdown). Returns the dict to publish or None '''
+        if self.window is None or not self._agg:
+            return None
+        return self._close_window(t)
+
+    def _close_window(self, t):
+        out = {}
+        for key, (low, high, total, count, last) in self._agg.items():
+            for stat in AGGREGATES:
+                self._base[statkey(key, stat)] = key
+            out[statkey(key, 'min')] = low
+            out[statkey(key, 'max')] = high
+            out[statkey(key, 'mean')] = round(total / count, 4)
+            out[key] = last
+        self._agg = {}
+        return self._gate(t, out)
+
+    def _moved(self, key, value):
+        ''' True if value is past the deadband for key. Window outputs (IbusAmaxf..) use the deadband of IbusAf '''
+        band = self.deadband.get(self._base.get(key, key), 0)
+        last = self._last_sent.get(key)
+        return last is None or abs(value - last) > band
+
+    def _gate(self, t, data):
+        due = self._t_sent is None or (self.heartbeat is not None and t - self._t_sent >= self.heartbeat)
+        if not due and not self.deadband:
+            due = True
+        if not due:
+            due = any(self._moved(key, value) for key, value in data.items())
+        if not due:
+            return None
+        self._last_sent.update(data)
+        self._t_sent = t
+        self.messages += 1
+        return dict(data)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+'''
+Background sampling of a PiINA219 into a fixed size ring buffer.
+
+The sampler thread reads the board as fast as its ADC config allows (one read per shunt+bus conversion)
+and writes timestamped samples into preallocated array('d') columns. Nothing is allocated per sample.
+Consumers pull windowed stats (mean/min/max/rms) or raw slices whenever they want, ie a 1Hz publisher.
+
+sampler = Sampler(ina219A, size=20000)
+sampler.start()
+sampler.ring.stats(seconds=1)         # {'Vbusf': {'n':.., 'mean':.., 'min':.., 'max':.., 'rms':..}, 'IbusAf': {..}, ..}
+sampler.flatstats(seconds=1)          # {'Vbusmeanf':.., 'Vbusminf':.., .., 'IbusAmeanf':..} ready for json/mqtt
+t, cols = sampler.ring.slice(n=500)   # last 500 samples as arrays
+sampler.stop()
+
+Sampler(ina219A, onsample=func) also calls func(t, volts, amps, watts) on every sample, ie energy.Integrator.add
+sampler.call(ina219A.set_adc, 3, 15).result(1)   # runs on the sampler thread between two reads
+'''
+
+import threading, logging
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from math import sqrt, nan
+from time import perf_counter, sleep
+from .Mpiina219 import Sample
+
+STATS = ('mean', 'min', 'max', 'rms')
+
+def statkey(key, stat):
+    ''' IbusAf + mean -> IbusAmeanf. Keeps the trailing type letter node-red uses to parse the field '''
+    if key[-1:] in ('f', 'i'):
+        return key[:-1] + stat + key[-1]
+    return key + stat
+
+class RingBuffer:
+    ''' Fixed size ring of timestamped samples. Time and each field are preallocated array('d') columns.
+    Amps/watts lost to a current overflow are stored as nan and skipped by stats '''
+
+    def __init__(self, size, fields=('Vbusf', 'IbusAf', 'PowerWf')):
+        self.size = size
+        self.fields = tuple(fields)
+        self.t = array('d', bytes(8 * size))
+        self.cols = [array('d', bytes(8 * size)) for _ in self.fields]
+        self.count = 0                    # Total samples ever written. Write index is count % size
+        self.lock = threading.Lock()
+
+    def append(self, t, *values):
+        with self.lock:
+            i = self.count % self.size
+            self.t[i] = t
+            for col, value in zip(self.cols, values):
+                col[i] = value
+            self.count += 1
+
+    def append3(self, t, a, b, c):
+        ''' append() for a three field ring (volts, amps, watts) without the *values tuple and zip, the per-sample path '''
+        with self.lock:
+            i = self.count % self.size
+            self.t[i] = t
+            cols = self.cols
+            cols[0][i] = a
+            cols[1][i] = b
+            cols[2][i] = c
+            self.count += 1
+
+    def _span(self, seconds=None, n=None, now=None, count=None):
+        ''' Start index and length of the newest samples (last n, or newer than seconds ago). Call with lock held
+        or pass the count the span should end at '''
+        count = self.count if count is None else count
+        available = min(count, self.size)
+        if n is not None:
+            available = min(available, n)
+        if seconds is not None and available:
+            since = (perf_counter() if now is None else now) - seconds
+            lo, hi = count - available, count   # Timestamps only go up, binary search the oldest one in the window
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.t[mid % self.size] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            available = count - lo
+        return (count - available) % self.size, available
+
+    def _copy(self, col, start, length):
+        end = start + length
+        if end <= self.size:
+            return col[start:end]
+        return col[start:] + col[:end - self.size]
+
+    def slice(self, seconds=None, n=None):
+        ''' Copy of the newest samples as (t, [field arrays]) oldest first '''
+        with self.lock:
+            start, length = self._span(seconds, n)
+            return self._copy(self.t, start, length), [self._copy(col, start, length) for col in self.cols]
+
+    def stats(self, seconds=None, n=None):
+        ''' n/mean/min/max/rms per field over the newest samples. Fields with no valid samples get nan '''
+        t, cols = self.slice(seconds, n)
+        out = {}
+        for field, col in zip(self.fields, cols):
+            values = [x for x in col if x == x]     # drop nan (overflow)
+            if values:
+                count = len(values)
+                out[field] = {'n': count, 'mean': sum(values) / count, 'min': min(values), 'max': max(values),
+                              'rms': sqrt(sum(x * x for x in values) / count)}
+            else:
+                out[field] = {'n': 0, 'mean': nan, 'min': nan, 'max': nan, 'rms': nan}
+        return out
+
+    def flatstats(self, seconds=None, n=None, digits=4):
+        ''' Window stats flattened into one dict for publishing. Also adds the sample count as samplesi '''
+        out = {}
+        samples = 0
+        for field, stats in self.stats(seconds, n).items():
+            samples = max(samples, stats['n'])
+            for stat in STATS:
+                if stats['n']:
+                    out[statkey(field, stat)] = round(stats[stat], digits)
+        out['samplesi'] = samples
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+class Sampler(threading.Thread):
+    ''' Thread reading one PiINA219 at its conversion rate (or a fixed period) into a RingBuffer '''
+
+    def __init__(self, ina219, size=10000, period=None, logger=None, onsample=None):
+        super().__init__(name="sampler-{0}".format(hex(ina219.address)), daemon=True)
+        self.ina219 = ina219
+        self.period = period              # None = ina219.conversion_time() (or 0 when ina219.acquire paces reads off CNVR)
+                                          # 0 = back to back reads
+        self.ring = RingBuffer(size, (ina219.voltkey, ina219.currentkey, ina219.powerkey))
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.onsample = onsample          # Optional onsample(t, volts, amps, watts) on every sample (amps/watts None on overflow)
+        self.errors = 0                   # i2c/os errors (sample skipped)
+        self.onsample_errors = 0          # onsample raised (ie an AdcTuner set_adc i2c error). Sampling carries on
+        self._calls = deque()             # (future, func, args) to run between reads
+        self._stop_event = threading.Event()
+
+    def run(self):
+        read_into = self.ina219.read_into
+        sample = Sample()
+        append = self.ring.append3
+        onsample = self.onsample
+        if self.period is not None:
+            period = self.period
+        elif self.ina219.acquire is not None:   # read() already waits for each conversion
+            period = 0
+        else:
+            period = self.ina219.conversion_time()
+        adc_changes = self.ina219.adc_changes
+        self.logger.info('sampler {0} started, period {1:.3f}ms'.format(hex(self.ina219.address), period * 1000))
+        deadline = perf_counter()
+        t_logged = 0.0                    # Last onsample error logged, at most one a second
+        while not self._stop_event.is_set():
+            if self._calls:
+                self._run_calls()
+            try:
+                read_into(sample)
+            except OSError as e:
+                self.errors += 1
+                self.logger.warning('sampler {0} read failed: {1}'.format(hex(self.ina219.address), e))
+                self._stop_event.wait(0.1)
+                deadline = perf_counter()
+                continue
+            t = sample.t
+            amps = sample.amps
+            watts = sample.watts
+            append(t, sample.volts, nan if amps is None else amps, nan if watts is None else watts)
+            if onsample is not None:
+                try:
+                    onsample(t, sample.volts, amps, watts)
+                except Exception as e:
+                    self.onsample_errors += 1
+                    if t - t_logged >= 1:
+                        t_logged = t
+                        self.logger.warning('sampler {0} onsample failed ({1} so far): {2!r}'.format(
+                            hex(self.ina219.address), self.onsample_errors, e), exc_info=True)
+            if self.ina219.adc_changes != adc_changes:   # set_adc at runtime (ie AdcTuner). Follow the new conversion time
+                adc_changes = self.ina219.adc_changes
+                if self.period is None and self.ina219.acquire is None:
+                    period = self.ina219.conversion_time()
+            deadline += period
+            if deadline > t:
+                sleep(deadline - t)
+            else:
+                deadline = t                # Reads are slower than conversions. Run back to back, don't try to catch up
+
+    def call(self, func, *args):
+        ''' Run func(*args) on the sampler thread between two reads, so it never lands in the middle of one
+        (ie ina219.set_adc). Returns a Future with the result. Runs at once if the sampler is not running '''
+        future = Future()
+        if not self.is_alive():
+            self._call(future, func, args)
+        else:
+            self._calls.append((future, func, args))
+        return future
+
+    def _run_calls(self):
+        while self._calls:
+            self._call(*self._calls.popleft())
+
+    @staticmethod
+    def _call(future, func, args):
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def stop(self, timeout=1):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def flatstats(self, seconds=None, n=None, digits=4):
+        ''' Window stats flattened into one dict for publishing (RingBuffer.flatstats) '''
+        return self.ring.flatstats(seconds, n, digits)
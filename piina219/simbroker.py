@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in MQTT broker for exercising the publish path with paho, no mosquitto needed.
+
+Speaks enough MQTT 3.1.1 for a publishing client: CONNECT/CONNACK, PUBLISH with PUBACK (QoS 1) or
+PUBREC/PUBREL/PUBCOMP (QoS 2), SUBSCRIBE/SUBACK (granted, nothing is forwarded), PINGREQ/PINGRESP, DISCONNECT.
+Messages are counted, and kept as (topic, payload bytes) in received with keep=True. Runs an asyncio loop
+in its own thread.
+
+A slow or stuck broker is the point:
+rate          messages/sec it reads at most. Past that the socket fills and the client backs up (TCP backpressure)
+ack_delay     seconds before each QoS 1/2 acknowledgement goes out
+stall(secs)   stop reading for a while, ie a broker pausing on a disk flush
+
+broker = SimBroker(rate=200)           # port 0 = any free port
+client.connect('127.0.0.1', broker.port)
+broker.messages, broker.bytes          # received so far
+broker.close()
+'''
+
+import asyncio, threading, struct
+from time import monotonic
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK = range(1, 10)
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+class SimBroker:
+
+    def __init__(self, host='127.0.0.1', port=0, rate=None, ack_delay=0.0, keep=False):
+        self.host = host
+        self.rate = rate
+        self.ack_delay = ack_delay
+        self.keep = keep
+        self.received = []                # (topic, payload) with keep=True
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self._stall_until = 0.0
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(port,), name='simbroker', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self, port):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._client, self.host, port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def stall(self, seconds):
+        ''' Stop reading from every client for seconds '''
+        self._stall_until = monotonic() + seconds
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, shift = 0, 0
+        while True:                        # Remaining length, 7 bits per byte
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return header[0], await reader.readexactly(length)
+
+    async def _ack(self, writer, kind, mid):
+        if self.ack_delay:
+            await asyncio.sleep(self.ack_delay)
+        if not writer.is_closing():
+            writer.write(bytes((kind << 4, 2)) + struct.pack('>H', mid))
+
+    async def _client(self, reader, writer):
+        self.connections += 1
+        t_next = monotonic()
+        try:
+            while True:
+                delay = max(self._stall_until, t_next) - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                header, body = await self._read_packet(reader)
+                kind = header >> 4
+                if kind == CONNECT:
+                    writer.write(bytes((CONNACK << 4, 2, 0, 0)))
+                elif kind == PUBLISH:
+                    qos = (header >> 1) & 0x03
+                    topic_len = struct.unpack_from('>H', body)[0]
+                    self.messages += 1
+                    self.bytes += len(body) - topic_len - 2 - (2 if qos else 0)
+                    if self.keep:
+                        self.received.append((body[2:2 + topic_len].decode(), body[2 + topic_len + (2 if qos else 0):]))
+                    if qos:
+                        mid = struct.unpack_from('>H', body, 2 + topic_len)[0]
+                        self._loop.create_task(self._ack(writer, PUBACK if qos == 1 else PUBREC, mid))
+                    if self.rate:
+                        t_next = max(t_next, monotonic() - 1) + 1 / self.rate
+                elif kind == PUBREL:
+                    writer.write(bytes((PUBCOMP << 4, 2)) + body[:2])
+                elif kind == SUBSCRIBE:
+                    topics = 0
+                    i = 2
+                    while i < len(body):
+                        i += 2 + struct.unpack_from('>H', body, i)[0] + 1
+                        topics += 1
+                    writer.write(bytes((SUBACK << 4, 2 + topics)) + body[:2] + bytes(topics))
+                elif kind == PINGREQ:
+                    writer.write(bytes((PINGRESP << 4, 0)))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):   # Cancelled = close()
+            pass
+        finally:
+            writer.close()
+
+    async def _shutdown(self):
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(2)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(2)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+'''
+Simulated INA219 on a simulated I2C bus. Lets PiINA219 (and anything built on it) run without a board.
+
+SimINA219 answers the same calls pi-ina219 makes on an Adafruit_GPIO.I2C.Device
+(readU16BE, readS16BE, writeList) and keeps the real register map:
+0x00 config, 0x01 shunt, 0x02 bus, 0x03 power, 0x04 current, 0x05 calibration
+
+Every transaction costs xfer_s seconds (time.sleep so other threads keep running).
+A 2 byte register read at 100kHz is ~0.4ms, at 400kHz ~0.1ms.
+
+Conversions follow the ADC settings in the config register like the real part. In continuous mode (7) new
+results land every shunt+bus conversion time, in triggered mode (1-3) one conversion runs after each config
+write. CNVR is set when a conversion finishes and cleared by reading power or writing config.
+convert_s=0 skips the timing and converts on every read.
+
+sim = SimINA219(address=0x40, volts=5.0, amps=0.120)
+ina = PiINA219('Vbusf', 'IbusAf', 'PowerWf', i2c=sim)
+sim.amps = 0.250          # change the load
+sim.transactions          # number of i2c transactions so far
+
+Devices sharing a SimI2CBus take turns on it like the real bus (one transaction at a time),
+devices on different buses run in parallel.
+bus = SimI2CBus(busnum=1, xfer_s=0.0004)
+simA = bus.device(0x40, amps=0.1)
+simB = bus.device(0x41, amps=0.2)
+discover([1], i2c={1: bus})   # bus.get_i2c_device() stands in for Adafruit_GPIO.I2C, empty addresses NACK
+
+The bus also speaks the lower level APIs the driver backends (piina219/backends.py) are built on
+bus.smbus()               smbus2.SMBus calls (read_word_data little endian, write_i2c_block_data)
+bus.busio()               Blinka busio.I2C calls (try_lock, writeto, readfrom_into, writeto_then_readfrom, scan)
+open_device('smbus', 0x40, 1, bus=bus.smbus())   # PiINA219(i2c=..) on the real smbus2 code path
+
+Faults and noise for exercising the error paths
+noise_amps/noise_volts  gaussian noise (std) on each single conversion, reduced by sqrt(n) when the ADC averages n
+sim.force_ovf = True    set OVF on every conversion (math overflow) whatever the load
+fail_rate=0.01          1% of transactions raise OSError 121 (Remote I/O error) like a flaky bus
+'''
+
+import threading
+import time
+import random
+from math import trunc, sqrt
+
+REG_CONFIG = 0x00
+REG_SHUNTVOLTAGE = 0x01
+REG_BUSVOLTAGE = 0x02
+REG_POWER = 0x03
+REG_CURRENT = 0x04
+REG_CALIBRATION = 0x05
+
+CONFIG_DEFAULT = 0x399F   # Power on reset value (32V, /8 gain, 12bit, continuous shunt+bus)
+SHUNT_LSB = 0.00001       # 10uV
+BUS_LSB = 0.004           # 4mV
+PGA_LIMIT = [4000, 8000, 16000, 32000]  # Shunt register full scale for gain /1, /2, /4, /8
+BUS_LIMIT = [16, 32]      # BRNG 0=16V, 1=32V (ADC itself tops out near 32V)
+
+class SimI2CBus:
+    ''' One simulated /dev/i2c-N. Transactions from all devices on it are serialized by a lock '''
+
+    def __init__(self, busnum=1, xfer_s=0.0004):
+        self.busnum = busnum
+        self.xfer_s = xfer_s
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def device(self, address=0x40, **kwargs):
+        ''' Add a SimINA219 at address on this bus '''
+        kwargs.setdefault('xfer_s', self.xfer_s)
+        self.devices[address] = SimINA219(address, bus=self, **kwargs)
+        return self.devices[address]
+
+    def get_i2c_device(self, address, busnum=None):
+        ''' Same call as Adafruit_GPIO.I2C.get_i2c_device. Nothing at address = every read is NACKed (OSError) '''
+        return self.devices.get(address) or _Absent(self)
+
+    def smbus(self):
+        return SimSMBus(self)
+
+    def busio(self):
+        return SimBusIO(self)
+
+class SimSMBus:
+    ''' smbus2.SMBus stand-in on a SimI2CBus. SMBus words are little endian, the INA219 sends MSB first '''
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def read_word_data(self, address, register):
+        value = self.bus.get_i2c_device(address).readU16BE(register)
+        return ((value & 0xFF) << 8) | (value >> 8)
+
+    def read_i2c_block_data(self, address, register, length):
+        value = self.bus.get_i2c_device(address).readU16BE(register)
+        return [value >> 8, value & 0xFF][:length]
+
+    def write_i2c_block_data(self, address, register, data):
+        self.bus.get_i2c_device(address).writeList(register, data)
+
+    def write_word_data(self, address, register, value):
+        self.bus.get_i2c_device(address).writeList(register, [value & 0xFF, value >> 8])
+
+    def close(self):
+        pass
+
+class SimBusIO:
+    ''' Blinka busio.I2C stand-in on a SimI2CBus. A 1 byte write sets the register pointer, 3 bytes write a register '''
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._pointer = {}
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def scan(self):
+        return sorted(self.bus.devices)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        device = self.bus.get_i2c_device(address)
+        if not data:                      # Probe. Costs a transaction, NACKs if nothing is there
+            device.readU16BE(0x00)
+        elif len(data) == 1:
+            self._pointer[address] = data[0]
+        else:
+            self._pointer[address] = data[0]
+            device.writeList(data[0], list(data[1:3]))
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        value = self.bus.get_i2c_device(address).readU16BE(self._pointer.get(address, 0))
+        end = len(buffer) if end is None else end
+        buffer[start:end] = bytes((value >> 8, value & 0xFF))[:end - start]
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        ''' Register pointer write and read with a repeated start, one transaction '''
+        self._pointer[address] = buffer_out[out_start]
+        self.readfrom_into(address, buffer_in, start=in_start, end=in_end)
+
+class _Absent:
+    ''' Empty address. Costs a transaction and fails like the real bus '''
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def readU16BE(self, register):
+        with self.bus.lock:
+            time.sleep(self.bus.xfer_s)
+        raise OSError(121, 'Remote I/O error')
+
+    readS16BE = readU16BE
+
+class SimINA219:
+
+    def __init__(self, address=0x40, volts=5.0, amps=0.1, shunt_ohms=0.1, xfer_s=0.0004, profile=None, convert_s=None, bus=None,
+                 noise_amps=0.0, noise_volts=0.0, fail_rate=0.0):
+        self.address = address
+        self.bus = bus                    # SimI2CBus shared with other devices, None = a bus of its own
+        self.busnum = bus.busnum if bus is not None else None
+        self.volts = volts                # Bus voltage (load side) seen by the device
+        self.amps = amps                  # Current through the shunt
+        self.shunt_ohms = shunt_ohms
+        self.xfer_s = xfer_s              # Seconds per i2c transaction
+        self.profile = profile            # Optional profile(t_sec) -> (volts, amps), overrides volts/amps
+        self.convert_s = convert_s        # None = conversion time from the config ADC bits, 0 = convert on every read
+        self.noise_amps = noise_amps      # Std of one 12bit conversion, averaging mode divides by sqrt(samples)
+        self.noise_volts = noise_volts
+        self.fail_rate = fail_rate        # Fraction of transactions that fail with OSError
+        self.force_ovf = False
+        self.transactions = 0
+        self.conversions = 0              # Conversions completed (compare with samples read to check for misses)
+        self.regs = [0] * 6
+        self.reset()
+
+    def reset(self):
+        ''' Power on reset. Config back to default and calibration cleared '''
+        self.regs = [0] * 6
+        self.regs[REG_CONFIG] = CONFIG_DEFAULT
+        self._conv_start = time.perf_counter()   # Continuous: when the conversion sequence started. Triggered: trigger time
+        self._conv_done = 0                      # Continuous: conversions already latched since _conv_start
+        self._triggered = False                  # Triggered: conversion pending
+
+    def conversion_time(self):
+        ''' Shunt + bus conversion time for the ADC bits in the config register '''
+        if self.convert_s is not None:
+            return self.convert_s
+        config = self.regs[REG_CONFIG]
+        return _adc_time((config >> 7) & 0x0F) + _adc_time((config >> 3) & 0x0F)
+
+    def load(self):
+        ''' Present volts, amps from the profile (if given) or the static attributes '''
+        if self.profile is not None:
+            return self.profile(time.perf_counter())
+        return self.volts, self.amps
+
+    def gain(self):
+        return (self.regs[REG_CONFIG] >> 11) & 0x03
+
+    def convert(self):
+        ''' Run one conversion of the present load into the shunt, bus, current and power registers '''
+        volts, amps = self.load()
+        config = self.regs[REG_CONFIG]
+        if self.noise_amps:
+            amps += random.gauss(0, self.noise_amps / sqrt(_adc_samples((config >> 3) & 0x0F)))
+        if self.noise_volts:
+            volts += random.gauss(0, self.noise_volts / sqrt(_adc_samples((config >> 7) & 0x0F)))
+        limit = PGA_LIMIT[(config >> 11) & 0x03]
+        shunt = int(round(amps * self.shunt_ohms / SHUNT_LSB))
+        shunt = max(-limit, min(limit, shunt))
+        bus = int(round(min(max(volts, 0), BUS_LIMIT[(config >> 13) & 0x01]) / BUS_LSB))
+        bus = min(bus, 0x1FFF)
+        ovf = 1 if self.force_ovf else 0
+        cal = self.regs[REG_CALIBRATION] & 0xFFFE
+        current = trunc(shunt * cal / 4096)
+        if current > 0x7FFF or current < -0x8000:
+            current = max(-0x8000, min(0x7FFF, current))
+            ovf = 1
+        power = trunc(abs(current) * bus / 5000)
+        if power > 0xFFFF:
+            power = 0xFFFF
+            ovf = 1
+        self.regs[REG_SHUNTVOLTAGE] = shunt & 0xFFFF
+        self.regs[REG_CURRENT] = current & 0xFFFF
+        self.regs[REG_POWER] = power
+        self.regs[REG_BUSVOLTAGE] = (bus << 3) | 0x02 | ovf   # CNVR set, OVF if math overflowed
+
+    def _xfer(self):
+        self.transactions += 1
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise OSError(121, 'Remote I/O error')
+        if self.bus is not None:
+            with self.bus.lock:
+                time.sleep(self.xfer_s)
+        elif self.xfer_s:
+            time.sleep(self.xfer_s)
+
+    def update(self):
+        ''' Latch any conversion that has finished by now '''
+        mode = self.regs[REG_CONFIG] & 0x07
+        conv = self.conversion_time()
+        if mode == 0 or mode == 4:          # Power down / ADC off
+            return
+        if conv == 0:
+            self.convert()
+            self.conversions += 1
+        elif mode >= 5:                     # Continuous
+            done = int((time.perf_counter() - self._conv_start) / conv)
+            if done > self._conv_done:
+                self.conversions += done - self._conv_done
+                self._conv_done = done
+                self.convert()
+        elif self._triggered and time.perf_counter() - self._conv_start >= conv:
+            self._triggered = False
+            self.conversions += 1
+            self.convert()
+
+    def _read(self, register):
+        self._xfer()
+        if register in (REG_SHUNTVOLTAGE, REG_BUSVOLTAGE, REG_POWER, REG_CURRENT):
+            self.update()
+        value = self.regs[register] if register < len(self.regs) else 0   # No registers past calibration
+        if register == REG_POWER:
+            self.regs[REG_BUSVOLTAGE] &= ~0x02   # Reading power clears CNVR
+        return value
+
+    # Adafruit_GPIO.I2C.Device interface used by pi-ina219
+    def readU16BE(self, register):
+        return self._read(register)
+
+    def readS16BE(self, register):
+        value = self._read(register)
+        return value - 0x10000 if value > 0x7FFF else value
+
+    def writeList(self, register, data):
+        self._xfer()
+        value = (data[0] << 8) | data[1]
+        if register == REG_CONFIG and value & 0x8000:
+            self.reset()
+        elif register == REG_CONFIG:
+            self.regs[REG_CONFIG] = value
+            self.regs[REG_BUSVOLTAGE] &= ~0x02   # Writing config clears CNVR and restarts conversions
+            self._conv_start = time.perf_counter()
+            self._conv_done = 0
+            self._triggered = value & 0x07 in (1, 2, 3)
+        elif register == REG_CALIBRATION:
+            self.regs[REG_CALIBRATION] = value & 0xFFFE   # Bit 0 is void and reads 0
+
+def _adc_samples(code):
+    return 1 << (code & 0x07) if code & 0x08 else 1
+
+def _adc_time(code):
+    ''' Conversion time for a 4 bit BADC/SADC code. 0-3 = 9-12bit, 8-15 = 1 to 128 averaged 12bit samples '''
+    if code & 0x08:
+        return 532e-6 * (1 << (code & 0x07))
+    return (84e-6, 148e-6, 276e-6, 532e-6)[code & 0x03]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for the InfluxDB write endpoint, for trying InfluxSink without an influx server.
+
+Answers POST /write (1.x) and /api/v2/write (2.x) with 204, gunzips the body and counts lines, points per
+series and bytes. Lines are parsed just enough to check them (measurement/tags, fields, integer timestamp).
+A bad line gets the whole batch a 400, like influx, and so does a precision the endpoint does not take
+(1.x n/ns/u/ms/s/m/h, 2.x ns/us/ms/s) or timestamps more than a year off now in that precision.
+Runs an http.server in its own thread.
+
+down(seconds)   answer 503 for a while, ie influx restarting
+delay           seconds to hold each response, a slow server
+
+db = SimInflux()                       # port 0 = any free port
+sink = InfluxSink(db.url, db='ina219')
+db.points, db.requests, db.bytes       # received so far
+db.series                              # {'ina219,device=ina219A': points}
+db.writes                              # [(points, first timestamp)] per accepted request, in arrival order
+db.close()
+'''
+
+import gzip, threading
+from time import time, monotonic, sleep
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PRECISIONS = {'/write': ('n', 'ns', 'u', 'ms', 's', 'm', 'h'), '/api/v2/write': ('ns', 'us', 'ms', 's')}
+SCALE = {'n': 10**9, 'ns': 10**9, 'u': 10**6, 'us': 10**6, 'ms': 10**3, 's': 1, 'm': 1 / 60, 'h': 1 / 3600}
+
+def parse_line(line):
+    ''' (series, fields text, timestamp) of one line protocol line. ValueError if it is not valid '''
+    parts, escaped, quoted, start = [], False, False, 0
+    for i, char in enumerate(line):       # Split on the unescaped spaces outside quoted field strings
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char == ' ' and not quoted:
+            parts.append(line[start:i])
+            start = i + 1
+    parts.append(line[start:])
+    if len(parts) != 3 or not parts[0] or not parts[1] or '=' not in parts[1]:
+        raise ValueError('bad line: {0!r}'.format(line[:80]))
+    return parts[0], parts[1], int(parts[2])
+
+class SimInflux:
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        self.delay = delay
+        self.requests = 0
+        self.points = 0
+        self.bytes = 0                    # Request bodies as sent (gzip)
+        self.errors = 0                   # 4xx/5xx answers
+        self.series = {}
+        self.writes = []
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                sim._write(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self._server.server_address[1]
+        self.url = 'http://{0}:{1}'.format(host, self.port)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='siminflux', daemon=True)
+        self._thread.start()
+
+    def down(self, seconds):
+        ''' Answer 503 for seconds '''
+        self._down_until = monotonic() + seconds
+
+    def _answer(self, handler, code, text=b''):
+        handler.send_response(code)
+        handler.send_header('Content-Length', str(len(text)))
+        handler.end_headers()
+        handler.wfile.write(text)
+
+    def _write(self, handler):
+        body = handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+        if self.delay:
+            sleep(self.delay)
+        if monotonic() < self._down_until:
+            with self._lock:
+                self.errors += 1
+            return self._answer(handler, 503, b'{"error":"down"}')
+        url = urlsplit(handler.path)
+        if url.path not in PRECISIONS:
+            return self._answer(handler, 404)
+        precision = parse_qs(url.query).get('precision', ['ns'])[0]
+        if precision not in PRECISIONS[url.path]:
+            with self._lock:
+                self.errors += 1
+            return self._answer(handler, 400, '{{"error":"invalid precision {0!r}"}}'.format(precision).encode())
+        try:
+            if handler.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body) if body else body
+            counts = {}
+            first = None
+            for line in body.decode().splitlines():
+                if line and not line.startswith('#'):
+                    series, fieldset, timestamp = parse_line(line)
+                    if abs(timestamp / SCALE[precision] - time()) > 365 * 86400:
+                        raise ValueError('timestamp {0} is not {1} precision'.format(timestamp, precision))
+                    counts[series] = counts.get(series, 0) + 1
+                    first = timestamp if first is None else first
+        except (ValueError, OSError, EOFError) as e:
+            with self._lock:
+                self.errors += 1
+            return self._answer(handler, 400, '{{"error":"{0}"}}'.format(e).encode())
+        with self._lock:
+            self.requests += 1
+            self.bytes += int(handler.headers.get('Content-Length', 0))
+            for series, count in counts.items():
+                self.series[series] = self.series.get(series, 0) + count
+                self.points += count
+            self.writes.append((sum(counts.values()), first))
+        self._answer(handler, 204)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(2)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+'''
+Store and forward for MQTT. Messages published while the broker is unreachable go to a bounded on-disk
+spool and are drained in batches at a fixed rate once the connection is back.
+
+The spool is an append-only log split into segment files (seg-00000001.spool, ..) in one directory.
+record  '<IdHI' crc32, t epoch sec, topic length, payload length, then topic and payload
+        crc32 covers everything after it, so a record cut short by a crash or power loss is detected and skipped
+cursor  file 'cursor' holds the segment and offset of the next record to send. It is rewritten after each
+        drain so a restart resends at most one drain batch (at least once delivery)
+When the spool passes max_bytes the oldest segment is deleted (oldest data dropped, counted in dropped).
+
+spool = Spool('/home/pi/spool', max_bytes=50*10**6)
+publisher = SpoolPublisher(mqtt_client, spool, drain_rate=500)
+publisher.publish(topic, payload)     # same call as mqtt_client.publish. Spools if not connected or publish fails
+publisher.drain()                     # call every ~0.1s (scheduler job). Sends up to drain_rate msgs/sec when connected
+
+Single JSON readings drained together for one topic are sent as one columnar JSON batch (piina219/batch.py)
+so they keep the time they were taken. Batches and other payloads are sent as they were.
+'''
+
+import os, json, struct, threading, logging
+from zlib import crc32
+from time import time, monotonic
+from .batch import encode
+
+RECORD = struct.Struct('<IdHI')
+
+class Spool:
+
+    def __init__(self, directory, max_bytes=50 * 10**6, segment_bytes=10**6, fsync=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync                # fsync every put. Survives power loss, costs an sd card write per message
+        self.dropped = 0                  # Records lost to the size limit
+        self.corrupt = 0                  # Truncated/damaged records skipped
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[4:12]) for name in os.listdir(directory)
+                               if name.startswith('seg-') and name.endswith('.spool'))
+        self.read_seq, self.read_offset = self._load_cursor()
+        self._writer = None
+
+    def _path(self, seq):
+        return os.path.join(self.directory, 'seg-{0:08d}.spool'.format(seq))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor')) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 1), 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'w') as f:
+            f.write('{0} {1}'.format(self.read_seq, self.read_offset))
+        os.replace(path + '.tmp', path)
+
+    def size(self):
+        ''' Bytes on disk, including records already sent from the oldest segment '''
+        return sum(os.path.getsize(self._path(seq)) for seq in self.segments)
+
+    def __bool__(self):
+        ''' True while there are records not sent yet '''
+        if any(seq > self.read_seq for seq in self.segments):
+            return True
+        return self.read_seq in self.segments and self.read_offset < os.path.getsize(self._path(self.read_seq))
+
+    def put(self, topic, payload, t=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        body = struct.pack('<dHI', time() if t is None else t, len(topic), len(payload)) + topic + payload
+        if self._writer is None or self._writer.tell() >= self.segment_bytes:
+            self._roll()
+        self._writer.write(struct.pack('<I', crc32(body)) + body)
+        self._writer.flush()
+        if self.fsync:
+            os.fsync(self._writer.fileno())
+
+    def _roll(self):
+        ''' Start a new segment and enforce max_bytes by dropping the oldest ones '''
+        if self._writer is not None:
+            self._writer.close()
+        seq = self.segments[-1] + 1 if self.segments else max(1, self.read_seq)
+        self.segments.append(seq)
+        self._writer = open(self._path(seq), 'ab')
+        while len(self.segments) > 1 and self.size() > self.max_bytes:
+            oldest = self.segments.pop(0)
+            self.dropped += sum(1 for record in self._records(oldest, 0) if record[2] is not None)
+            os.remove(self._path(oldest))
+            if self.read_seq <= oldest:
+                self.read_seq, self.read_offset = self.segments[0], 0
+        self._save_cursor()
+
+    def _records(self, seq, offset):
+        ''' Yield (next offset, t, topic, payload) from one segment starting at offset.
+        A damaged record yields (end of file, None, None, None) so the reader skips the rest of the segment '''
+        with open(self._path(seq), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            crc, t, topiclen, payloadlen = RECORD.unpack_from(data, pos)
+            end = pos + RECORD.size + topiclen + payloadlen
+            if end > len(data) or crc32(data[pos + 4:end]) != crc:
+                self.corrupt += 1             # Torn write at the end of a segment. Nothing after it is trusted
+                yield offset + len(data), None, None, None
+                return
+            topic = data[pos + RECORD.size:pos + RECORD.size + topiclen].decode()
+            yield offset + end, t, topic, data[pos + RECORD.size + topiclen:end]
+            pos = end
+        if pos < len(data):                   # Less than a record header left over
+            self.corrupt += 1
+            yield offset + len(data), None, None, None
+
+    def get(self, count):
+        ''' Up to count oldest records as [(t, topic, payload)] without removing them. Follow with commit() '''
+        out = []
+        self._pending = (self.read_seq, self.read_offset)
+        self._positions = []              # Cursor after each record returned, for commit(count)
+        for i, segment in enumerate(self.segments):
+            if segment < self.read_seq:
+                continue
+            start = self.read_offset if segment == self.read_seq else 0
+            for offset, t, topic, payload in self._records(segment, start):
+                self._pending = (segment, offset)
+                if topic is None:
+                    break
+                out.append((t, topic, payload))
+                self._positions.append((segment, offset))
+                if len(out) >= count:
+                    return out
+            if i + 1 < len(self.segments):      # Segment done (the newest one is still being written)
+                self._pending = (self.segments[i + 1], 0)
+        return out
+
+    def commit(self, count=None):
+        ''' Mark the records from the last get() as sent (only the first count of them if given) and delete
+        fully sent segments '''
+        if count is None:
+            self.read_seq, self.read_offset = self._pending
+        elif count > 0:
+            self.read_seq, self.read_offset = self._positions[count - 1]
+        else:
+            return
+        while self.segments and self.segments[0] < self.read_seq:
+            os.remove(self._path(self.segments.pop(0)))
+        self._save_cursor()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+class SpoolPublisher:
+    ''' mqtt client.publish stand-in that spools while the broker is down and drains the backlog afterwards '''
+
+    def __init__(self, client, spool, drain_rate=500, qos=0, logger=None):
+        self.client = client
+        self.spool = spool
+        self.drain_rate = drain_rate      # Max spooled messages per second sent after reconnect
+        self.qos = qos
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.spooled = 0
+        self.drained = 0
+        self.lock = threading.Lock()      # publish() and drain() can run on different threads (ie behind an AsyncPublisher)
+        self._t_drain = monotonic()
+
+    def publish(self, topic, payload, qos=None):
+        if self.client.is_connected():
+            info = self.client.publish(topic, payload, self.qos if qos is None else qos)
+            if info.rc == 0:
+                return info
+        with self.lock:
+            self.spool.put(topic, payload)
+            self.spooled += 1
+        return None
+
+    def drain(self):
+        ''' Send the next slice of the backlog. The slice size follows drain_rate and the time since the last call '''
+        now = monotonic()
+        budget = int((now - self._t_drain) * self.drain_rate)
+        if budget < 1:
+            return 0
+        self._t_drain = now
+        with self.lock:
+            if not self.client.is_connected() or not self.spool:
+                return 0
+            records = self.spool.get(budget)
+            sent = 0
+            for topic, payload, count in self._group(records):
+                if self.client.publish(topic, payload, self.qos).rc != 0:
+                    break                 # Lost the connection again. What was not sent stays in the spool
+                sent += count
+            self.spool.commit(None if sent == len(records) else sent)
+            self.drained += sent
+        if not self.spool:
+            self.logger.info('spool drained, {0} messages resent'.format(self.drained))
+        return sent
+
+    def _group(self, records):
+        ''' Runs of plain JSON readings on the same topic become one timestamped batch. Everything else as is.
+        Yields (topic, payload, records it carries) '''
+        run, runtopic = [], None
+        for t, topic, payload in records:
+            reading = None
+            if payload[:1] == b'{':
+                reading = json.loads(payload)
+                if 't0' in reading:           # Already a batch
+                    reading = None
+            if reading is None or topic != runtopic:
+                if run:
+                    yield runtopic, encode(run, 'json'), len(run)
+                run, runtopic = [], None
+            if reading is None:
+                yield topic, payload, 1
+            else:
+                parts = topic.split('/')
+                run.append((parts[1] if len(parts) > 1 else topic, t, reading))
+                runtopic = topic
+        if run:
+            yield runtopic, encode(run, 'json'), len(run)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+'''
+Triggered transient capture (oscilloscope mode). Inrush and brown-outs last milliseconds and vanish in a 1Hz
+snapshot. The trigger sees every sample (Sampler onsample), keeps the newest ones in its own ring as the
+pre-trigger buffer, and when the signal trips it freezes pre seconds before and post seconds after the trigger
+into one event. Events are published as one JSON message each, so the detail costs network only when it matters.
+
+mode      rising    field crosses level going up (after it was below level - hysteresis)
+          falling   field crosses level going down (after it was above level + hysteresis)
+          above     field at or above level
+          below     field at or below level
+holdoff   seconds after an event ends before the trigger re-arms. A level that stays tripped fires again after it
+
+trigger = Trigger('IbusAf', 'rising', level=0.5, pre=0.01, post=0.05, holdoff=1)
+sampler = Sampler(ina219A, onsample=trigger.add)
+for payload in trigger.poll():        # scheduler job, every 0.1s or so
+    mqtt_client.publish(pubtopic + '/event', payload)
+
+Event message (dt in us from the trigger, negative before it, nan as null)
+{"t0": epoch sec, "field": "IbusAf", "mode": "rising", "level": 0.5, "valuef": 0.52, "pre": 0.01, "post": 0.05,
+ "n": 90, "dt": [-9980, ..], "Vbusf": [..], "IbusAf": [..], "PowerWf": [..], "IbusAminf": .., "IbusAmaxf": .., ..}
+'''
+
+import json, logging
+from collections import deque
+from math import nan
+from time import time, perf_counter
+from .sampler import RingBuffer, statkey
+
+MODES = ('rising', 'falling', 'above', 'below')
+ARMED, POST, HOLDOFF = range(3)
+
+class Trigger:
+
+    def __init__(self, field, mode='rising', level=0.0, hysteresis=0.0, pre=0.01, post=0.05, holdoff=1.0,
+                 fields=('Vbusf', 'IbusAf', 'PowerWf'), size=4096, max_events=10, digits=5, logger=None):
+        if mode not in MODES:
+            raise ValueError('mode must be one of {0}'.format(MODES))
+        if field not in fields:
+            raise ValueError('field must be one of {0}'.format(tuple(fields)))
+        self.field = field
+        self.mode = mode
+        self.level = level
+        self.hysteresis = hysteresis      # Edge modes: how far back past level the signal must go to arm again
+        self.pre = pre                    # Seconds kept before the trigger
+        self.post = post                  # Seconds captured after it
+        self.holdoff = holdoff
+        self.digits = digits
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.ring = RingBuffer(size, fields)   # Pre-trigger buffer. Must hold pre + post at the sample rate
+        self.triggers = 0
+        self.events = 0                   # Events taken by poll()
+        self.missed = 0                   # Events dropped because poll() did not keep up (max_events)
+        self.truncated = 0                # Events whose window did not fit in the ring
+        self._index = list(fields).index(field)
+        self._state = ARMED
+        self._primed = mode in ('above', 'below')
+        self._t_trigger = 0.0
+        self._value = nan
+        self._t_rearm = 0.0
+        self._ready = deque(maxlen=max_events)   # Frozen windows, sampler thread appends, poll() takes
+
+    def add(self, t, volts, amps, watts):
+        ''' Sampler onsample(t, volts, amps, watts). amps/watts None (overflow) are stored as nan '''
+        if amps is None:
+            amps = watts = nan
+        self.ring.append3(t, volts, amps, watts)
+        index = self._index
+        value = volts if index == 0 else amps if index == 1 else watts
+        if self._state == ARMED:
+            if value != value:
+                return
+            if self._tripped(value):
+                self._state = POST
+                self._t_trigger = t
+                self._value = value
+                self.triggers += 1
+        elif self._state == POST:
+            if t - self._t_trigger >= self.post:
+                self._freeze()
+                self._state = HOLDOFF
+                self._t_rearm = t + self.holdoff
+        elif t >= self._t_rearm:
+            self._state = ARMED
+            self._primed = self.mode in ('above', 'below')
+
+    def _tripped(self, value):
+        mode = self.mode
+        if mode == 'above':
+            return value >= self.level
+        if mode == 'below':
+            return value <= self.level
+        if mode == 'rising':
+            if value < self.level - self.hysteresis:
+                self._primed = True
+            elif self._primed and value >= self.level:
+                return True
+        else:
+            if value > self.level + self.hysteresis:
+                self._primed = True
+            elif self._primed and value <= self.level:
+                return True
+        return False
+
+    def _freeze(self):
+        ''' Copy the window out of the ring before it is overwritten. Runs on the sampler thread, once per event '''
+        start = self._t_trigger - self.pre
+        t, cols = self.ring.slice(seconds=perf_counter() - start)
+        if len(self._ready) == self._ready.maxlen:
+            self.missed += 1
+        if len(t) == self.ring.size:
+            self.truncated += 1           # The whole ring is newer than the window start, the front is missing
+        self._ready.append((self._t_trigger, self._value, t, cols))
+
+    def poll(self):
+        ''' Encoded events frozen since the last call, oldest first '''
+        out = []
+        while self._ready:
+            out.append(self.encode(*self._ready.popleft()))
+            self.events += 1
+        return out
+
+    def encode(self, t_trigger, value, t, cols):
+        ''' One event as compact JSON. Times are perf_counter in the ring, t0 is epoch '''
+        digits = self.digits
+        event = {'t0': round(t_trigger + time() - perf_counter(), 6), 'field': self.field, 'mode': self.mode,
+                 'level': self.level, 'valuef': round(value, digits), 'pre': self.pre, 'post': self.post,
+                 'n': len(t), 'dt': [int(round((x - t_trigger) * 10**6)) for x in t]}
+        for field, col in zip(self.ring.fields, cols):
+            event[field] = [round(x, digits) if x == x else None for x in col]
+        for field, col in zip(self.ring.fields, cols):
+            values = [x for x in col if x == x]
+            if values:
+                event[statkey(field, 'min')] = round(min(values), digits)
+                event[statkey(field, 'max')] = round(max(values), digits)
+        return json.dumps(event, separators=(',', ':'))
+
+    def stats(self):
+        return {'triggers': self.triggers, 'events': self.events, 'missed': self.missed, 'truncated': self.truncated}
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+'''
+Picks bus_adc/shunt_adc for a target sample rate and noise floor, and re-tunes when the load noise changes.
+
+Each ADC setting is a conversion time (ADC_CONV_S) and a noise level. Averaging N samples divides white noise
+by sqrt(N), 9-11bit settings add quantization noise (LSB/sqrt(12)). Noise is measured from the samples going
+by from the successive differences (mean of the smallest 90% of |difference|, scaled for gaussian noise), so a
+slowly changing load or the odd load step does not count as noise.
+That is scaled back to the noise of a single 12bit conversion, and every setting's noise is predicted from it.
+
+rate   samples/sec wanted. Only settings whose conversion cycle (bus + shunt) fits in 1/rate are used
+noise  current noise floor wanted, amps RMS. vnoise is the same for the bus voltage
+Choice: the fastest setting that meets the noise floor within the rate. No noise floor = the lowest noise the rate allows.
+No setting meets the floor = the lowest noise the rate allows (logged)
+
+tuner = AdcTuner(ina219A, rate=100, noise=0.0005)     # 100 samples/sec, 0.5mA RMS
+sampler = Sampler(ina219A, onsample=tuner.add)        # or tuner.add(t, volts, amps, watts) after each read
+tuner.tune()                                          # re-tune now with the last noise estimate
+'''
+
+import logging
+from array import array
+from math import sqrt
+from .Mpiina219 import ADC_CONV_S
+
+CODES = (0, 1, 2, 3, 9, 10, 11, 12, 13, 14, 15)    # 9-12bit, then 2-128 averaged 12bit samples
+SHUNT_LSB = 10e-6                                   # Shunt register volts per bit at 12bit
+BUS_LSB = 4e-3                                      # Bus register volts per bit
+TRIM = 0.9                                          # Fraction of the smallest differences kept in the noise estimate
+TRIM_SCALE = 0.6574 * sqrt(2)                       # Trimmed mean |difference| per unit of gaussian noise
+
+def adc_samples(code):
+    return 1 << (code & 0x07) if code & 0x08 else 1
+
+def adc_bits(code):
+    return 12 if code & 0x08 else 9 + (code & 0x03)
+
+def adc_noise(code, raw, lsb):
+    ''' Predicted RMS noise for a setting from the noise of one 12bit conversion (raw) and the 12bit lsb '''
+    q = lsb * (1 << (12 - adc_bits(code)))
+    return sqrt(raw * raw / adc_samples(code) + q * q / 12)
+
+class AdcTuner:
+
+    def __init__(self, ina219, rate=None, noise=None, vnoise=None, window=200, retune=0.5, holdoff=10, logger=None):
+        self.ina219 = ina219
+        self.rate = rate
+        self.noise = noise
+        self.vnoise = vnoise
+        self.window = window              # Samples per noise estimate
+        self.retune = retune              # Re-tune when the raw noise moves by more than this fraction (0.5 = +50%/-33%)
+        self.holdoff = holdoff            # Seconds between re-tunes at least
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.retunes = 0
+        self.raw_amps = None              # Noise of one 12bit conversion, amps RMS (last estimate)
+        self.raw_volts = None
+        self._tuned = (None, None)        # Raw noise the current setting was picked for
+        self._t_tuned = None
+        self._diff_amps = array('d', bytes(8 * window))
+        self._diff_volts = array('d', bytes(8 * window))
+        self._reset()
+
+    def _reset(self):
+        self._n = 0
+        self._last = None
+
+    def add(self, t, volts, amps, watts):
+        ''' One sample at perf_counter time t. Signature matches Sampler onsample '''
+        if amps is None or amps != amps:
+            self._last = None             # Overflow breaks the difference chain
+            return
+        last = self._last
+        self._last = (volts, amps)
+        if last is None:
+            return
+        self._diff_volts[self._n] = abs(volts - last[0])
+        self._diff_amps[self._n] = abs(amps - last[1])
+        self._n += 1
+        if self._n >= self.window:
+            self._estimate(t)
+
+    def _estimate(self, t):
+        ''' Close a window. Scale the measured noise back to one 12bit conversion '''
+        ina = self.ina219
+        keep = int(self._n * TRIM)
+        amps = sum(sorted(self._diff_amps[:self._n])[:keep]) / keep / TRIM_SCALE
+        volts = sum(sorted(self._diff_volts[:self._n])[:keep]) / keep / TRIM_SCALE
+        self._reset()
+        lsb_amps = SHUNT_LSB / ina.SHUNT_OHMS
+        self.raw_amps = sqrt(max(amps * amps - (lsb_amps * (1 << (12 - adc_bits(ina.shunt_adc)))) ** 2 / 12, 0) * adc_samples(ina.shunt_adc))
+        self.raw_volts = sqrt(max(volts * volts - (BUS_LSB * (1 << (12 - adc_bits(ina.bus_adc)))) ** 2 / 12, 0) * adc_samples(ina.bus_adc))
+        if self._t_tuned is not None and t - self._t_tuned < self.holdoff:
+            return
+        if self._t_tuned is None or self._moved(self.raw_amps, self._tuned[0]) or self._moved(self.raw_volts, self._tuned[1]):
+            self._t_tuned = t
+            self.tune()
+
+    def _moved(self, raw, tuned):
+        if tuned is None:
+            return True
+        low, high = tuned / (1 + self.retune), tuned * (1 + self.retune)
+        return not low <= raw <= high and abs(raw - tuned) > 1e-9
+
+    def choose(self, raw_amps=None, raw_volts=None):
+        ''' (bus_adc, shunt_adc) for the targets given the raw noise. Unknown noise counts as 0 '''
+        budget = 1 / self.rate if self.rate else None
+        lsb_amps = SHUNT_LSB / self.ina219.SHUNT_OHMS
+        best, best_key = None, None
+        for bus in CODES:
+            for shunt in CODES:
+                seconds = ADC_CONV_S[bus] + ADC_CONV_S[shunt]
+                if budget is not None and seconds > budget:
+                    continue
+                amps = adc_noise(shunt, raw_amps or 0.0, lsb_amps)
+                volts = adc_noise(bus, raw_volts or 0.0, BUS_LSB)
+                # How far over the floor (0 = met). No floor: bus/shunt at least 12bit
+                over = max(amps / self.noise - 1, 0) if self.noise else (0 if shunt >= 3 else 1)
+                over += max(volts / self.vnoise - 1, 0) if self.vnoise else (0 if bus >= 3 else 1)
+                if self.noise is None and self.vnoise is None and budget is not None:
+                    key = (amps / lsb_amps + volts / BUS_LSB, seconds)   # Spend the whole budget on averaging
+                elif over:
+                    key = (1, over, seconds)
+                else:
+                    key = (0, seconds, amps)
+                if best_key is None or key < best_key:
+                    best, best_key = (bus, shunt), key
+        if best is None:                  # Rate faster than any setting. Go as fast as possible
+            return 0, 0
+        if best_key[0] == 1 and (self.noise or self.vnoise):
+            self.logger.warning('ina219 at {0}: noise floor not reachable at {1}/s, using lowest noise setting'.format(
+                self.ina219.address, self.rate))
+        return best
+
+    def tune(self):
+        ''' Apply the best setting for the latest noise estimate. Returns (bus_adc, shunt_adc) '''
+        bus, shunt = self.choose(self.raw_amps, self.raw_volts)
+        self._tuned = (self.raw_amps, self.raw_volts)
+        if (bus, shunt) != (self.ina219.bus_adc, self.ina219.shunt_adc):
+            self.retunes += 1
+            self.logger.info('ina219 at {0} tuned for noise {1}A {2}V (one 12bit conversion)'.format(
+                self.ina219.address, 'unknown' if self.raw_amps is None else '{0:.6f}'.format(self.raw_amps),
+                'unknown' if self.raw_volts is None else '{0:.4f}'.format(self.raw_volts)))
+            self.ina219.set_adc(bus, shunt)
+            self._reset()                 # Samples from the old setting don't go in the next estimate
+        return bus, shunt
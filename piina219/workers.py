@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+'''
+One worker process per i2c bus. Sampling runs outside the publishing process, so the GIL, logging and mqtt stalls
+in the coordinator can't delay a read.
+
+Each worker reads the boards on its bus back to back (MultiReader, triggered boards pipelined) and writes every
+sample into a SharedRing per board: a RingBuffer whose columns live in an anonymous shared mmap. The coordinator
+reads the rings (stats/flatstats/slice) without taking any lock the worker waits on. One writer per ring, readers
+copy and drop whatever the writer overwrote while they were copying.
+Workers are forked (Linux/Pi), so the PiINA219 objects set up in the coordinator are the ones the worker reads.
+They are forked by a launcher process that start() forks first, before mqtt/influx/publish threads are running,
+so no worker (restarts included) starts with a lock some other thread held at fork time (ie a logging handler).
+The coordinator must not read them itself once the workers are started. Boards with a capture set are refused:
+the forked copies would each write the one file from their own record count, and the coordinator's would clear it.
+Timestamps are perf_counter (CLOCK_MONOTONIC, the same clock in every process).
+
+supervise() restarts a worker that died or stopped sending heartbeats (stall seconds), no more often than holdoff.
+acqstats (PiINA219 counters) are copied into shared memory by the worker every second.
+call() runs a PiINA219 method in the worker between two read cycles (ie set_adc). Calls are kept and run again
+on a restarted worker, which starts from the boards as they were set up in the coordinator.
+
+workers = BusWorkers(ina219Set, size=20000)     # {'ina219A': PiINA219(busnum=1), 'ina219B': PiINA219(busnum=3)}
+workers.start()
+workers.rings['ina219A'].flatstats(seconds=1)  # same as Sampler.flatstats
+workers.supervise()                             # every second or so
+workers.call('ina219A', 'set_adc', 3, 15)       # waits for the worker to run it, raises if it failed
+workers.close()
+'''
+
+import os, mmap, signal, logging, threading
+import multiprocessing
+from array import array
+from math import nan
+from time import perf_counter, sleep
+from .sampler import RingBuffer
+from .multireader import MultiReader
+
+HEARTBEAT, CYCLES, ERRORS, PID, COMMANDS, EXITCODE = range(6)  # Per worker shared state (doubles). EXITCODE nan while running
+
+class SharedRing(RingBuffer):
+    ''' RingBuffer in an anonymous shared mmap, written by one forked process and read by another '''
+
+    def __init__(self, size, fields=('Vbusf', 'IbusAf', 'PowerWf')):
+        self.size = size
+        self.fields = tuple(fields)
+        self._mm = mmap.mmap(-1, 8 + 8 * size * (len(self.fields) + 1))    # MAP_SHARED, survives fork
+        view = memoryview(self._mm)
+        self._count = view[0:8].cast('Q')
+        self.t = view[8:8 + 8 * size].cast('d')
+        self.cols = [view[8 + 8 * size * (i + 1):8 + 8 * size * (i + 2)].cast('d') for i in range(len(self.fields))]
+        self.lock = threading.Lock()      # Only keeps threads of one process apart
+
+    @property
+    def count(self):
+        return self._count[0]
+
+    @count.setter
+    def count(self, value):               # Written after the sample, so a reader never sees a count ahead of its data
+        self._count[0] = value
+
+    def _copy(self, col, start, length):
+        out = array('d')
+        end = start + length
+        if end <= self.size:
+            out.frombytes(col[start:end].cast('B'))
+        else:
+            out.frombytes(col[start:].cast('B'))
+            out.frombytes(col[:end - self.size].cast('B'))
+        return out
+
+    def slice(self, seconds=None, n=None):
+        ''' Copy of the newest samples as (t, [field arrays]) oldest first. Samples the writer overwrote during
+        the copy (ring lapped, or the slot being written) are dropped from the front '''
+        count = self.count
+        start, length = self._span(seconds, n, count=count)
+        t = self._copy(self.t, start, length)
+        cols = [self._copy(col, start, length) for col in self.cols]
+        torn = self.count + 1 - self.size - (count - length)
+        if torn > 0:
+            del t[:torn]
+            for col in cols:
+                del col[:torn]
+        return t, cols
+
+class BusWorkers:
+
+    def __init__(self, ina219Set, size=20000, period=None, stall=5.0, holdoff=5.0, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        for device, ina219 in ina219Set.items():
+            if ina219.capture is not None:
+                raise ValueError('{0}: capture is not supported with bus workers, use highrate'.format(device))
+        self.ina219Set = ina219Set
+        self.period = period              # Seconds per read cycle. None = slowest board's conversion time (0 if all use acquire)
+        self.stall = stall                # No heartbeat for this long = worker hung, restart it
+        self.holdoff = holdoff            # Seconds between restarts of one worker at least
+        self.restarts = 0
+        self.buses = {}                   # busnum -> [device, ..]
+        for device, ina219 in ina219Set.items():
+            self.buses.setdefault(ina219.busnum, []).append(device)
+        self.rings = {device: SharedRing(size, (ina219.voltkey, ina219.currentkey, ina219.powerkey))
+                      for device, ina219 in ina219Set.items()}
+        self._ctx = multiprocessing.get_context('fork')
+        self._state = {busnum: self._ctx.Array('d', 6, lock=False) for busnum in self.buses}
+        self._pipes = {busnum: self._ctx.Pipe() for busnum in self.buses}   # (coordinator end, worker end)
+        self._calls = {device: [] for device in ina219Set}                # (method, args) run so far, replayed on restart
+        self._call_lock = threading.Lock()
+        self._seq = 0
+        self._acqkeys = {device: list(ina219.acqstats()) for device, ina219 in ina219Set.items()}
+        self._acq = {device: self._ctx.Array('d', len(keys), lock=False) for device, keys in self._acqkeys.items()}
+        self._stop = self._ctx.Event()
+        self._launcher = None
+        self._launch = None               # Coordinator end of the launcher pipe
+        self._launch_lock = threading.Lock()
+        self._pids = {}                   # busnum -> worker pid
+        self._started = {}                # busnum -> perf_counter of the last (re)start
+
+    def start(self):
+        ''' Fork the launcher and the workers. Call before starting other threads '''
+        self._launch, conn = self._ctx.Pipe()
+        self._launcher = self._ctx.Process(target=self._launcher_run, args=(conn,), name='i2cbus-launcher', daemon=True)
+        self._launcher.start()
+        for busnum in self.buses:
+            self._spawn(busnum)
+
+    def _spawn(self, busnum):
+        state = self._state[busnum]
+        state[HEARTBEAT] = perf_counter()
+        state[EXITCODE] = nan
+        with self._launch_lock:
+            self._launch.send((busnum, self._calls))
+            pid = self._launch.recv() if self._launch.poll(5) else 0
+        self._pids[busnum] = pid
+        self._started[busnum] = perf_counter()
+        if not pid:
+            state[EXITCODE] = -1
+            self.logger.error('bus {0} launcher did not answer, worker not started'.format(busnum))
+            return
+        self.logger.info('bus {0} worker pid {1}: {2}'.format(busnum, pid, self.buses[busnum]))
+
+    def _launcher_run(self, conn):
+        ''' Launcher process. Forks a worker per request and reaps them. Stays single threaded '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        children = {}                     # pid -> busnum
+        while not self._stop.is_set():
+            if conn.poll(0.2):
+                try:
+                    busnum, calls = conn.recv()
+                except EOFError:          # Coordinator is gone
+                    break
+                self._calls = calls       # Calls made since start(), replayed by the new worker
+                pid = os.fork()
+                if pid == 0:
+                    self._worker(busnum)
+                children[pid] = busnum
+                conn.send(pid)
+            for pid, busnum in list(children.items()):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    self._state[busnum][EXITCODE] = os.waitstatus_to_exitcode(status)
+                    del children[pid]
+        deadline = perf_counter() + 2
+        for pid, busnum in children.items():
+            while not os.waitpid(pid, os.WNOHANG)[0]:
+                if perf_counter() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                sleep(0.05)
+
+    def _worker(self, busnum):
+        ''' Forked worker. Never returns '''
+        code = 0
+        multiprocessing.current_process().name = 'i2cbus-{0}'.format(busnum)
+        try:
+            self._run(busnum)
+        except BaseException:
+            self.logger.exception('bus {0} worker failed'.format(busnum))
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _run(self, busnum):
+        ''' Worker process main loop '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # ctrl-C is for the coordinator, it stops the workers
+        launcher = os.getppid()
+        devices = {device: self.ina219Set[device] for device in self.buses[busnum]}
+        state = self._state[busnum]
+        state[PID] = os.getpid()
+        conn = self._pipes[busnum][1]
+        while conn.poll():                # Sent to the worker this one replaces, already in the replayed calls
+            conn.recv()
+        commands = state[COMMANDS]
+        for device in devices:
+            for method, args in self._calls[device]:
+                self._apply(devices[device], method, args)
+        reader = MultiReader(devices, logger=self.logger)
+        rings = [(device, self.rings[device].append) for device in devices]
+        period = self._period(devices)
+        adc_changes = [ina219.adc_changes for ina219 in devices.values()]
+        t_acq = 0.0
+        deadline = perf_counter()
+        while not self._stop.is_set():
+            readings = reader.read().readings
+            for device, append in rings:
+                reading = readings[device]
+                if reading is not None:
+                    append(reading.t, reading.volts, nan if reading.amps is None else reading.amps,
+                           nan if reading.watts is None else reading.watts)
+            t = perf_counter()
+            state[HEARTBEAT] = t
+            state[CYCLES] += 1
+            state[ERRORS] = reader.errors
+            if state[COMMANDS] != commands:
+                commands = state[COMMANDS]
+                while conn.poll():
+                    seq, device, method, args = conn.recv()
+                    conn.send((seq, self._apply(devices[device], method, args)))
+                changes = [ina219.adc_changes for ina219 in devices.values()]
+                if changes != adc_changes:   # set_adc (ie a ZCMD bus_adc). Follow the new conversion time like Sampler
+                    adc_changes = changes
+                    period = self._period(devices)
+            if t - t_acq >= 1:
+                t_acq = t
+                if os.getppid() != launcher:   # Launcher (and so the coordinator) is gone
+                    break
+                for device, ina219 in devices.items():
+                    self._acq[device][:] = array('d', ina219.acqstats().values())
+            deadline += period
+            if deadline > t:
+                sleep(deadline - t)
+            else:
+                deadline = t
+
+    def _period(self, devices):
+        ''' Seconds per read cycle for the boards on one bus '''
+        if self.period is not None:
+            return self.period
+        if all(ina219.acquire is not None for ina219 in devices.values()):
+            return 0                      # read() already waits for each conversion
+        return max(ina219.conversion_time() for ina219 in devices.values())
+
+    def _apply(self, ina219, method, args):
+        ''' Run one call in the worker. Returns None or the error as text '''
+        try:
+            getattr(ina219, method)(*args)
+        except Exception as e:
+            self.logger.warning('ina219 at {0} {1}{2} failed: {3}'.format(ina219.address, method, args, e))
+            return '{0}: {1}'.format(type(e).__name__, e)
+        return None
+
+    def call(self, device, method, *args, timeout=1.0):
+        ''' Run ina219Set[device].<method>(*args) in its worker between two read cycles and wait for it.
+        Raises RuntimeError if it failed there, TimeoutError if the worker did not answer (it runs after a restart) '''
+        busnum = self.ina219Set[device].busnum
+        conn = self._pipes[busnum][0]
+        with self._call_lock:
+            self._seq += 1
+            seq = self._seq
+            self._calls[device].append((method, args))
+            conn.send((seq, device, method, args))
+            self._state[busnum][COMMANDS] += 1
+            deadline = perf_counter() + timeout
+            while conn.poll(max(deadline - perf_counter(), 0)):
+                reply, error = conn.recv()
+                if reply != seq:          # Answer to a call that timed out earlier
+                    continue
+                if error is not None:
+                    self._calls[device].pop()
+                    raise RuntimeError(error)
+                return
+        raise TimeoutError('bus {0} worker did not answer {1} in {2}s'.format(busnum, method, timeout))
+
+    def _alive(self, busnum):
+        code = self._state[busnum][EXITCODE]
+        return code != code               # nan = not reaped by the launcher yet
+
+    def supervise(self):
+        ''' Restart dead or hung workers. Call every second or so from the coordinator '''
+        now = perf_counter()
+        for busnum, pid in self._pids.items():
+            alive = self._alive(busnum)
+            if alive and now - self._state[busnum][HEARTBEAT] < self.stall:
+                continue
+            if now - self._started[busnum] < self.holdoff:
+                continue
+            if alive:
+                self.logger.warning('bus {0} worker pid {1} hung ({2:.1f}s since last cycle), restarting'.format(
+                    busnum, pid, now - self._state[busnum][HEARTBEAT]))
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                for _ in range(20):       # Wait for the launcher to reap it
+                    if not self._alive(busnum):
+                        break
+                    sleep(0.05)
+            else:
+                self.logger.warning('bus {0} worker pid {1} exited with code {2:.0f}, restarting'.format(
+                    busnum, pid, self._state[busnum][EXITCODE]))
+            self.restarts += 1
+            self._spawn(busnum)
+
+    def acqstats(self, device):
+        ''' PiINA219.acqstats() of a board as of the worker's last copy (up to a second old) '''
+        return {key: int(value) for key, value in zip(self._acqkeys[device], self._acq[device])}
+
+    def stats(self, busnum):
+        ''' Worker state for the metrics: cycles, errors, seconds since the last cycle '''
+        state = self._state[busnum]
+        return {'worker_cycles': int(state[CYCLES]), 'worker_errors': int(state[ERRORS]),
+                'worker_alive': int(self._alive(busnum)), 'worker_age_s': perf_counter() - state[HEARTBEAT]}
+
+    def close(self, timeout=2):
+        ''' Stop the workers (the launcher waits up to 2s for them, then kills them) and the launcher '''
+        self._stop.set()
+        if self._launcher is not None:
+            self._launcher.join(timeout + 2.5)
+            if self._launcher.is_alive():
+                self._launcher.kill()
+                self._launcher.join()
@@ -66,7 +66,12 @@ def read():
         logging.info("Current overflow")
     return Vbus, Ibus, Pwr, Vshunt
 
-ina219A = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, address=ADDRESS, log_level=logging.INFO)
+SIMULATE = False  # True runs without a board on a simulated INA219 (piina219/simbus.py)
+if SIMULATE:
+    from piina219 import PiINA219, SimINA219
+    ina219A = PiINA219(maxA=MAX_EXPECTED_AMPS, address=ADDRESS, i2c=SimINA219(ADDRESS, volts=5.0, amps=0.12, noise_amps=0.002)).ina219
+else:
+    ina219A = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, address=ADDRESS, log_level=logging.INFO)
 
 # AUTO GAIN
 #ina219A.configure()  # automatically adjusts gain as required until the maximum is reached, when a DeviceRangeError exception